@@ -0,0 +1,171 @@
+"""
+Benchmarks for the weather data pipeline.
+Run from the project_weather_app directory:
+    python benchmark.py
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from database import WeatherDatabase
+from columnar_store import ColumnarWeatherStore
+from decode import COLUMNS, hourly_to_frame, records_to_frame, time_to_minutes
+from location import Location
+
+BENCHMARKS = ["insert", "decode", "scan"]
+
+
+def make_forecast(n: int, seed: int = 0) -> dict:
+    """
+    Make a forecast with n hourly records, shaped like the "hourly" data of the API.
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2024, 1, 1)
+    return {
+        "time": [(start + datetime.timedelta(hours=i)).isoformat(timespec="minutes")
+                 for i in range(n)],
+        "precipitation_probability": rng.integers(0, 100, n).tolist(),
+        "precipitation": rng.random(n).round(2).tolist(),
+        "wind_speed_10m": (rng.random(n) * 20).round(1).tolist(),
+    }
+
+
+def bench_insert_single_record(db: WeatherDatabase, locations, forecast) -> float:
+    """
+    Insert the forecast for each location one record at a time.
+    Returns the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    for location in locations:
+        for record in zip(forecast["time"],
+                          forecast["precipitation_probability"],
+                          forecast["precipitation"],
+                          forecast["wind_speed_10m"]):
+            db.insert_single_record(location, *record)
+    return time.perf_counter() - start
+
+
+def bench_insert_records(db: WeatherDatabase, locations, forecast) -> float:
+    """
+    Insert the forecast for each location with the bulk insert.
+    Returns the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    for location in locations:
+        db.insert_records(location, forecast)
+    return time.perf_counter() - start
+
+
+def run_insert_benchmark(hours: int, n_locations: int):
+    """
+    Compare rows/sec of insert_single_record() and insert_records().
+    """
+    forecast = make_forecast(hours)
+    locations = [Location(longitude=13.41 + i * 0.1, latitude=52.52) for i in range(n_locations)]
+    rows = hours * n_locations
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, bench in [("insert_single_record", bench_insert_single_record),
+                            ("insert_records", bench_insert_records)]:
+            db = WeatherDatabase(os.path.join(tmpdir, name + ".db"))
+            elapsed = bench(db, locations, forecast)
+            print(f"{name:<24} {rows:>8} rows {elapsed:>9.3f} s {rows / elapsed:>12.0f} rows/sec")
+            del db
+
+
+def old_hourly_to_frame(hourly: dict) -> pd.DataFrame:
+    """
+    The decode of the API response before decode.hourly_to_frame().
+    """
+    df = pd.DataFrame(hourly)
+    df["time"] = df["time"].map(np.datetime64)
+    return df.set_index("time")
+
+def old_records_to_frame(records) -> pd.DataFrame:
+    """
+    The decode of the database records before decode.records_to_frame().
+    """
+    df = pd.DataFrame(records)
+    df.columns = COLUMNS
+    df["time"] = df["time"].map(np.datetime64)
+    return df.set_index("time")
+
+def time_it(func, *args) -> float:
+    """
+    Returns the elapsed time in seconds of func(*args).
+    """
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def run_decode_benchmark(rows: int):
+    """
+    Compare the row-wise and the columnar decode of the API response
+    and of the database records.
+    """
+    hourly = make_forecast(rows)
+    records = list(zip(*[hourly[column] for column in COLUMNS]))
+    # the database stores the time as integer minutes since the epoch
+    minute_records = list(zip(time_to_minutes(hourly["time"]).tolist(),
+                              *[hourly[column] for column in COLUMNS[1:]]))
+    for name, func, data in [("decode API (old)", old_hourly_to_frame, hourly),
+                             ("decode API", hourly_to_frame, hourly),
+                             ("decode records (old)", old_records_to_frame, records),
+                             ("decode records", records_to_frame, minute_records)]:
+        elapsed = time_it(func, data)
+        print(f"{name:<24} {rows:>8} rows {elapsed:>9.3f} s {rows / elapsed:>12.0f} rows/sec")
+
+def get_size(path) -> int:
+    """
+    Get the size in bytes of a file (with its sqlite write-ahead log), or of all files in a directory.
+    """
+    if os.path.isfile(path):
+        return sum(os.path.getsize(name) for name in [path, path + "-wal"] if os.path.exists(name))
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+def run_scan_benchmark(hours: int, n_locations: int):
+    """
+    Compare the full scan (get_all_data() and iter_chunks()) and the disk size
+    of the SQLite database and the columnar store.
+    """
+    forecast = make_forecast(hours)
+    locations = [Location(longitude=13.41 + i * 0.1, latitude=52.52) for i in range(n_locations)]
+    rows = hours * n_locations
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, path, create in [("sqlite", os.path.join(tmpdir, "weather.db"), WeatherDatabase),
+                                   ("columnar", os.path.join(tmpdir, "columnar"), ColumnarWeatherStore)]:
+            storage = create(path)
+            elapsed = time_it(lambda: [storage.insert_records(location, forecast) for location in locations])
+            print(f"{'insert ' + name:<24} {rows:>8} rows {elapsed:>9.3f} s {rows / elapsed:>12.0f} rows/sec")
+            elapsed = time_it(storage.get_all_data)
+            print(f"{'get_all_data ' + name:<24} {rows:>8} rows {elapsed:>9.3f} s {rows / elapsed:>12.0f} rows/sec")
+            elapsed = time_it(lambda: sum(len(df) for df in storage.iter_chunks()))
+            print(f"{'iter_chunks ' + name:<24} {rows:>8} rows {elapsed:>9.3f} s {rows / elapsed:>12.0f} rows/sec")
+            print(f"{'disk size ' + name:<24} {get_size(path) / 1e6:>8.1f} MB")
+            del storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the weather data pipeline.")
+    parser.add_argument("--bench", action="append", choices=BENCHMARKS,
+                        help="benchmark to run, can be repeated (default: all)")
+    parser.add_argument("--hours", type=int, default=168, help="hours of forecast per location")
+    parser.add_argument("--locations", type=int, default=10, help="number of locations")
+    parser.add_argument("--decode-rows", type=int, default=1_000_000, help="rows for the decode benchmark")
+    args = parser.parse_args()
+    benchmarks = args.bench or BENCHMARKS
+    if "insert" in benchmarks:
+        run_insert_benchmark(args.hours, args.locations)
+    if "decode" in benchmarks:
+        run_decode_benchmark(args.decode_rows)
+    if "scan" in benchmarks:
+        run_scan_benchmark(args.hours, args.locations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+Benchmark suite of the stages of the weather data pipeline, parametrized over
+the hours of data per location (rows) and the number of locations.
+The API stages download from the local stand-in server (stub_server.py).
+Run from the project_weather_app directory:
+    python benchmark_suite.py run --rows 168 720 --locations 1 10 --output results.json
+    python benchmark_suite.py compare baseline.json results.json --threshold 0.2
+The results are written as json. compare exits with status 1 if a stage is slower
+than in the baseline by more than the threshold, so it can gate changes.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# plot without a display, before pyplot is imported by the visualization handler
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from benchmark import make_forecast
+from database import WeatherDatabase
+from data_service import DataServiceFromAPI, DataServiceMocked, split_response
+from decode import COLUMNS, hourly_to_frame
+from mock_data import make_locations
+from stub_server import start_server
+from util import get_file_path
+from visualization_handler import HeadlessVisualizationHandler, VisualizationHandler, render_many
+
+CONFIG_FILE = "config/config.json"
+FIXTURE_FILE = "fixtures/forecast_multi.json"
+
+class BenchmarkContext():
+    def __init__(self, tmpdir: str, url: str):
+        """
+        The temporary directory for the databases and config files of the stages,
+        and the url of the stand-in API server.
+        """
+        self.tmpdir = tmpdir
+        self.url = url
+        self._n_files = 0
+
+    def new_db_file(self) -> str:
+        """
+        Get the path of a new database file.
+        """
+        self._n_files += 1
+        return os.path.join(self.tmpdir, "weather_" + str(self._n_files) + ".db")
+
+    def config_file(self, forecast_days: int) -> str:
+        """
+        Get a config file for the stand-in server and forecast_days days of forecast,
+        without a rate limit or the http cache.
+        """
+        filename = os.path.join(self.tmpdir, "config_" + str(forecast_days) + ".json")
+        if not os.path.exists(filename):
+            with open(get_file_path(CONFIG_FILE, calling_file=__file__)) as f:
+                config = json.load(f)
+            config["configuration"]["url"] = self.url
+            config["configuration"]["fetch"].update({"requests_per_second": 0,
+                                                     "forecast_days": forecast_days})
+            config["configuration"]["http_cache"] = {"enabled": False}
+            with open(filename, "w") as f:
+                json.dump(config, f)
+        return filename
+
+# Each stage is set up for the rows per location and the number of locations,
+# untimed, and returns the function to time and the number of records it handles.
+
+def setup_insert_single_record(ctx: BenchmarkContext, rows: int, n_locations: int):
+    db = WeatherDatabase(ctx.new_db_file())
+    forecast = make_forecast(rows)
+    records = list(zip(*[forecast[column] for column in COLUMNS]))
+    locations = make_locations(n_locations)
+    def run():
+        for location in locations:
+            for record in records:
+                db.insert_single_record(location, *record)
+    return run, rows * n_locations
+
+def setup_insert_records(ctx: BenchmarkContext, rows: int, n_locations: int):
+    db = WeatherDatabase(ctx.new_db_file())
+    forecast = make_forecast(rows)
+    locations = make_locations(n_locations)
+    def run():
+        for location in locations:
+            db.insert_records(location, forecast)
+    return run, rows * n_locations
+
+def setup_insert_many(ctx: BenchmarkContext, rows: int, n_locations: int):
+    db = WeatherDatabase(ctx.new_db_file())
+    forecast = make_forecast(rows)
+    locations = make_locations(n_locations)
+    def run():
+        db.insert_many((location, forecast) for location in locations)
+    return run, rows * n_locations
+
+def _make_database(ctx: BenchmarkContext, rows: int, n_locations: int):
+    """
+    Make a database with rows records for each of n_locations locations.
+    """
+    db = WeatherDatabase(ctx.new_db_file())
+    forecast = make_forecast(rows)
+    locations = make_locations(n_locations)
+    db.insert_many((location, forecast) for location in locations)
+    return db, locations
+
+def setup_get_location_record(ctx: BenchmarkContext, rows: int, n_locations: int):
+    db, locations = _make_database(ctx, rows, n_locations)
+    def run():
+        for location in locations:
+            db.get_location_record(location)
+    return run, rows * n_locations
+
+def setup_get_df(ctx: BenchmarkContext, rows: int, n_locations: int):
+    db, _ = _make_database(ctx, rows, n_locations)
+    records = db.cursor.execute("SELECT " + ", ".join(COLUMNS) + " FROM weather;").fetchall()
+    def run():
+        db._get_df(records)
+    return run, len(records)
+
+def setup_mock_download_data(ctx: BenchmarkContext, rows: int, n_locations: int):
+    db = WeatherDatabase(ctx.new_db_file())
+    data_service = DataServiceMocked(CONFIG_FILE, db, hours=rows)
+    locations = make_locations(n_locations)
+    def run():
+        for location in locations:
+            data_service.download_data(location)
+    return run, rows * n_locations
+
+def setup_api_download_data(ctx: BenchmarkContext, rows: int, n_locations: int):
+    forecast_days = math.ceil(rows / 24)
+    db = WeatherDatabase(ctx.new_db_file())
+    data_service = DataServiceFromAPI(ctx.config_file(forecast_days), db)
+    locations = make_locations(n_locations)
+    def run():
+        for location in locations:
+            data_service.download_data(location)
+    return run, forecast_days * 24 * n_locations
+
+def setup_api_download_many(ctx: BenchmarkContext, rows: int, n_locations: int):
+    forecast_days = math.ceil(rows / 24)
+    db = WeatherDatabase(ctx.new_db_file())
+    data_service = DataServiceFromAPI(ctx.config_file(forecast_days), db)
+    locations = make_locations(n_locations)
+    def run():
+        data_service.download_many(locations)
+    return run, forecast_days * 24 * n_locations
+
+def make_response(rows: int, n_locations: int) -> bytes:
+    """
+    Make the body of an API response for n_locations locations with rows hours each,
+    from the multi-location response in FIXTURE_FILE, with its hourly data repeated.
+    """
+    with open(get_file_path(FIXTURE_FILE, calling_file=__file__)) as f:
+        recorded = json.load(f)
+    hourly = recorded[0]["hourly"]
+    start = datetime.datetime.fromisoformat(hourly["time"][0])
+    times = [(start + datetime.timedelta(hours=i)).isoformat(timespec="minutes") for i in range(rows)]
+    content = []
+    for i in range(n_locations):
+        item = dict(recorded[i % len(recorded)])
+        item["location_id"] = i
+        item["hourly"] = {"time": times}
+        for measure in COLUMNS[1:]:
+            values = recorded[i % len(recorded)]["hourly"][measure]
+            item["hourly"][measure] = [values[j % len(values)] for j in range(rows)]
+        content.append(item)
+    return json.dumps(content[0] if n_locations == 1 else content).encode()
+
+def setup_json_decode(ctx: BenchmarkContext, rows: int, n_locations: int):
+    body = make_response(rows, n_locations)
+    def run():
+        [hourly_to_frame(hourly) for hourly in split_response(json.loads(body), n_locations)]
+    return run, rows * n_locations
+
+def setup_visualize_data(ctx: BenchmarkContext, rows: int, n_locations: int):
+    df = hourly_to_frame(make_forecast(rows))
+    visualization_handler = VisualizationHandler()
+    def run():
+        for _ in range(n_locations):
+            visualization_handler.visualize_data(df)
+            plt.close("all")
+    return run, rows * n_locations
+
+def setup_render_headless(ctx: BenchmarkContext, rows: int, n_locations: int):
+    df = hourly_to_frame(make_forecast(rows))
+    visualization_handler = HeadlessVisualizationHandler()
+    def run():
+        for _ in range(n_locations):
+            visualization_handler.render(df)
+    return run, rows * n_locations
+
+def setup_render_many(ctx: BenchmarkContext, rows: int, n_locations: int):
+    df = hourly_to_frame(make_forecast(rows))
+    plots = [(os.path.join(ctx.tmpdir, "plot_" + str(i) + ".png"), df) for i in range(n_locations)]
+    def run():
+        render_many(plots)
+    return run, rows * n_locations
+
+STAGES = {
+    "insert_single_record": setup_insert_single_record,
+    "insert_records": setup_insert_records,
+    "insert_many": setup_insert_many,
+    "get_location_record": setup_get_location_record,
+    "get_df": setup_get_df,
+    "mock_download_data": setup_mock_download_data,
+    "api_download_data": setup_api_download_data,
+    "api_download_many": setup_api_download_many,
+    "json_decode": setup_json_decode,
+    "visualize_data": setup_visualize_data,
+    "render_headless": setup_render_headless,
+    "render_many": setup_render_many,
+}
+
+def run_stage(ctx: BenchmarkContext, stage: str, rows: int, n_locations: int, repeat: int) -> dict:
+    """
+    Time a stage repeat times, each time with a new setup.
+    """
+    times = []
+    for _ in range(repeat):
+        func, n_records = STAGES[stage](ctx, rows, n_locations)
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    return {
+        "stage": stage,
+        "rows": rows,
+        "locations": n_locations,
+        "records": n_records,
+        "repeat": repeat,
+        "times": times,
+        "min": min(times),
+        "median": median,
+        "records_per_second": n_records / median if median > 0 else None,
+    }
+
+def get_commit():
+    """
+    Get the git commit of the code, or None.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_suite(stages, rows_list, locations_list, repeat: int) -> dict:
+    """
+    Run the stages for all combinations of rows and locations.
+    """
+    results = []
+    server = start_server()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ctx = BenchmarkContext(tmpdir, "http://127.0.0.1:" + str(server.server_port) + "/v1/forecast")
+            for stage in stages:
+                for rows in rows_list:
+                    for n_locations in locations_list:
+                        result = run_stage(ctx, stage, rows, n_locations, repeat)
+                        results.append(result)
+                        print(f"{stage:<22} {rows:>6} rows {n_locations:>5} locations "
+                              f"{result['median']:>9.4f} s {result['records_per_second'] or 0:>12.0f} records/sec")
+    finally:
+        server.shutdown()
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+def compare(baseline: dict, current: dict, threshold: float, statistic: str = "median") -> bool:
+    """
+    Print the ratio of the times of current to baseline for each stage in both,
+    and return whether a stage is slower by more than threshold (e.g. 0.2 for 20%).
+    """
+    def key(result):
+        return (result["stage"], result["rows"], result["locations"])
+    baseline_results = {key(result): result for result in baseline["results"]}
+    regression = False
+    for result in current["results"]:
+        base = baseline_results.get(key(result))
+        if base is None:
+            continue
+        ratio = result[statistic] / base[statistic] if base[statistic] > 0 else float("inf")
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+            regression = True
+        elif ratio < 1 / (1 + threshold):
+            status = "faster"
+        else:
+            status = ""
+        print(f"{result['stage']:<22} {result['rows']:>6} rows {result['locations']:>5} locations "
+              f"{base[statistic]:>9.4f} s -> {result[statistic]:>9.4f} s {ratio:>6.2f}x {status}")
+    return regression
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite of the weather data pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--stage", action="append", choices=list(STAGES),
+                            help="stage to run, can be repeated (default: all)")
+    run_parser.add_argument("--rows", type=int, nargs="+", default=[168, 720],
+                            help="hours of data per location (default: 168 720)")
+    run_parser.add_argument("--locations", type=int, nargs="+", default=[1, 10],
+                            help="numbers of locations (default: 1 10)")
+    run_parser.add_argument("--repeat", type=int, default=3, help="repetitions of each benchmark")
+    run_parser.add_argument("--output", help="json file for the results")
+    compare_parser = subparsers.add_parser("compare", help="compare results with a baseline")
+    compare_parser.add_argument("baseline", help="json file of the baseline results")
+    compare_parser.add_argument("current", help="json file of the current results")
+    compare_parser.add_argument("--threshold", type=float, default=0.2,
+                                help="slowdown that counts as a regression (default: 0.2 for 20%%)")
+    compare_parser.add_argument("--statistic", choices=["median", "min"], default="median",
+                                help="statistic of the times to compare (default: median)")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_suite(args.stage or list(STAGES), args.rows, args.locations, args.repeat)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        if compare(baseline, current, args.threshold, args.statistic):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+The ForecastCache object keeps recently used weather dataframes in memory,
+in front of the database.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import pandas as pd
+
+from location import Location
+
+import logging
+logger = logging.getLogger(__name__)
+
+class ForecastCache():
+    def __init__(self, max_entries: int = 128, ttl: float = 3600, precision: int = 4):
+        """
+        Create the cache for up to max_entries dataframes.
+        An entry expires ttl seconds after it was cached, and the least recently used
+        entry is evicted when the cache is full.
+        Locations are rounded to precision decimal places for the cache key.
+        """
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._precision = precision
+        self._entries = OrderedDict() # key -> (time cached, dataframe), in LRU order
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _get_location_key(self, location: Location):
+        """
+        Get the rounded (longitude, latitude) of a location.
+        """
+        return (round(location.get_longitude(), self._precision),
+                round(location.get_latitude(), self._precision))
+
+    def _get_key(self, location: Location, start=None, end=None):
+        """
+        Get the cache key for a location and time window.
+        """
+        return self._get_location_key(location) + (start, end)
+
+    def get(self, location: Location, start=None, end=None) -> Optional[pd.DataFrame]:
+        """
+        Get the cached dataframe for a location and time window, or None.
+        The returned dataframe is a copy, so changing it does not change the cache.
+        """
+        key = self._get_key(location, start, end)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            cached_time, df = entry
+            if time.monotonic() - cached_time > self._ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return df.copy()
+
+    def put(self, location: Location, df: pd.DataFrame, start=None, end=None):
+        """
+        Cache a copy of the dataframe for a location and time window.
+        """
+        key = self._get_key(location, start, end)
+        df = df.copy()
+        with self._lock:
+            self._entries[key] = (time.monotonic(), df)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, location: Location):
+        """
+        Remove the cached dataframes of all time windows for a location.
+        """
+        location_key = self._get_location_key(location)
+        with self._lock:
+            keys = [key for key in self._entries if key[:2] == location_key]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+
+    def clear(self):
+        """
+        Remove all cached dataframes.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> dict:
+        """
+        Get the counters of the cache.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,418 @@
+"""
+The ColumnarWeatherStore object stores the weather data in columnar files:
+a directory for each location, a partition directory for each month,
+and a numpy .npy file for each column of a partition.
+The time is stored as integer minutes since the epoch, and the files are
+memory-mapped when they are read.
+"""
+import datetime
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from database import IWeatherStorage
+from decode import EPOCH, MEASURES, frame_to_columns
+from decimate import bucket_envelope, get_bucket_minutes, interleave_envelope
+from spatial_index import LocationIndex
+from location import Location
+from util import get_file_path
+from exception import DatabaseError
+
+import logging
+logger = logging.getLogger(__name__)
+
+FETCH_STATE_FILE = "fetch_state.json"
+
+class ColumnarWeatherStore(IWeatherStorage):
+    def __init__(self, store_dir: str, on_conflict: str = "update") -> None:
+        """
+        Create the columnar store for weather data in store_dir.
+        on_conflict is the policy for records that are already stored:
+        "update" overwrites them with the newer forecast, "ignore" keeps them.
+        """
+        if on_conflict not in ("update", "ignore"):
+            raise DatabaseError("Unknown on_conflict policy.", on_conflict)
+        self._update = on_conflict == "update"
+        self._path = Path(get_file_path(store_dir, calling_file=__file__))
+        if not self._path.exists():
+            logger.info("Columnar store not found: " + str(self._path))
+            logger.info("The columnar store will be created.")
+        else:
+            logger.info("Columnar store found: " + str(self._path))
+        try:
+            self._path.mkdir(parents=True, exist_ok=True)
+        except OSError as err:
+            raise DatabaseError("Error in columnar store initialiation.", err)
+        # the files of a partition are replaced one at a time,
+        # so reads and writes in this process are serialized.
+        self._lock = threading.RLock()
+        # spatial index of the stored locations, made when it is needed, with the
+        # modification time of the store directory and the locations it was made from
+        self._location_index = None
+
+    def _get_location_dir(self, location: Location) -> Path:
+        """
+        Get the directory of a location.
+        """
+        return self._path / (repr(float(location.get_longitude())) + "_"
+                             + repr(float(location.get_latitude())))
+
+    def _get_locations(self):
+        """
+        Get the stored locations, ordered by longitude and latitude.
+        """
+        locations = []
+        for location_dir in self._path.iterdir():
+            if location_dir.is_dir():
+                longitude, latitude = location_dir.name.split("_")
+                locations.append((float(longitude), float(latitude)))
+        return [Location(longitude, latitude) for longitude, latitude in sorted(locations)]
+
+    def _get_partitions(self, location: Location, start=None, end=None):
+        """
+        Get the partition directories of a location, in time order, that may have
+        records from start to end.
+        """
+        location_dir = self._get_location_dir(location)
+        if not location_dir.exists():
+            return []
+        partitions = sorted(path for path in location_dir.iterdir() if path.is_dir())
+        if start is not None:
+            first = str(np.datetime64(start, "M"))
+            partitions = [path for path in partitions if path.name >= first]
+        if end is not None:
+            last = str(np.datetime64(end, "M"))
+            partitions = [path for path in partitions if path.name <= last]
+        return partitions
+
+    def _read_partition(self, partition: Path, columns):
+        """
+        Memory-map the time and the given columns of a partition.
+        Once mapped, the arrays stay valid when the files are replaced by a write.
+        """
+        time = np.load(partition / "time.npy", mmap_mode="r")
+        return time, {column: np.load(partition / (column + ".npy"), mmap_mode="r")
+                      for column in columns}
+
+    def _write_partition(self, partition: Path, time: np.ndarray, measures: dict):
+        """
+        Write the time and measure columns of a partition.
+        Each file is written next to the old one and then replaces it.
+        """
+        partition.mkdir(parents=True, exist_ok=True)
+        for column, values in [("time", time)] + list(measures.items()):
+            tmp_file = partition / (column + ".tmp.npy")
+            np.save(tmp_file, np.ascontiguousarray(values))
+            os.replace(tmp_file, partition / (column + ".npy"))
+
+    def insert_single_record(self, location: Location, time,
+                             precipitation_probability, precipitation, wind_speed_10m):
+        """
+        Insert a single record into the store.
+        """
+        self.insert_records(location, {
+            "time": [time],
+            "precipitation_probability": [precipitation_probability],
+            "precipitation": [precipitation],
+            "wind_speed_10m": [wind_speed_10m]})
+
+    def insert_records(self, location: Location, data, fetched_at: datetime.datetime = None):
+        """
+        Insert the records of a forecast for a location, merging them
+        into the monthly partitions by the on_conflict policy.
+        data is a dataframe (or a dict of equal length arrays) with the columns
+        time, precipitation_probability, precipitation and wind_speed_10m.
+        If fetched_at is given, it is saved as the time of the last download.
+        Returns the number of records in data after removing duplicates.
+        """
+        time, measures = frame_to_columns(data)
+        minutes = (time - EPOCH).astype(np.int64)
+        months = time.astype("datetime64[M]")
+        location_dir = self._get_location_dir(location)
+        try:
+            with self._lock:
+                for month in np.unique(months):
+                    selected = months == month
+                    partition = location_dir / str(month)
+                    new_time = minutes[selected]
+                    new_measures = {measure: values[selected] for measure, values in measures.items()}
+                    if partition.exists():
+                        new_time, new_measures = self._merge(
+                            *self._read_partition(partition, MEASURES), new_time, new_measures)
+                    else:
+                        order = np.argsort(new_time, kind="stable")
+                        new_time = new_time[order]
+                        new_measures = {measure: values[order] for measure, values in new_measures.items()}
+                    self._write_partition(partition, new_time, new_measures)
+                if fetched_at is not None:
+                    self._set_last_fetched(location, fetched_at)
+        except OSError as err:
+            raise DatabaseError("Error in insert_records() from columnar store.", err)
+        return len(time)
+
+    def insert_many(self, forecasts, fetched_at: datetime.datetime = None):
+        """
+        Insert the records of the forecasts of many locations.
+        forecasts is an iterable of (location, data), with data as for insert_records().
+        If fetched_at is given, it is saved as the time of the last download
+        for each of the locations, with one write of the fetch state.
+        Returns the number of records inserted.
+        """
+        n_records = 0
+        locations = []
+        for location, data in forecasts:
+            n_records += self.insert_records(location, data)
+            locations.append(location)
+        if fetched_at is not None and locations:
+            try:
+                with self._lock:
+                    self._set_last_fetched(locations, fetched_at)
+            except OSError as err:
+                raise DatabaseError("Error in insert_many() from columnar store.", err)
+        return n_records
+
+    def _merge(self, old_time, old_measures, new_time, new_measures):
+        """
+        Merge new records into stored records, sorted by time.
+        For a time in both, the new record is kept with the "update" policy,
+        and the stored record with the "ignore" policy.
+        """
+        if self._update:
+            parts = [(old_time, old_measures), (new_time, new_measures)]
+        else:
+            parts = [(new_time, new_measures), (old_time, old_measures)]
+        time = np.concatenate([part[0] for part in parts])
+        # np.unique() keeps the first occurrence, so search the reversed times
+        # to keep the last one, which is the preferred record.
+        unique_time, reversed_index = np.unique(time[::-1], return_index=True)
+        index = len(time) - 1 - reversed_index
+        measures = {measure: np.concatenate([part[1][measure] for part in parts])[index]
+                    for measure in MEASURES}
+        return unique_time, measures
+
+    def _read_fetch_state(self) -> dict:
+        """
+        Read the times of the last downloads, keyed by location directory name.
+        """
+        try:
+            with open(self._path / FETCH_STATE_FILE) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _set_last_fetched(self, locations, fetched_at: datetime.datetime):
+        """
+        Save the time of the last download for a location, or a list of locations.
+        """
+        if isinstance(locations, Location):
+            locations = [locations]
+        state = self._read_fetch_state()
+        for location in locations:
+            state[self._get_location_dir(location).name] = fetched_at.isoformat(timespec="seconds")
+        tmp_file = self._path / (FETCH_STATE_FILE + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self._path / FETCH_STATE_FILE)
+
+    def get_last_fetched(self, location: Location):
+        """
+        Get the time (UTC) of the last download for a location,
+        or None if data for the location was never downloaded.
+        """
+        with self._lock:
+            last_fetched = self._read_fetch_state().get(self._get_location_dir(location).name)
+        if last_fetched is None:
+            return None
+        return datetime.datetime.fromisoformat(last_fetched)
+
+    def get_location_record(self, location: Location):
+        """
+        Get the three weather records for all times for a given location from the store.
+        """
+        return self.query(location)
+
+    def query(self, locations, start=None, end=None, columns=None):
+        """
+        Get the weather records for a location, or a list of locations,
+        for the times from start (included) to end (excluded), from the store.
+        start and end are datetimes or isoformat strings, and None means no limit.
+        columns is a list of the measures to get, by default all of them.
+        For a location, the dataframe has a time index and a column for each measure.
+        For a list of locations, it also has the longitude and latitude columns.
+        """
+        columns = self._get_columns(columns)
+        if isinstance(locations, Location):
+            return self._query_location(locations, start, end, columns)
+        dfs = []
+        for location in locations:
+            df = self._query_location(location, start, end, columns)
+            df.insert(0, "longitude", float(location.get_longitude()))
+            df.insert(1, "latitude", float(location.get_latitude()))
+            dfs.append(df)
+        if not dfs:
+            return self._get_df(np.empty(0, dtype=np.int64),
+                                {column: np.empty(0) for column in ["longitude", "latitude"] + columns})
+        return pd.concat(dfs)
+
+    def _query_location(self, location: Location, start, end, columns):
+        """
+        Get the given columns for a location and time range from the store.
+        """
+        return self._get_df(*self._read_range(location, start, end, columns))
+
+    def _read_range(self, location: Location, start, end, columns):
+        """
+        Read the given columns for a location and time range from the store.
+        Returns the minutes and a dict of the column arrays.
+        """
+        start_minute = None if start is None else int((np.datetime64(start, "m") - EPOCH).astype(np.int64))
+        end_minute = None if end is None else int((np.datetime64(end, "m") - EPOCH).astype(np.int64))
+        times = []
+        values = {column: [] for column in columns}
+        for partition in self._get_partitions(location, start, end):
+            with self._lock:
+                time, measures = self._read_partition(partition, columns)
+            # the time is sorted, so the range is a slice of the memory-mapped columns
+            first = 0 if start_minute is None else np.searchsorted(time, start_minute, "left")
+            last = len(time) if end_minute is None else np.searchsorted(time, end_minute, "left")
+            times.append(time[first:last])
+            for column in columns:
+                values[column].append(measures[column][first:last])
+        if not times:
+            return np.empty(0, dtype=np.int64), {column: np.empty(0) for column in columns}
+        return np.concatenate(times), {column: np.concatenate(values[column]) for column in columns}
+
+    def query_decimated(self, location: Location, buckets: int, start=None, end=None, columns=None):
+        """
+        Get the records of a location like query(), decimated for a plot of about
+        buckets pixels wide, like WeatherDatabase.query_decimated(). The columns are
+        read memory-mapped and reduced per bucket without a dataframe of all records.
+        """
+        columns = self._get_columns(columns)
+        minutes, values = self._read_range(location, start, end, columns)
+        if len(minutes) == 0:
+            return self._get_df(minutes, values)
+        first_minute = int(minutes[0])
+        envelope = bucket_envelope(minutes, values, first_minute,
+                                   get_bucket_minutes(first_minute, int(minutes[-1]), buckets))
+        return self._get_df(*interleave_envelope(*envelope))
+
+    def _get_df(self, minutes: np.ndarray, data: dict) -> pd.DataFrame:
+        """
+        Get the dataframe with a time index from epoch minutes and the columns.
+        """
+        index = pd.DatetimeIndex((minutes + EPOCH).astype("datetime64[s]"), name="time")
+        return pd.DataFrame(data, index=index)
+
+    def _get_columns(self, columns):
+        """
+        Get the list of measures to query, checking that they are valid column names.
+        """
+        if columns is None:
+            return list(MEASURES)
+        if isinstance(columns, str):
+            columns = [columns]
+        for column in columns:
+            if column not in MEASURES:
+                raise DatabaseError("Unknown column in query().", column)
+        return list(columns)
+
+    def find_nearest(self, location: Location, max_distance: float):
+        """
+        Get the stored location nearest to location, if it is within max_distance km, else None.
+        """
+        return self._get_location_index().find_nearest(location, max_distance)
+
+    def nearest_locations(self, locations, n: int, max_distance: float = None):
+        """
+        Get the n stored locations nearest to each of a list of locations, within
+        max_distance km if given, as a dataframe with a row for each neighbor
+        (see spatial_index.LocationIndex.nearest_locations()).
+        """
+        return self._get_location_index().nearest_locations(locations, n, max_distance)
+
+    def _get_location_index(self) -> LocationIndex:
+        """
+        Get the spatial index of the stored locations. It is made again when a location
+        directory was added or deleted, also by another process: the locations are
+        listed again when the modification time of the store directory changed.
+        """
+        with self._lock:
+            try:
+                modified = self._path.stat().st_mtime_ns
+                if self._location_index is not None and self._location_index[0] == modified:
+                    return self._location_index[2]
+                locations = self._get_locations()
+                coordinates = [(location.get_longitude(), location.get_latitude()) for location in locations]
+            except OSError as err:
+                raise DatabaseError("Error in reading the locations of columnar store.", err)
+            # the file of the last downloads also changes the modification time
+            if self._location_index is not None and self._location_index[1] == coordinates:
+                location_index = self._location_index[2]
+            else:
+                location_index = LocationIndex(locations)
+            self._location_index = (modified, coordinates, location_index)
+            return location_index
+
+    def get_all_data(self):
+        """
+        Get all records from the store.
+        The dataframe has a time index, and the longitude, latitude and measures columns.
+        """
+        return self.query(self._get_locations())
+
+    def iter_chunks(self, chunk_rows: int = 100000, columns=None):
+        """
+        Iterate over all records from the store, in dataframes of up to chunk_rows records,
+        like get_all_data(). Only one chunk of a memory-mapped partition is in memory at a time.
+        """
+        columns = self._get_columns(columns)
+        for location in self._get_locations():
+            with self._lock:
+                partitions = self._get_partitions(location)
+            for partition in partitions:
+                with self._lock:
+                    time, measures = self._read_partition(partition, columns)
+                for first in range(0, len(time), chunk_rows):
+                    chunk_time = np.array(time[first:first + chunk_rows])
+                    data = {"longitude": np.full(len(chunk_time), float(location.get_longitude())),
+                            "latitude": np.full(len(chunk_time), float(location.get_latitude()))}
+                    for column in columns:
+                        data[column] = np.array(measures[column][first:first + chunk_rows])
+                    yield self._get_df(chunk_time, data)
+
+    def reset(self):
+        """
+        Reset the store by deleting all records and the times of the last downloads.
+        """
+        try:
+            with self._lock:
+                for path in self._path.iterdir():
+                    if path.is_dir():
+                        shutil.rmtree(path)
+                    else:
+                        path.unlink()
+                self._location_index = None
+        except OSError as err:
+            raise DatabaseError("Error in deleting all records of columnar store.", err)
+        else:
+            logger.info("Reset columnar store: delete all records.")
+
+    def drop(self):
+        """
+        Drop the store by deleting its directory.
+        """
+        try:
+            with self._lock:
+                shutil.rmtree(self._path, ignore_errors=True)
+                self._location_index = None
+                self._path.mkdir(parents=True, exist_ok=True)
+        except OSError as err:
+            raise DatabaseError("Error in dropping columnar store.", err)
+        else:
+            logger.info("Columnar store is dropped.")
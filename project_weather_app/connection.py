@@ -0,0 +1,88 @@
+"""
+The ConnectionPool object manages the sqlite3 connections to a database file,
+one connection per thread, tuned with pragmas.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+# default pragmas of the connections:
+# in WAL mode readers run concurrently with a single writer,
+# and synchronous NORMAL is safe in WAL mode (a commit may only be lost on power failure).
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,      # milliseconds to wait for a lock before "database is locked"
+    "cache_size": -65536,      # negative: KiB of page cache per connection (64 MiB)
+    "mmap_size": 268435456,    # bytes of the database file to memory map (256 MiB)
+}
+
+class ConnectionPool():
+    def __init__(self, filepath, pragmas: dict = None):
+        """
+        Create the pool of connections to the database file.
+        pragmas overrides the values of DEFAULT_PRAGMAS.
+        """
+        self._filepath = filepath
+        self._pragmas = dict(DEFAULT_PRAGMAS)
+        self._pragmas.update(pragmas or {})
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        # writes are serialized in this process, so writers queue here
+        # instead of waiting on the database lock.
+        self._write_lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection with the pragmas.
+        """
+        # the connection is only used by one thread, but may be closed by another.
+        conn = sqlite3.connect(self._filepath, check_same_thread=False)
+        for name, value in self._pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        """
+        Get the connection of the current thread.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.cursor = conn.cursor()
+        return conn
+
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        Get the shared cursor of the current thread.
+        """
+        self.get()
+        return self._local.cursor
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a write transaction on the connection of the current thread,
+        one writer at a time. Commits on success and rolls back on an exception.
+        """
+        conn = self.get()
+        with self._write_lock:
+            with conn:
+                yield conn
+
+    def close(self):
+        """
+        Close all connections of the pool.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
@@ -6,6 +6,7 @@ processes the data.
 from data_service import IDataService
 from location import Location
 from visualization_handler import IVisualizationHandler
+import metrics
 
 import logging
 logger = logging.getLogger(__name__)
@@ -15,32 +16,60 @@ class DataHandler():
     Given the data_service, get the data, and process it.
     """
     def __init__(self, data_service: IDataService, 
-                 visualization_handler: IVisualizationHandler):
+                 visualization_handler: IVisualizationHandler,
+                 query_buckets: int = None):
+        """
+        With query_buckets, the data is decimated by the database query
+        for a plot of about query_buckets pixels wide.
+        """
         self.data_service = data_service
         self.visualization_handler = visualization_handler
+        self.query_buckets = query_buckets
 
     def execute(self, location: Location):
         """
         Execute the data handler process for a given location
         Get data from data service if data for the specified location 
-        is not available in the database.
+        is not available in the database, or if it is out of date.
+        A stored location within the snap distance is used instead of the given location.
         """
-        self.data = self.data_service.get_data_from_db(location) 
+        resolved = self.data_service.resolve_location(location)
+        if ((resolved.get_longitude(), resolved.get_latitude())
+                != (location.get_longitude(), location.get_latitude())):
+            logger.info("Using stored location " + str((resolved.get_longitude(), resolved.get_latitude()))
+                        + " for " + str((location.get_longitude(), location.get_latitude())))
+            location = resolved
+        self.data = self.data_service.get_data_from_db(location, self.query_buckets)
 
-        if self.data.empty:
-            logger.info("Data is not in database. Downloading data...")
+        if self.data.empty or self.data_service.is_stale(location):
+            if self.data.empty:
+                logger.info("Data is not in database. Downloading data...")
+            else:
+                logger.info("Data in database is out of date. Refreshing data...")
             self.data_service.download_data(location)
             self.data_service.print_status()
-            self.data = self.data_service.get_data_from_db(location)
+            self.data = self.data_service.get_data_from_db(location, self.query_buckets)
         else: 
             logger.info("Using data in database.")
         
         # Print data to console
         self.print_data()
 
-        # Use the visualizer.
-        self.visualization_handler.visualize_data(self.data)
+        # Use the visualizer, unless there is none (--no-plot).
+        if self.visualization_handler is not None:
+            with metrics.timer("plot"):
+                self.visualization_handler.visualize_data(self.data)
     
+    def refresh(self, location: Location, force: bool = False) -> bool:
+        """
+        Download the data for a location if it was never downloaded or it is
+        out of date, or always with force, without getting or plotting it.
+        Returns whether the data was downloaded.
+        """
+        if not force and not self.data_service.is_stale(location):
+            return False
+        return bool(self.data_service.download_data(location))
+
     def print_data(self):
         """
         Print the data in the data handler.
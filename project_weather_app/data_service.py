@@ -5,139 +5,552 @@ from abc import ABC, abstractmethod
 import numpy as np
 import pandas as pd
 import datetime
-import requests
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
 
 from location import Location
-from database import WeatherDatabase
+from database import IWeatherStorage
+from decode import hourly_to_frame
+from cache import ForecastCache
+from single_flight import SingleFlight
+from write_behind import WriteBehindQueue
+from mock_data import MockWeatherGenerator
+from spatial_index import SpatialIndex
 import exception as e
 import read_config as rc
+import metrics
 
 import logging
 logger = logging.getLogger(__name__)
 
+# locations of mocked data generated and inserted in one transaction
+MOCK_CHUNK_LOCATIONS = 1000
+
+# new locations within the snap distance of a location that resolve_locations() merges into it
+SNAP_NEIGHBORS = 16
+
 # interface for DataService
 class IDataService(ABC):
     @abstractmethod
-    def __init__(self, data_source: str, database: WeatherDatabase):
-        pass
+    def __init__(self, data_source: str, database: IWeatherStorage):
+        """
+        Keep the database, and the snap distance of resolve_location() from the config file.
+        """
+        self._database = database
+        self._snap_distance = rc.get_database_config(data_source)["snap_distance"]
 
     @abstractmethod
     def download_data(self, location: Location):
         pass
+
+    async def download_data_async(self, location: Location):
+        """
+        Download data for a location from a coroutine, without blocking the event loop.
+        """
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self.download_data, location)
     
+    def download_many(self, locations: List[Location]):
+        """
+        Download data for each of the locations.
+        """
+        for location in locations:
+            self.download_data(location)
+
     @abstractmethod
-    def get_data_from_db(self, location: Location):
+    def get_data_from_db(self, location: Location, buckets: int = None):
+        pass
+
+    def resolve_location(self, location: Location) -> Location:
+        """
+        Get the stored location nearest to location if it is within the snap distance
+        of the config file, so its data is reused, else location itself.
+        """
+        if self._snap_distance > 0:
+            nearest = self._database.find_nearest(location, self._snap_distance)
+            if nearest is not None:
+                return nearest
+        return location
+
+    def resolve_locations(self, locations: List[Location]) -> List[Location]:
+        """
+        Get the resolved location of each of many locations, like resolve_location(),
+        so nearby locations are downloaded once: the stored location within the snap
+        distance, else the first of the new locations that is within the snap distance
+        (the location itself, or an earlier one in the list).
+        The same location object is returned for locations that resolve to the same location.
+        """
+        locations = list(locations)
+        if self._snap_distance <= 0 or not locations:
+            return locations
+        resolved = [None] * len(locations)
+        stored = {}
+        nearest = self._database.nearest_locations(locations, 1, self._snap_distance)
+        for query, longitude, latitude in zip(nearest["query"], nearest["longitude"], nearest["latitude"]):
+            key = (float(longitude), float(latitude))
+            if key not in stored:
+                stored[key] = Location(*key)
+            resolved[query] = stored[key]
+        new = [i for i, location in enumerate(resolved) if location is None]
+        if new:
+            longitudes = [locations[i].get_longitude() for i in new]
+            latitudes = [locations[i].get_latitude() for i in new]
+            neighbors, _ = SpatialIndex(np.arange(len(new)), longitudes, latitudes).nearest_n(
+                longitudes, latitudes, SNAP_NEIGHBORS, self._snap_distance)
+            # in the order of the list, a new location that is not merged yet
+            # is kept, and the new locations near it are merged into it
+            for row, i in enumerate(new):
+                if resolved[i] is not None:
+                    continue
+                resolved[i] = locations[i]
+                for neighbor in neighbors[row]:
+                    if neighbor >= 0 and resolved[new[neighbor]] is None:
+                        resolved[new[neighbor]] = locations[i]
+        return resolved
+
+    @abstractmethod
+    def is_stale(self, location: Location) -> bool:
         pass
     
     @abstractmethod
     def print_status(self):
         pass
 
+    def close(self):
+        """
+        Finish the pending writes and release the resources of the data service.
+        """
+        pass
+
 class DataServiceFromAPI(IDataService):
-    def __init__(self, data_source: str, database: WeatherDatabase):
+    def __init__(self, data_source: str, database: IWeatherStorage):
         """
         Create the data service for accessing weather data API.
         """
+        # the http modules load requests, which only the API mode needs
+        from http_client import HttpClient
+        from http_cache import HttpCache
+        super().__init__(data_source, database)
         self._url, self._payload = rc.get_config(data_source)
-        self._database = database
+        fetch_config = rc.get_fetch_config(data_source)
+        self._batch_size = max(1, fetch_config["batch_size"])
+        self._max_workers = fetch_config["max_workers"]
+        self._refresh_interval = datetime.timedelta(seconds=fetch_config["refresh_interval"])
+        self._forecast_days = fetch_config["forecast_days"]
+        http_cache_config = rc.get_http_cache_config(data_source)
+        self._http_cache = None
+        if http_cache_config.pop("enabled"):
+            self._http_cache = HttpCache(http_cache_config.pop("file"), **http_cache_config)
+        self._client = HttpClient(max_workers=fetch_config["max_workers"],
+                                  requests_per_second=fetch_config["requests_per_second"],
+                                  retries=fetch_config["retries"],
+                                  backoff_factor=fetch_config["backoff_factor"],
+                                  timeout=fetch_config["timeout"],
+                                  cache=self._http_cache)
+        write_behind_config = rc.get_write_behind_config(data_source)
+        self._writer = None
+        if write_behind_config.pop("enabled"):
+            self._writer = WriteBehindQueue(database, **write_behind_config)
 
     def download_data(self, location: Location):
         """
         Download data from online weather API.
+        If data for the location was downloaded before, only the hours since
+        that download are requested, and only changed records are written.
+        With the write-behind queue, the records are committed together with
+        the downloads of other threads; the call returns when they are committed.
+        Returns whether the data was downloaded.
         """
-        self._location = location
-        self._payload["longitude"] = location.get_longitude()
-        self._payload["latitude"] = location.get_latitude()
+        # the location is not kept in the object, so downloads can run in several threads
+        fetched_at = utc_now()
         try:
-            r = requests.get(self._url, params=self._payload)
+            params = self._get_params([location], [self._database.get_last_fetched(location)])
+            with metrics.timer("fetch"):
+                r = self._client.get(self._url, params=params)
         except Exception as err:
             logger.critical("Error: Cannot get data with API.")
             logger.critical("Exception: " + str(err))
+            self.status_code = "error"
+            return False
         else:
             if r.status_code != 200:
                 logging.critical("Critical error: api code: " + str(r.status_code))
                 raise e.DataServiceError("Critical exception error.")
-            data = r.json().get("hourly", {})
-            df = pd.DataFrame(data)
-            for index, row in df.iterrows():
-                self._database.insert_single_record(self._location, row["time"],
-                                             row["precipitation_probability"],
-                                             row["precipitation"],
-                                             row["wind_speed_10m"])
-        # in either case, save the status_code from "try" section
-        self.status_code = r.status_code
-
-    def get_data_from_db(self, location: Location):
+            count_downloaded(r)
+            with metrics.timer("decode"):
+                df = hourly_to_frame(r.json().get("hourly", {}))
+            if self._writer is None:
+                self._database.insert_records(location, df, fetched_at=fetched_at)
+            else:
+                self._writer.put(location, df, fetched_at).result()
+            self.status_code = r.status_code
+            return True
+
+    def download_many(self, locations: List[Location]):
+        """
+        Download data for many locations from online weather API.
+        Each request asks for up to batch_size locations, up to max_workers requests
+        run concurrently, and the data of each location is written to the database
+        as soon as its response arrives: by the download threads to the write-behind
+        queue, which commits the data of many locations at once, or else by this thread.
+        Locations that cannot be downloaded are logged and skipped.
+        Returns the number of locations written to the database.
+        """
+        # only stale locations are downloaded, and locations downloaded at about
+        # the same time are batched together, since they request the same hours.
+        last_fetched = {}
+        for location in locations:
+            if self.is_stale(location):
+                last_fetched[location] = self._database.get_last_fetched(location)
+        stale = sorted(last_fetched, key=lambda location: (last_fetched[location] is not None,
+                                                           last_fetched[location] or 0))
+        batches = [stale[i:i + self._batch_size]
+                   for i in range(0, len(stale), self._batch_size)]
+        n_written = 0
+        fetched_at = utc_now()
+        writes = []
+        if self._writer is None:
+            fetch = self._fetch
+        else:
+            fetch = functools.partial(self._fetch_and_queue, fetched_at=fetched_at)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            # the database is only used from this thread and the writer thread,
+            # also to get the request parameters.
+            futures = {executor.submit(fetch, batch,
+                                       self._get_params(batch, [last_fetched[location] for location in batch])): batch
+                       for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    dfs = future.result()
+                except Exception as err:
+                    logger.error("Cannot get data with API for " + str(len(batch)) + " locations from: "
+                                 + str((batch[0].get_longitude(), batch[0].get_latitude())))
+                    logger.error("Exception: " + str(err))
+                    continue
+                if self._writer is not None:
+                    # the data is queued, and counted when it is committed
+                    writes.extend(dfs)
+                    continue
+                for location, df in zip(batch, dfs):
+                    self._database.insert_records(location, df, fetched_at=fetched_at)
+                n_written += len(batch)
+        for write in writes:
+            try:
+                write.result()
+            except e.RECOVERABLE_ERRORS:
+                # logged by the writer
+                continue
+            n_written += 1
+        logger.info("Downloaded data for " + str(n_written) + " of "
+                    + str(len(stale)) + " stale locations in "
+                    + str(len(batches)) + " requests. "
+                    + str(len(locations) - len(stale)) + " locations are up to date.")
+        self.status_code = str(n_written) + "/" + str(len(stale))
+        return n_written
+
+    def _fetch(self, locations: List[Location], params: dict) -> List[pd.DataFrame]:
+        """
+        Get the hourly data for a batch of locations from online weather API,
+        with one request. Returns a dataframe for each location, in order.
+        """
+        with metrics.timer("fetch"):
+            r = self._client.get(self._url, params=params)
+        r.raise_for_status()
+        count_downloaded(r)
+        with metrics.timer("decode"):
+            return [hourly_to_frame(hourly) for hourly in split_response(r.json(), len(locations))]
+
+    def _fetch_and_queue(self, locations: List[Location], params: dict, fetched_at: datetime.datetime):
+        """
+        Get the hourly data for a batch of locations like _fetch(), and put the data
+        of each location on the write-behind queue, which blocks while it is full.
+        Returns the futures of the writes.
+        """
+        return [self._writer.put(location, df, fetched_at)
+                for location, df in zip(locations, self._fetch(locations, params))]
+
+    def _get_params(self, locations: List[Location], last_fetched: list) -> dict:
+        """
+        Get the request parameters of the API for a list of locations,
+        given the time each location was last downloaded (or None).
+        The coordinates of several locations are sent as comma separated lists.
+        If all locations were downloaded before, only the hours from the
+        earliest of their downloads to the end of the forecast are requested.
+        """
+        params = dict(self._payload)
+        params["longitude"] = ",".join(str(location.get_longitude()) for location in locations)
+        params["latitude"] = ",".join(str(location.get_latitude()) for location in locations)
+        if None in last_fetched:
+            params["forecast_days"] = self._forecast_days
+        else:
+            # the forecast for the hours since the last download may have changed.
+            start = min(last_fetched).replace(minute=0, second=0, microsecond=0)
+            end = datetime.datetime.combine(utc_now().date(), datetime.time(23)) \
+                + datetime.timedelta(days=self._forecast_days - 1)
+            params["start_hour"] = start.isoformat(timespec="minutes")
+            params["end_hour"] = end.isoformat(timespec="minutes")
+        return params
+
+    def get_data_from_db(self, location: Location, buckets: int = None):
         """
         Get weather data for a given location from the database.
+        With buckets, the data is decimated by the database for a plot
+        of about buckets pixels wide (see IWeatherStorage.query_decimated()).
         """
+        if buckets:
+            return self._database.query_decimated(location, buckets)
         return self._database.get_location_record(location)
 
+    def is_stale(self, location: Location) -> bool:
+        """
+        The data for a location is stale if it was never downloaded,
+        or if it was downloaded more than refresh_interval ago.
+        """
+        last_fetched = self._database.get_last_fetched(location)
+        return last_fetched is None or utc_now() - last_fetched > self._refresh_interval
+
     def print_status(self):
         """
-        Print the status code from API access.
+        Print the status code from API access, and the hit rate of the http cache.
         """
         logger.info("API status code: " + str(self.status_code))
+        if self._http_cache is not None:
+            logger.info(self._http_cache.get_status())
+        if self._writer is not None:
+            logger.info(self._writer.get_status())
+
+    def close(self):
+        """
+        Write the data in the write-behind queue, and close the http client.
+        """
+        if self._writer is not None:
+            self._writer.close()
+        self._client.close()
+
+def utc_now() -> datetime.datetime:
+    """
+    Get the current UTC time without time zone, the time zone of the API data.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def count_downloaded(r):
+    """
+    Count the bytes of a response that came over the network,
+    not from the http cache (a hit, or a 304 answer that reuses the stored body).
+    """
+    if not getattr(r, "from_cache", False):
+        metrics.count("bytes_downloaded", len(r.content))
+
+def split_response(content, n_locations: int) -> List[dict]:
+    """
+    Split the json content of an API response for n_locations locations
+    into the "hourly" data of each location, in the order of the request.
+    The API answers with an object for one location, and a list of objects for several.
+    """
+    if isinstance(content, dict):
+        content = [content]
+    if len(content) != n_locations:
+        raise ValueError("API response has " + str(len(content))
+                         + " locations, expected " + str(n_locations) + ".")
+    if all("location_id" in item for item in content):
+        content = sorted(content, key=lambda item: item["location_id"])
+    return [item.get("hourly", {}) for item in content]
 
 # Mocked data service
 class DataServiceMocked(IDataService):
-    def __init__(self, data_source: str, database: WeatherDatabase):
+    def __init__(self, data_source: str, database: IWeatherStorage,
+                 seed: int = 0, hours: int = 168):
         """
         Create data service for a mocked data set.
+        The data of hours hours (by default 24 hours * 7 days) is generated
+        by a MockWeatherGenerator with the seed.
         """
         super().__init__(data_source, database)
         self.status_code = "init"
-        self._database = database
+        self._generator = MockWeatherGenerator(seed=seed, hours=hours)
 
     def download_data(self, location: Location):
         """
-        Generate n data points for a mocked data service 
-        where data is randomly generated as normal distribution 
-        with mean mu and standard deviation sd.
-        """
-        n: int = 168 # 24 hours * 7 days = 168 hours
-        mu: float = 65
-        sd: float = 5
-        now = datetime.datetime.now()
-        time_delta = datetime.timedelta(hours=n)
-        t = now - time_delta
-        self.time_list = [(t+datetime.timedelta(hours=i)).isoformat(timespec="minutes") for i in range(n) ]
-        self.precipitation_probability_list = \
-            [round(np.random.randn()*sd, 1) + mu for _ in range(n)]
-        self.precipitation_list = [round(np.random.randn()*sd, 1) + mu for _ in range(n)]    
-        self.wind_speed_10m_list = [round(np.random.randn()*sd, 1) + mu for _ in range(n)]    
-        for time, precip_prob, precip, wind in zip(
-                                    self.time_list, 
-                                    self.precipitation_probability_list,
-                                    self.precipitation_list,
-                                    self.wind_speed_10m_list):
-            self._database.insert_single_record(location, time, precip_prob, precip, wind)
+        Generate the data for a location and store it in the database.
+        """
+        self._database.insert_many(self._generator.iter_forecasts([location]),
+                                   fetched_at=utc_now())
         self.status_code = "OK"
+        return True
+
+    def download_many(self, locations: List[Location]):
+        """
+        Generate the data for the locations that were not generated before,
+        and bulk load it into the database, one transaction per chunk of locations.
+        Returns the number of locations written to the database.
+        """
+        stale = [location for location in locations if self.is_stale(location)]
+        start = time.perf_counter()
+        n_records = 0
+        fetched_at = utc_now()
+        for first in range(0, len(stale), MOCK_CHUNK_LOCATIONS):
+            chunk = stale[first:first + MOCK_CHUNK_LOCATIONS]
+            n_records += self._database.insert_many(
+                self._generator.iter_forecasts(chunk, chunk_locations=MOCK_CHUNK_LOCATIONS),
+                fetched_at=fetched_at)
+        elapsed = time.perf_counter() - start
+        logger.info("Generated " + str(n_records) + " records for " + str(len(stale)) +
+                    " locations in " + format(elapsed, ".2f") + " s (" +
+                    format(n_records / max(elapsed, 1e-9), ".0f") + " records/s). " +
+                    str(len(locations) - len(stale)) + " locations were generated before.")
+        self.status_code = str(len(stale)) + "/" + str(len(stale))
+        return len(stale)
 
-    def get_data_from_db(self, location: Location):
+    def get_data_from_db(self, location: Location, buckets: int = None):
+        if buckets:
+            return self._database.query_decimated(location, buckets)
         return self._database.get_location_record(location)
+
+    def is_stale(self, location: Location) -> bool:
+        """
+        Mocked data is generated once for a location, and never gets stale.
+        """
+        return self._database.get_last_fetched(location) is None
     
     def print_status(self):
         logger.info("Mocked service status code: " + str(self.status_code))
 
 
+# Data service with a read-through cache
+class CachedDataService(IDataService):
+    def __init__(self, data_service: IDataService, cache: ForecastCache):
+        """
+        Create a data service that serves get_data_from_db() from the cache
+        in front of another data service. Downloads invalidate the cache.
+        """
+        self._data_service = data_service
+        self._cache = cache
+
+    def download_data(self, location: Location):
+        result = self._data_service.download_data(location)
+        self._cache.invalidate(location)
+        return result
+
+    async def download_data_async(self, location: Location):
+        result = await self._data_service.download_data_async(location)
+        self._cache.invalidate(location)
+        return result
+
+    def download_many(self, locations: List[Location]):
+        result = self._data_service.download_many(locations)
+        for location in locations:
+            self._cache.invalidate(location)
+        return result
+
+    def get_data_from_db(self, location: Location, buckets: int = None):
+        if buckets:
+            # decimated data is small and cheap to query, and is not cached
+            return self._data_service.get_data_from_db(location, buckets)
+        df = self._cache.get(location)
+        if df is None:
+            df = self._data_service.get_data_from_db(location)
+            self._cache.put(location, df)
+        return df
+
+    def resolve_location(self, location: Location) -> Location:
+        return self._data_service.resolve_location(location)
+
+    def resolve_locations(self, locations: List[Location]) -> List[Location]:
+        return self._data_service.resolve_locations(locations)
+
+    def is_stale(self, location: Location) -> bool:
+        return self._data_service.is_stale(location)
+
+    def print_status(self):
+        self._data_service.print_status()
+        logger.info("Cache: " + str(self._cache.get_stats()))
+
+    def close(self):
+        self._data_service.close()
+
+
+# Data service that coalesces concurrent downloads of the same location
+class SingleFlightDataService(IDataService):
+    def __init__(self, data_service: IDataService, timeout: float = None):
+        """
+        Create a data service in front of another data service, that runs one download
+        per location at a time: a caller that asks for a location that is being downloaded
+        waits up to timeout seconds for that download instead of starting another one.
+        """
+        self._data_service = data_service
+        self._single_flight = SingleFlight(timeout=timeout)
+
+    @staticmethod
+    def _get_key(location: Location):
+        return ("download", float(location.get_longitude()), float(location.get_latitude()))
+
+    def download_data(self, location: Location):
+        return self._single_flight.do(self._get_key(location), self._data_service.download_data, location)
+
+    async def download_data_async(self, location: Location):
+        """
+        Like download_data(), for coroutines: the download runs in the default executor
+        of the event loop, and is shared with the threads downloading the same location.
+        """
+        return await self._single_flight.do_async(self._get_key(location),
+                                                  self._data_service.download_data, location)
+
+    def download_many(self, locations: List[Location]):
+        return self._data_service.download_many(locations)
+
+    def get_data_from_db(self, location: Location, buckets: int = None):
+        return self._data_service.get_data_from_db(location, buckets)
+
+    def resolve_location(self, location: Location) -> Location:
+        return self._data_service.resolve_location(location)
+
+    def resolve_locations(self, locations: List[Location]) -> List[Location]:
+        return self._data_service.resolve_locations(locations)
+
+    def is_stale(self, location: Location) -> bool:
+        return self._data_service.is_stale(location)
+
+    def print_status(self):
+        self._data_service.print_status()
+        logger.info(self._single_flight.get_status())
+
+    def close(self):
+        self._data_service.close()
+
+
 class DataServiceFactory:
-    def __init__(self, data_source: str, database: WeatherDatabase, mode: str = "API", ):
+    def __init__(self, data_source: str, database: IWeatherStorage, mode: str = "API",
+                 cache: ForecastCache = None, seed: int = 0, mock_hours: int = 168):
         """
         Instantiates the DataService.
         By default, getting the data service via API.
+        Concurrent downloads of the same location are coalesced (see SingleFlightDataService).
+        With a cache, the data service reads through the cache.
+        seed and mock_hours are the settings of the mocked data.
         """    
         self.data_source = data_source
         self.mode = mode.upper()
         self._database = database
+        self._cache = cache
+        self._seed = seed
+        self._mock_hours = mock_hours
     
     def create(self) -> IDataService:
         """
         Create the data service for the mode stored in the object.
         """
         if self.mode == "API":
-            return DataServiceFromAPI(self.data_source, self._database)
+            data_service = DataServiceFromAPI(self.data_source, self._database)
         elif self.mode == "MOCK":
-            return DataServiceMocked(self.data_source, self._database)
+            data_service = DataServiceMocked(self.data_source, self._database,
+                                             seed=self._seed, hours=self._mock_hours)
         else:
             raise e.ModeError("Mode error.", self.mode)
+        data_service = SingleFlightDataService(
+            data_service, timeout=rc.get_fetch_config(self.data_source)["coalesce_timeout"])
+        if self._cache is not None:
+            data_service = CachedDataService(data_service, self._cache)
+        return data_service
@@ -2,25 +2,171 @@
 The WeatherDatabase object manages the low level interaction with the database.
 """
 import sqlite3
+import datetime
+import math
 from location import Location
 from util import get_file_path
 import os.path
-import pandas as pd
 import numpy as np
+import pandas as pd
+from abc import ABC, abstractmethod
 
 from exception import DatabaseError
+from connection import ConnectionPool
+from decode import COLUMNS, MEASURES, frame_to_columns, minutes_to_time, records_to_frame, time_to_minutes
+from decimate import get_bucket_minutes, interleave_envelope
+from spatial_index import LocationIndex
+import metrics
 
 import logging
 logger = logging.getLogger(__name__)
 
-class WeatherDatabase():
-    def __init__(self, db_file: str) -> None:
+# version of the database schema, stored in "PRAGMA user_version"
+SCHEMA_VERSION = 2
+
+# default size of the grid cells of the locations, in degrees (about 11 m).
+# Locations in the same cell are stored as one location.
+GRID_RESOLUTION = 0.0001
+
+# minutes in a day, for the day of a time stored as minutes since the epoch
+DAY_MINUTES = 1440
+
+# policies for inserting a record for a location and time that is already stored:
+# "update" overwrites the stored record with the newer forecast
+# (only records with changed values are written),
+# "ignore" keeps the stored record.
+ON_CONFLICT_POLICIES = {
+    "update": '''
+        ON CONFLICT (location_id, time) DO UPDATE SET
+            precipitation_probability = excluded.precipitation_probability,
+            precipitation = excluded.precipitation,
+            wind_speed_10m = excluded.wind_speed_10m
+        WHERE precipitation_probability IS NOT excluded.precipitation_probability
+            OR precipitation IS NOT excluded.precipitation
+            OR wind_speed_10m IS NOT excluded.wind_speed_10m''',
+    "ignore": '''
+        ON CONFLICT (location_id, time) DO NOTHING''',
+}
+
+# rollups of the hourly records: name -> (SQL expression on the 'weather' table,
+#                                        SQL expression on the 'weather_daily' summary table)
+ROLLUPS = {
+    "precipitation_probability_max": ("MAX(precipitation_probability)",
+                                      "MAX(precipitation_probability_max)"),
+    "precipitation_sum": ("SUM(precipitation)",
+                          "SUM(precipitation_sum)"),
+    "wind_speed_10m_mean": ("AVG(wind_speed_10m)",
+                            "SUM(wind_speed_10m_sum) / SUM(wind_speed_10m_count)"),
+    "wind_speed_10m_max": ("MAX(wind_speed_10m)",
+                           "MAX(wind_speed_10m_max)"),
+}
+
+# periods of the rollups: freq -> SQL expression of the first day of the period for a day
+# (days since the epoch)
+ROLLUP_PERIODS = {
+    "D": "{day}",
+    "W": "(({day} + 3) / 7) * 7 - 3", # weeks start on Monday (the epoch is a Thursday)
+}
+
+# (re)compute the rows of the daily summary table from the 'weather' table
+SUMMARIZE_SQL = '''
+    INSERT OR REPLACE INTO weather_daily
+        SELECT location_id, time / 1440 AS day,
+                MAX(precipitation_probability),
+                SUM(precipitation),
+                SUM(wind_speed_10m),
+                COUNT(wind_speed_10m),
+                MAX(wind_speed_10m)
+            FROM weather {where}
+            GROUP BY location_id, day;
+'''
+
+# interface for the storage of the weather data
+class IWeatherStorage(ABC):
+    @abstractmethod
+    def insert_single_record(self, location: Location, time,
+                             precipitation_probability, precipitation, wind_speed_10m):
+        pass
+
+    @abstractmethod
+    def insert_records(self, location: Location, data, fetched_at: datetime.datetime = None):
+        pass
+
+    @abstractmethod
+    def insert_many(self, forecasts, fetched_at: datetime.datetime = None):
+        pass
+
+    @abstractmethod
+    def get_last_fetched(self, location: Location):
+        pass
+
+    @abstractmethod
+    def get_location_record(self, location: Location):
+        pass
+
+    @abstractmethod
+    def query(self, locations, start=None, end=None, columns=None):
+        pass
+
+    @abstractmethod
+    def query_decimated(self, location: Location, buckets: int, start=None, end=None, columns=None):
+        pass
+
+    @abstractmethod
+    def find_nearest(self, location: Location, max_distance: float):
+        pass
+
+    @abstractmethod
+    def nearest_locations(self, locations, n: int, max_distance: float = None):
+        pass
+
+    @abstractmethod
+    def get_all_data(self):
+        pass
+
+    @abstractmethod
+    def iter_chunks(self, chunk_rows: int = 100000, columns=None):
+        pass
+
+    @abstractmethod
+    def reset(self):
+        pass
+
+    @abstractmethod
+    def drop(self):
+        pass
+
+class WeatherDatabase(IWeatherStorage):
+    def __init__(self, db_file: str, on_conflict: str = "update", summaries: bool = False,
+                 pragmas: dict = None, grid_resolution: float = GRID_RESOLUTION) -> None:
         """
-        Create database for storing weather time temperature
+        Create database for storing weather time temperature.
+        on_conflict is the policy for records that are already stored,
+        "update" or "ignore". (See ON_CONFLICT_POLICIES.)
+        With summaries, the daily summary table for rollup() is created, and
+        it is kept up to date on insert (also when the database is opened later
+        without summaries).
+        Each thread gets its own connection, configured with the sqlite pragmas
+        (see connection.DEFAULT_PRAGMAS), so reads run concurrently with a single writer.
+        Locations are stored in the cells of a grid of grid_resolution degrees;
+        the grid resolution of a database is set when it is created.
         """
+        if on_conflict not in ON_CONFLICT_POLICIES:
+            raise DatabaseError("Unknown on_conflict policy.", on_conflict)
+        self._on_conflict = ON_CONFLICT_POLICIES[on_conflict]
+        if not grid_resolution > 0:
+            raise DatabaseError("The grid resolution must be positive.", grid_resolution)
+        self._grid_resolution = grid_resolution
+        # ids of the committed locations: (longitude key, latitude key) -> id.
+        # The ids stay valid for all connections, since locations are never deleted (see reset()).
+        self._location_ids = {}
+        # spatial index of the stored locations, made when it is needed,
+        # with the (count, max id) of the locations table it was made from
+        self._location_index = None
+
         # get complete path to the file
-        filepath = get_file_path(db_file, calling_file=__file__)        
-        
+        filepath = get_file_path(db_file, calling_file=__file__)
+
         # check if db_file exist
         if not os.path.exists(filepath):
             logger.info("Database not found: " + str(filepath))
@@ -31,74 +177,401 @@ class WeatherDatabase():
         # sqlite3.connect() will create the database if it does not exist.
         logger.info("Connecting to database: " + str(filepath))
         try:
-            self.conn = sqlite3.connect(filepath)
-            self.cursor = self.conn.cursor()
+            self._pool = ConnectionPool(filepath, pragmas)
+            migrated_summaries = self._create_tables()
+            self._summaries = self._create_summary_table(summaries or migrated_summaries)
+        except Exception as err:
+            raise DatabaseError("Error in database initialiation.", err)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        The database connection of the current thread.
+        """
+        return self._pool.get()
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        The database cursor of the current thread.
+        """
+        return self._pool.cursor()
+
+    def _create_tables(self) -> bool:
+        """
+        Create the 'metadata', 'locations', 'weather' and 'fetch_state' tables,
+        and migrate an older schema.
+        Returns whether the migrated database had the daily summary table.
+        """
+        version = self.cursor.execute("PRAGMA user_version;").fetchone()[0]
+        # before schema version 2, the 'weather' table has the longitude
+        # and latitude, and the time as isoformat text, of each record.
+        migrate = version < 2 and self.cursor.execute('''
+            SELECT 1 FROM pragma_table_info('weather') WHERE name = 'longitude';
+        ''').fetchone() is not None
+        had_summaries = False
+        with self._pool.transaction():
+            # one transaction, so a failed migration leaves the database unchanged
+            self.cursor.execute("BEGIN;")
+            if migrate:
+                logger.info("Migrating database to schema version " + str(SCHEMA_VERSION) + ".")
+                had_summaries = self._rename_old_tables()
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS metadata (
+                    key TEXT PRIMARY KEY,
+                    value
+                );
+            ''')
+            # a location is a cell of the grid, identified by its integer coordinates,
+            # with the longitude and latitude of the first location stored in the cell.
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS locations (
+                    id INTEGER PRIMARY KEY,
+                    longitude_key INTEGER NOT NULL,
+                    latitude_key INTEGER NOT NULL,
+                    longitude REAL NOT NULL,
+                    latitude REAL NOT NULL,
+                    UNIQUE (longitude_key, latitude_key)
+                );
+            ''')
+            self.cursor.execute('''
+                CREATE INDEX IF NOT EXISTS locations_coordinates
+                    ON locations (longitude, latitude);
+            ''')
+            # the time is stored as minutes since the epoch (UTC). The primary key
+            # makes location lookups index seeks and lets inserts resolve duplicates
+            # with ON CONFLICT, and without a rowid the records are stored in it.
             self.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS weather (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    longitude REAL,
-                    latitude REAL,
-                    time TEXT,
+                    location_id INTEGER NOT NULL,
+                    time INTEGER NOT NULL,
                     precipitation_probability REAL,
-                    precipitation REAL, 
-                    wind_speed_10m REAL
+                    precipitation REAL,
+                    wind_speed_10m REAL,
+                    PRIMARY KEY (location_id, time)
+                ) WITHOUT ROWID;
+            ''')
+            # the time of the last download for each location, in seconds since the epoch (UTC)
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS fetch_state (
+                    location_id INTEGER PRIMARY KEY,
+                    last_fetched INTEGER
                 );
             ''')
-        except Exception as err:
-            raise DatabaseError("Error in database initialiation.", err)
+            self._check_grid_resolution()
+            if migrate:
+                self._migrate_old_tables()
+            self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        return had_summaries
 
-    def _get_df(self, data):
-        """ 
-        Get the pandas dataframe fro the given data. 
+    def _check_grid_resolution(self):
         """
-        columns = ["time", "precipitation_probability", "precipitation", "wind_speed_10m"]
-        if data == []:
-            # create an empty dataframe with column names
-            df = pd.DataFrame(columns = columns) 
-        else:
-            # create data frame if there is data
-            df = pd.DataFrame(data)
-            df.columns = columns
-        # convert time format from isoformat to np.datetime64
-        df["time"] = df["time"].map(np.datetime64)
-        df.set_index("time", inplace=True) # set time as the dataframe's index column
-        return df
-
-    def insert_single_record(self, location: Location, time, 
+        Save the grid resolution of a new database, or keep the saved one
+        of an existing database.
+        """
+        row = self.cursor.execute('''
+            SELECT value FROM metadata WHERE key = 'grid_resolution';
+        ''').fetchone()
+        if row is None:
+            self.cursor.execute('''
+                INSERT INTO metadata (key, value) VALUES ('grid_resolution', ?);
+            ''', (self._grid_resolution,))
+        elif row[0] != self._grid_resolution:
+            logger.warning("The database has the grid resolution " + str(row[0]) +
+                           ", not " + str(self._grid_resolution) + ". Using " + str(row[0]) + ".")
+            self._grid_resolution = row[0]
+
+    def _rename_old_tables(self) -> bool:
+        """
+        Rename the tables of schema version 0 or 1, to make room for the new tables.
+        Returns whether the daily summary table was renamed.
+        """
+        renamed = []
+        for table in ["weather", "fetch_state", "weather_daily"]:
+            if self._table_exists(table):
+                self.cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_v1;")
+                renamed.append(table)
+        self.cursor.execute("DROP INDEX IF EXISTS weather_location_time;")
+        return "weather_daily" in renamed
+
+    def _migrate_old_tables(self):
+        """
+        Copy the records and the times of the last downloads of schema version 0 or 1
+        to the new tables, and drop the old tables.
+        Of the records for the same location (grid cell) and time, the last inserted is kept.
+        """
+        has_fetch_state = self._table_exists("fetch_state_v1")
+        sql = "SELECT DISTINCT longitude, latitude FROM weather_v1"
+        if has_fetch_state:
+            sql += " UNION SELECT longitude, latitude FROM fetch_state_v1"
+        coordinates = self.cursor.execute(sql + ";").fetchall()
+        # map the old coordinates to the ids of the locations
+        self.cursor.execute('''
+            CREATE TEMP TABLE location_map (
+                longitude REAL,
+                latitude REAL,
+                location_id INTEGER,
+                PRIMARY KEY (longitude, latitude)
+            );
+        ''')
+        self.cursor.executemany('''
+            INSERT INTO location_map (longitude, latitude, location_id) VALUES (?, ?, ?);
+        ''', [(longitude, latitude, self._get_location_id(Location(longitude, latitude), create=True))
+              for longitude, latitude in coordinates])
+        # the records are copied in insert order, so the last one replaces the others
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO weather
+                SELECT m.location_id, CAST(strftime('%s', w.time) AS INTEGER) / 60,
+                        w.precipitation_probability, w.precipitation, w.wind_speed_10m
+                    FROM weather_v1 AS w
+                    JOIN location_map AS m
+                        ON m.longitude = w.longitude AND m.latitude = w.latitude
+                    WHERE strftime('%s', w.time) IS NOT NULL
+                    ORDER BY w.id;
+        ''')
+        if has_fetch_state:
+            self.cursor.execute('''
+                INSERT INTO fetch_state (location_id, last_fetched)
+                    SELECT m.location_id, MAX(CAST(strftime('%s', f.last_fetched) AS INTEGER))
+                        FROM fetch_state_v1 AS f
+                        JOIN location_map AS m
+                            ON m.longitude = f.longitude AND m.latitude = f.latitude
+                        WHERE strftime('%s', f.last_fetched) IS NOT NULL
+                        GROUP BY m.location_id;
+            ''')
+        n_records = self.cursor.execute("SELECT COUNT(*) FROM weather;").fetchone()[0]
+        self.cursor.execute("DROP TABLE location_map;")
+        for table in ["weather_v1", "fetch_state_v1", "weather_daily_v1"]:
+            self.cursor.execute(f"DROP TABLE IF EXISTS {table};")
+        logger.info("Migrated " + str(n_records) + " records of " +
+                    str(len(coordinates)) + " locations.")
+
+    def _table_exists(self, table: str) -> bool:
+        """
+        Check if the database has the table.
+        """
+        return self.cursor.execute('''
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;
+        ''', (table,)).fetchone() is not None
+
+    def _create_summary_table(self, create: bool) -> bool:
+        """
+        Create the 'weather_daily' summary table from the stored records, if create is True
+        and the table does not exist. Returns whether the summary table exists.
+        """
+        exists = self._table_exists("weather_daily")
+        if exists or not create:
+            return exists
+        logger.info("Creating the daily summary table 'weather_daily'.")
+        with self._pool.transaction():
+            # the day is stored as days since the epoch
+            self.cursor.execute('''
+                CREATE TABLE weather_daily (
+                    location_id INTEGER NOT NULL,
+                    day INTEGER NOT NULL,
+                    precipitation_probability_max REAL,
+                    precipitation_sum REAL,
+                    wind_speed_10m_sum REAL,
+                    wind_speed_10m_count INTEGER,
+                    wind_speed_10m_max REAL,
+                    PRIMARY KEY (location_id, day)
+                ) WITHOUT ROWID;
+            ''')
+            self.cursor.execute(SUMMARIZE_SQL.format(where=""))
+        return True
+
+    def _update_summary(self, location_id: int, first_time: int, last_time: int):
+        """
+        Recompute the daily summaries of a location for the days from first_time to last_time
+        (minutes since the epoch). Called in the transaction of the insert.
+        """
+        self.cursor.execute(SUMMARIZE_SQL.format(where='''
+            WHERE location_id = ? AND time >= ? AND time < ?'''),
+            (location_id, first_time // DAY_MINUTES * DAY_MINUTES,
+             (last_time // DAY_MINUTES + 1) * DAY_MINUTES))
+
+    def _get_location_key(self, location: Location):
+        """
+        Get the integer coordinates of the grid cell of a location.
+        """
+        # round half up, so the cells of negative and positive coordinates have the same size
+        return (int(math.floor(location.get_longitude() / self._grid_resolution + 0.5)),
+                int(math.floor(location.get_latitude() / self._grid_resolution + 0.5)))
+
+    def _get_location_id(self, location: Location, create: bool = False):
+        """
+        Get the id of the grid cell of a location, or None if it is not stored.
+        With create, a location that is not stored is inserted.
+        Must be called in a transaction when create is True.
+        """
+        key = self._get_location_key(location)
+        location_id = self._location_ids.get(key)
+        if location_id is not None:
+            return location_id
+        row = self.cursor.execute('''
+            SELECT id FROM locations WHERE longitude_key = ? AND latitude_key = ?;
+        ''', key).fetchone()
+        if row is not None:
+            if not self.conn.in_transaction:
+                # a location inserted by the running transaction is cached when it
+                # is read after the commit, so a rolled back insert leaves no stale id.
+                self._location_ids[key] = row[0]
+            return row[0]
+        if not create:
+            return None
+        self.cursor.execute('''
+            INSERT INTO locations (longitude_key, latitude_key, longitude, latitude)
+                VALUES (?, ?, ?, ?);
+        ''', key + (location.get_longitude(), location.get_latitude()))
+        return self.cursor.lastrowid
+
+    def _get_df(self, data, columns=COLUMNS):
+        """
+        Get the pandas dataframe from the given records with the given columns,
+        by default (time, precipitation_probability, precipitation, wind_speed_10m).
+        """
+        with metrics.timer("dataframe"):
+            return records_to_frame(data, columns)
+
+    def insert_single_record(self, location: Location, time,
                         precipitation_probability, precipitation, wind_speed_10m):
-        record = self.get_single_record(location, time)
         """
         Insert a single record into the database.
-        Record is inserted only if there is no database record for this location and time
-        """
-        if record.empty:
-            try:
-                self.cursor.execute(''' 
-                    INSERT INTO weather
-                        (longitude, latitude, time,                         
-                                precipitation_probability, 
-                                precipitation,
-                                wind_speed_10m)
-                        VALUES (?, ?, ?, ?, ?, ?);
-                ''', (location.get_longitude(), location.get_latitude(), time, 
-                                precipitation_probability, precipitation, wind_speed_10m))
-                self.conn.commit()
-            except Exception as err:
-                raise DatabaseError("Error in insert_single_record() from database.", err)
+        A record that is already stored for this location and time is handled
+        by the on_conflict policy of the database.
+        """
+        minute = int(time_to_minutes([time])[0])
+        try:
+            with metrics.timer("insert"), self._pool.transaction():
+                location_id = self._get_location_id(location, create=True)
+                self.cursor.execute(self._get_insert_sql(),
+                                    (location_id, minute,
+                                     precipitation_probability, precipitation, wind_speed_10m))
+                if self._summaries:
+                    self._update_summary(location_id, minute, minute)
+        except Exception as err:
+            raise DatabaseError("Error in insert_single_record() from database.", err)
+        metrics.count("rows_ingested")
+
+    def insert_records(self, location: Location, data, fetched_at: datetime.datetime = None):
+        """
+        Insert the records of a whole forecast for a location in one transaction.
+        data is a dataframe (or a dict of equal length arrays) with the columns
+        time, precipitation_probability, precipitation and wind_speed_10m.
+        Duplicated times in data are dropped (the last one is kept), and records
+        that are already stored are handled by the on_conflict policy of the database.
+        If fetched_at is given, it is saved as the time of the last download
+        for the location, in the same transaction.
+        Returns the number of records in data after removing duplicates.
+        """
+        minutes, columns = self._get_columns_of_records(data)
+        try:
+            with metrics.timer("insert"), self._pool.transaction():
+                location_id = self._get_location_id(location, create=True)
+                records = list(zip([location_id] * len(minutes), minutes, *columns))
+                self.cursor.executemany(self._get_insert_sql(), records)
+                if self._summaries and records:
+                    self._update_summary(location_id, min(minutes), max(minutes))
+                if fetched_at is not None:
+                    self._set_last_fetched(location_id, fetched_at)
+        except Exception as err:
+            raise DatabaseError("Error in insert_records() from database.", err)
+        metrics.count("rows_ingested", len(minutes))
+        return len(minutes)
+
+    def insert_many(self, forecasts, fetched_at: datetime.datetime = None):
+        """
+        Insert the records of the forecasts of many locations in one transaction.
+        forecasts is an iterable of (location, data), with data as for insert_records().
+        If fetched_at is given, it is saved as the time of the last download
+        for each of the locations.
+        Returns the number of records inserted.
+        """
+        n_records = 0
+        try:
+            with metrics.timer("insert"), self._pool.transaction():
+                for location, data in forecasts:
+                    minutes, columns = self._get_columns_of_records(data)
+                    location_id = self._get_location_id(location, create=True)
+                    self.cursor.executemany(self._get_insert_sql(),
+                                            zip([location_id] * len(minutes), minutes, *columns))
+                    if self._summaries and minutes:
+                        self._update_summary(location_id, min(minutes), max(minutes))
+                    if fetched_at is not None:
+                        self._set_last_fetched(location_id, fetched_at)
+                    n_records += len(minutes)
+        except Exception as err:
+            raise DatabaseError("Error in insert_many() from database.", err)
+        metrics.count("rows_ingested", n_records)
+        return n_records
+
+    def _get_insert_sql(self):
+        """
+        Get the upsert statement for a record with the on_conflict policy of the database.
+        """
+        return '''
+            INSERT INTO weather
+                (location_id, time,
+                        precipitation_probability,
+                        precipitation,
+                        wind_speed_10m)
+                VALUES (?, ?, ?, ?, ?)''' + self._on_conflict + ";"
+
+    def _get_columns_of_records(self, data):
+        """
+        Get the time (minutes since the epoch) and the measures of the given data
+        as lists of Python numbers, for the parameters of insert_records().
+        """
+        time, measures = frame_to_columns(data)
+        return (time_to_minutes(time).tolist(),
+                [measures[measure].tolist() for measure in MEASURES])
+
+    def _set_last_fetched(self, location_id: int, fetched_at: datetime.datetime):
+        """
+        Save the time of the last download for a location.
+        """
+        # fetched_at is a naive datetime in UTC
+        seconds = int(fetched_at.replace(tzinfo=datetime.timezone.utc).timestamp())
+        self.cursor.execute('''
+            INSERT INTO fetch_state (location_id, last_fetched)
+                VALUES (?, ?)
+                ON CONFLICT (location_id) DO UPDATE SET
+                    last_fetched = excluded.last_fetched;
+        ''', (location_id, seconds))
+
+    def get_last_fetched(self, location: Location):
+        """
+        Get the time (UTC) of the last download for a location,
+        or None if data for the location was never downloaded.
+        """
+        try:
+            location_id = self._get_location_id(location)
+            if location_id is None:
+                return None
+            self.cursor.execute('''
+                SELECT last_fetched FROM fetch_state
+                    WHERE location_id = ?;
+            ''', (location_id,))
+            row = self.cursor.fetchone()
+        except Exception as err:
+            raise DatabaseError("Error in get_last_fetched() from database.", err)
+        if row is None:
+            return None
+        return datetime.datetime.fromtimestamp(row[0], datetime.timezone.utc).replace(tzinfo=None)
 
     def get_single_record(self, location: Location, time):
         """
         Get a single record for the specified location and time.
         """
         try:
-            self.cursor.execute(''' 
-                SELECT precipitation_probability, precipitation, wind_speed_10m 
-                    FROM weather
-                    WHERE longitude = ? 
-                    AND latitude = ?
-                    AND time = ?;
-            ''', (location.get_longitude(), location.get_latitude(), time))
-            data = self.cursor.fetchall()
+            with metrics.timer("query"):
+                self.cursor.execute('''
+                    SELECT time, precipitation_probability, precipitation, wind_speed_10m
+                        FROM weather
+                        WHERE location_id = ?
+                        AND time = ?;
+                ''', (self._get_location_id(location), int(time_to_minutes([time])[0])))
+                data = self.cursor.fetchall()
         except Exception as err:
             raise DatabaseError("Error in get_single_record() from database.", err)
         else:
@@ -108,43 +581,257 @@ class WeatherDatabase():
         """
         Get the three weather records for all times for a given location from the database.
         """
+        return self.query(location)
+
+    def query(self, locations, start=None, end=None, columns=None):
+        """
+        Get the weather records for a location, or a list of locations,
+        for the times from start (included) to end (excluded), from the database.
+        start and end are datetimes or isoformat strings, and None means no limit.
+        columns is a list of the measures to get, by default all of them.
+        For a location, the dataframe has a time index and a column for each measure.
+        For a list of locations, it also has the longitude and latitude columns.
+        """
+        columns = self._get_columns(columns)
+        if isinstance(locations, Location):
+            return self._query_location(locations, start, end, columns)
+        location_columns = ["longitude", "latitude"]
+        dfs = []
+        for location in locations:
+            # each location is an index seek on (location_id, time)
+            df = self._query_location(location, start, end, columns)
+            df.insert(0, "longitude", location.get_longitude())
+            df.insert(1, "latitude", location.get_latitude())
+            dfs.append(df)
+        if not dfs:
+            return self._get_df([], ["time"] + location_columns + columns)
+        return pd.concat(dfs)
+
+    def _query_location(self, location: Location, start, end, columns):
+        """
+        Get the given columns for a location and time range from the database.
+        """
+        sql = "SELECT time, " + ", ".join(columns) + \
+            " FROM weather WHERE location_id = ?"
         try:
-            self.cursor.execute(''' 
-                SELECT time, precipitation_probability, precipitation, wind_speed_10m 
-                    FROM weather
-                    WHERE longitude = ? 
-                    AND latitude = ?;
-            ''', (location.get_longitude(), location.get_latitude()))
-            data = self.cursor.fetchall()
+            params = [self._get_location_id(location)]
+            if start is not None:
+                sql += " AND time >= ?"
+                params.append(int(time_to_minutes([start])[0]))
+            if end is not None:
+                sql += " AND time < ?"
+                params.append(int(time_to_minutes([end])[0]))
+            sql += " ORDER BY time;"
+            with metrics.timer("query"):
+                self.cursor.execute(sql, params)
+                data = self.cursor.fetchall()
         except Exception as err:
-            raise DatabaseError("Error in get_location_record() from database.", err)
+            raise DatabaseError("Error in query() from database.", err)
+        return self._get_df(data, ["time"] + columns)
+
+    def query_decimated(self, location: Location, buckets: int, start=None, end=None, columns=None):
+        """
+        Get the records of a location like query(), decimated by the database for a plot
+        of about buckets pixels wide: the time range is split into buckets of equal length,
+        and for each bucket the minimum of each measure is returned at its first time
+        and the maximum at its last time (at most 2 * buckets rows).
+        """
+        columns = self._get_columns(columns)
+        where = " FROM weather WHERE location_id = ?"
+        try:
+            params = [self._get_location_id(location)]
+            if start is not None:
+                where += " AND time >= ?"
+                params.append(int(time_to_minutes([start])[0]))
+            if end is not None:
+                where += " AND time < ?"
+                params.append(int(time_to_minutes([end])[0]))
+            with metrics.timer("query"):
+                # two subqueries, so each is one seek in the primary key
+                first, last = self.cursor.execute("SELECT (SELECT min(time)" + where + "), (SELECT max(time)"
+                                                  + where + ");", params + params).fetchone()
+                if first is None:
+                    return self._get_df([], ["time"] + columns)
+                bucket_minutes = get_bucket_minutes(first, last, buckets)
+                sql = "SELECT min(time), max(time), count(*), " + \
+                    ", ".join("min(" + column + ")" for column in columns) + ", " + \
+                    ", ".join("max(" + column + ")" for column in columns) + \
+                    where + " GROUP BY (time - ?) / ? ORDER BY 1;"
+                self.cursor.execute(sql, params + [first, bucket_minutes])
+                data = self.cursor.fetchall()
+        except Exception as err:
+            raise DatabaseError("Error in query_decimated() from database.", err)
+        with metrics.timer("dataframe"):
+            table = np.array(data, dtype=np.float64).reshape(-1, 3 + 2 * len(columns))
+            n = len(columns)
+            minutes, values = interleave_envelope(table[:, 0].astype(np.int64), table[:, 1].astype(np.int64),
+                                                  table[:, 2],
+                                                  {column: table[:, 3 + i] for i, column in enumerate(columns)},
+                                                  {column: table[:, 3 + n + i] for i, column in enumerate(columns)})
+            return pd.DataFrame(values, index=minutes_to_time(minutes))
+
+    def _get_columns(self, columns):
+        """
+        Get the list of measures to query, checking that they are valid column names.
+        """
+        if columns is None:
+            return list(MEASURES)
+        if isinstance(columns, str):
+            columns = [columns]
+        for column in columns:
+            if column not in MEASURES:
+                raise DatabaseError("Unknown column in query().", column)
+        return list(columns)
+
+    def rollup(self, location: Location, freq: str = "D", agg=None, start=None, end=None):
+        """
+        Get the rollups of the hourly records of a location per day (freq "D")
+        or per week starting on Monday (freq "W"), computed by the database.
+        agg is a list of the rollups to get (see ROLLUPS), by default all of them.
+        start and end are rounded down to whole days; the periods from
+        start (included) to end (excluded) are returned, and None means no limit.
+        The rollups come from the daily summary table if it exists.
+        The dataframe has a time index with the first day of each period
+        and a column for each rollup.
+        """
+        if freq not in ROLLUP_PERIODS:
+            raise DatabaseError("Unknown freq in rollup().", freq)
+        if agg is None:
+            agg = list(ROLLUPS)
+        elif isinstance(agg, str):
+            agg = [agg]
+        for name in agg:
+            if name not in ROLLUPS:
+                raise DatabaseError("Unknown agg in rollup().", name)
+        if self._summaries:
+            table, day, column = "weather_daily", "day", 1
         else:
-            return self._get_df(data)
+            table, day, column = "weather", "time / 1440", 0
+        # the first minute of the first day of the period
+        sql = "SELECT (" + ROLLUP_PERIODS[freq].format(day=day) + ") * 1440 AS period, " + \
+            ", ".join(ROLLUPS[name][column] for name in agg) + \
+            " FROM " + table + " WHERE location_id = ?"
+        try:
+            params = [self._get_location_id(location)]
+            if start is not None:
+                sql += " AND " + day + " >= ?"
+                params.append(int(time_to_minutes([start])[0]) // DAY_MINUTES)
+            if end is not None:
+                sql += " AND " + day + " < ?"
+                params.append(int(time_to_minutes([end])[0]) // DAY_MINUTES)
+            sql += " GROUP BY period ORDER BY period;"
+            with metrics.timer("query"):
+                self.cursor.execute(sql, params)
+                data = self.cursor.fetchall()
+        except Exception as err:
+            raise DatabaseError("Error in rollup() from database.", err)
+        return self._get_df(data, ["time"] + agg)
+
+    def find_nearest(self, location: Location, max_distance: float):
+        """
+        Get the stored location nearest to location (as stored, with its coordinates),
+        if it is within max_distance km, else None.
+        """
+        return self._get_location_index().find_nearest(location, max_distance)
+
+    def nearest_locations(self, locations, n: int, max_distance: float = None):
+        """
+        Get the n stored locations nearest to each of a list of locations, within
+        max_distance km if given, as a dataframe with a row for each neighbor
+        (see spatial_index.LocationIndex.nearest_locations()).
+        """
+        return self._get_location_index().nearest_locations(locations, n, max_distance)
+
+    def _get_location_index(self) -> LocationIndex:
+        """
+        Get the spatial index of the stored locations. It is made again when
+        the committed locations changed, also by another connection or process.
+        """
+        try:
+            with metrics.timer("query"):
+                version = self.cursor.execute("SELECT count(*), max(id) FROM locations;").fetchone()
+                cached = self._location_index
+                if cached is not None and cached[0] == version:
+                    return cached[1]
+                rows = self.cursor.execute("SELECT id, longitude, latitude FROM locations;").fetchall()
+        except Exception as err:
+            raise DatabaseError("Error in reading the locations from database.", err)
+        location_index = LocationIndex(Location(longitude, latitude) for _, longitude, latitude in rows)
+        # the version of the rows the index is made from, read in the same statement
+        version = (len(rows), max((row[0] for row in rows), default=None))
+        self._location_index = (version, location_index)
+        return location_index
 
     def get_all_data(self):
         """
         Get all records from the database.
+        The dataframe has a time index, and the longitude, latitude and measures columns.
         """
+        columns = ["time", "longitude", "latitude"] + MEASURES
         try:
-            self.cursor.execute('''  
-                SELECT * FROM weather;
-            ''')
-            data = self.cursor.fetchall()
+            with metrics.timer("query"):
+                self.cursor.execute(self._get_scan_sql(columns))
+                data = self.cursor.fetchall()
         except Exception as err:
             raise DatabaseError("Error in get_all_data() from database.", err)
         else:
-            return self._get_df(data)
+            return self._get_df(data, columns)
 
+    def iter_chunks(self, chunk_rows: int = 100000, columns=None):
+        """
+        Iterate over all records from the database, in dataframes of up to chunk_rows records.
+        columns is a list of the measures to get, by default all of them.
+        The dataframes have a time index, and the longitude, latitude and measures columns,
+        like get_all_data(), but only one chunk is in memory at a time.
+        """
+        columns = ["time", "longitude", "latitude"] + self._get_columns(columns)
+        # a separate cursor, so the database can be used while iterating
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(self._get_scan_sql(columns))
+            while True:
+                data = cursor.fetchmany(chunk_rows)
+                if not data:
+                    break
+                yield self._get_df(data, columns)
+        except Exception as err:
+            raise DatabaseError("Error in iter_chunks() from database.", err)
+        finally:
+            cursor.close()
+
+    def _get_scan_sql(self, columns):
+        """
+        Get the select statement of the given columns of all records,
+        ordered by longitude, latitude and time.
+        """
+        # CROSS JOIN keeps the locations in the outer loop, so the locations are read
+        # in the order of their coordinates index and the records of each location
+        # in the order of the primary key. With l.id in the ORDER BY, sqlite knows
+        # that the records are in order, and does not sort them.
+        return "SELECT " + ", ".join("l." + column if column in ("longitude", "latitude")
+                                     else "w." + column for column in columns) + \
+            " FROM locations AS l CROSS JOIN weather AS w ON w.location_id = l.id" + \
+            " ORDER BY l.longitude, l.latitude, l.id, w.time;"
 
     def reset(self):
         """
-        Reset the database by deleting all records from the 'weather' table of the database.
+        Reset the database by deleting all records from the 'weather' table of the database,
+        the times of the last downloads and the daily summaries.
+        The locations (grid cells) are kept, so their ids stay valid for the other
+        connections and processes that cached them.
         """
-        try: 
-            self.cursor.execute(''' 
-                DELETE FROM weather; 
-            ''')
-            self.conn.commit()
+        try:
+            with self._pool.transaction():
+                self.cursor.execute('''
+                    DELETE FROM weather;
+                ''')
+                self.cursor.execute('''
+                    DELETE FROM fetch_state;
+                ''')
+                if self._summaries:
+                    self.cursor.execute('''
+                        DELETE FROM weather_daily;
+                    ''')
         except Exception as err:
             raise DatabaseError("Error in deleting all rows for database.", err)
         else:
@@ -152,23 +839,27 @@ class WeatherDatabase():
 
     def drop(self):
         """
-        Drop the database table from the database.
+        Drop the database tables from the database.
         """
-        try: 
-            self.cursor.execute(''' 
-                DROP TABLE IF EXISTS weather; 
-            ''')
-            self.conn.commit()
+        try:
+            with self._pool.transaction():
+                for table in ["weather", "fetch_state", "weather_daily", "locations", "metadata"]:
+                    self.cursor.execute(f"DROP TABLE IF EXISTS {table};")
+                self.cursor.execute("PRAGMA user_version = 0;")
+            self._summaries = False
+            self._location_ids.clear()
+            self._location_index = None
         except Exception as err:
             raise DatabaseError("Error in dropping table from database.", err)
         else:
-            logger.info("Database table 'weather' is dropped.")
+            logger.info("Database tables 'weather', 'fetch_state', 'weather_daily', " +
+                        "'locations' and 'metadata' are dropped.")
 
     def __del__(self):
         """
-        Close connection when object is deleted.
+        Close connections when object is deleted.
         """
         try:
-            self.conn.close()
+            self._pool.close()
         except Exception as err:
             raise DatabaseError("Error in closing database connection.", err)
@@ -0,0 +1,133 @@
+"""
+Downsampling of long time series for plotting, to about one point per pixel,
+so the cost of a plot does not grow with the stored history.
+lttb() keeps the points that best preserve the shape of a series
+(Largest-Triangle-Three-Buckets), and minmax() keeps the lowest and the highest
+point of each bucket, so no peak is lost.
+Both return the indices of the kept points, and decimate_frame() applies them
+to each series of a dataframe.
+"""
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+# methods of decimate_frame()
+METHODS = ("lttb", "minmax")
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Get the indices of n_out points of the series (x, y) chosen with the
+    Largest-Triangle-Three-Buckets algorithm. The first and the last point are kept,
+    and in each bucket between them the point is kept that makes the largest triangle
+    with the point kept in the previous bucket and the mean of the next bucket.
+    x is sorted, and y has no NaN.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # n_out - 2 buckets of about the same size, between the first and the last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    ends = np.append(edges[1:], n)
+    # the means of the buckets, and of the last point as the bucket after the last one
+    sums = np.add.reduceat(np.column_stack((x, y))[:n - 1], edges[:-1], axis=0)
+    means = np.vstack((sums / (edges[1:] - edges[:-1])[:, np.newaxis], [[x[-1], y[-1]]]))
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    # each bucket depends on the point kept in the previous one
+    for i in range(n_out - 2):
+        lo, hi = edges[i], ends[i]
+        mean_x, mean_y = means[i + 1]
+        area = np.abs((x[a] - mean_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (mean_y - y[a]))
+        a = lo + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+def minmax(y: np.ndarray, n_buckets: int) -> np.ndarray:
+    """
+    Get the sorted indices of the lowest and the highest point of each of n_buckets
+    buckets of the series y (at most 2 * n_buckets points), and of its first and last point.
+    y has no NaN.
+    """
+    n = len(y)
+    if 2 * n_buckets >= n or n_buckets < 1:
+        return np.arange(n)
+    size = -(-n // n_buckets)
+    n_buckets = -(-n // size)
+    # the last bucket is padded with the last value, which argmin and argmax never
+    # choose over the same value before it
+    padded = np.pad(np.asarray(y, dtype=np.float64), (0, n_buckets * size - n), mode="edge")
+    buckets = padded.reshape(n_buckets, size)
+    starts = np.arange(n_buckets) * size
+    indices = np.concatenate(([0, n - 1], starts + buckets.argmin(axis=1), starts + buckets.argmax(axis=1)))
+    return np.unique(indices)
+
+def decimate_series(series: pd.Series, width: int, method: str = "lttb") -> pd.Series:
+    """
+    Downsample a series with a time index to about width points with lttb,
+    or to the lowest and highest point of width buckets with minmax.
+    Missing values are dropped. A series that is short enough is returned as it is.
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown decimation method: " + str(method))
+    series = series.dropna()
+    if method == "lttb":
+        indices = lttb(series.index.asi8, series.to_numpy(), width)
+    else:
+        indices = minmax(series.to_numpy(), width)
+    if len(indices) == len(series):
+        return series
+    return series.iloc[indices]
+
+def decimate_frame(df: pd.DataFrame, width: int, method: str = "lttb") -> Dict[str, pd.Series]:
+    """
+    Downsample each column of a dataframe with a time index with decimate_series().
+    The columns keep different times, so they are returned as a dict of series.
+    """
+    return {column: decimate_series(df[column], width, method) for column in df.columns}
+
+def get_bucket_minutes(first_minute: int, last_minute: int, buckets: int) -> int:
+    """
+    Get the width in minutes of the time buckets of a decimating query,
+    for about buckets buckets from first_minute to last_minute.
+    """
+    return max(1, -(-(last_minute - first_minute + 1) // max(1, buckets)))
+
+def bucket_envelope(minutes: np.ndarray, columns: Dict[str, np.ndarray], first_minute: int,
+                    bucket_minutes: int):
+    """
+    Get the first and last time, the number of records, and the minimum and maximum
+    of each column of each time bucket of sorted minutes, like a decimating query.
+    minutes is not empty.
+    """
+    bucket = (minutes - first_minute) // bucket_minutes
+    starts = np.flatnonzero(np.diff(bucket, prepend=bucket[0] - 1))
+    ends = np.append(starts[1:], len(minutes)) - 1
+    mins = {column: np.fmin.reduceat(values, starts) for column, values in columns.items()}
+    maxs = {column: np.fmax.reduceat(values, starts) for column, values in columns.items()}
+    return minutes[starts], minutes[ends], ends - starts + 1, mins, maxs
+
+def interleave_envelope(minutes_min: np.ndarray, minutes_max: np.ndarray, counts: np.ndarray,
+                        mins: Dict[str, np.ndarray], maxs: Dict[str, np.ndarray]):
+    """
+    Interleave the per-bucket minimums and maximums of a decimating query into rows:
+    the minimums at the first time of each bucket, and the maximums at its last time,
+    for the buckets with more than one record. Returns the times and the columns.
+    """
+    two = counts > 1
+    # position of the first row of each bucket in the output
+    positions = np.concatenate(([0], np.cumsum(1 + two)[:-1])).astype(np.int64)
+    n_rows = len(counts) + int(two.sum())
+    minutes = np.empty(n_rows, dtype=np.int64)
+    minutes[positions] = minutes_min
+    minutes[positions[two] + 1] = minutes_max[two]
+    columns = {}
+    for column in mins:
+        values = np.empty(n_rows, dtype=np.float64)
+        values[positions] = mins[column]
+        values[positions[two] + 1] = maxs[column][two]
+        columns[column] = values
+    return minutes, columns
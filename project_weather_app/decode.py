@@ -0,0 +1,110 @@
+"""
+Decode the weather data into pandas dataframes, column by column,
+without per-row Python code.
+"""
+import numpy as np
+import pandas as pd
+
+# columns of the weather data
+COLUMNS = ["time", "precipitation_probability", "precipitation", "wind_speed_10m"]
+MEASURES = COLUMNS[1:]
+
+def parse_time(values) -> pd.DatetimeIndex:
+    """
+    Parse an array of isoformat time strings (e.g. "2024-01-01T00:00") into a DatetimeIndex.
+    The strings are parsed by numpy as datetime64[m], which is then stored with
+    the coarsest resolution supported by pandas (seconds).
+    """
+    time = np.asarray(values, dtype=object).astype("datetime64[m]")
+    return pd.DatetimeIndex(time.astype("datetime64[s]"), name="time")
+
+# the database stores the time as integer minutes since the epoch
+EPOCH = np.datetime64("1970-01-01T00:00", "m")
+
+def time_to_minutes(values) -> np.ndarray:
+    """
+    Convert an array of datetimes or isoformat time strings to minutes since the epoch.
+    """
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.datetime64):
+        values = values.astype(object)
+    return (values.astype("datetime64[m]") - EPOCH).astype(np.int64)
+
+def minutes_to_time(minutes) -> pd.DatetimeIndex:
+    """
+    Convert an array of minutes since the epoch to a DatetimeIndex.
+    """
+    time = np.asarray(minutes, dtype=np.int64).astype("datetime64[m]")
+    return pd.DatetimeIndex(time.astype("datetime64[s]"), name="time")
+
+def format_time(values) -> np.ndarray:
+    """
+    Format an array of datetimes as isoformat time strings with minutes (e.g. "2024-01-01T00:00").
+    """
+    return np.datetime_as_string(np.asarray(values, dtype="datetime64[m]"), unit="m")
+
+def hourly_to_frame(hourly: dict) -> pd.DataFrame:
+    """
+    Decode the "hourly" arrays of an API response into a dataframe
+    with a time index and a float64 column for each measure.
+    """
+    index = parse_time(hourly.get("time", []))
+    data = {}
+    for measure in MEASURES:
+        # missing values (null in json) become NaN
+        data[measure] = np.asarray(hourly.get(measure, [np.nan] * len(index)), dtype=np.float64)
+    return pd.DataFrame(data, index=index)
+
+def records_to_frame(records, columns=COLUMNS) -> pd.DataFrame:
+    """
+    Decode database records into a dataframe with a time index
+    and a float64 column for each of the other columns.
+    The first of the columns of the records is the time in minutes since the epoch.
+    """
+    # all columns are numbers, and missing values (NULL in the database) become NaN
+    table = np.array(records, dtype=np.float64).reshape(-1, len(columns))
+    index = minutes_to_time(table[:, 0])
+    data = {}
+    for i, column in enumerate(columns[1:], start=1):
+        data[column] = table[:, i]
+    return pd.DataFrame(data, index=index)
+
+def frame_to_columns(data):
+    """
+    Get the time (as datetime64[m]) and float64 measure arrays of weather data
+    for storage. data is a dataframe, with the time in a column or in the index,
+    or a dict of equal length arrays. Duplicated times are dropped (the last one is kept).
+    Returns the time array and a dict of the measure arrays.
+    """
+    if isinstance(data, dict):
+        return _dict_to_columns(data)
+    df = pd.DataFrame(data)
+    if "time" not in df.columns:
+        # the time may be stored in the index of the dataframe
+        df = df.reset_index()
+    df = df.drop_duplicates(subset="time", keep="last")
+    time = df["time"].to_numpy()
+    if not np.issubdtype(time.dtype, np.datetime64):
+        time = time.astype(object)
+    time = time.astype("datetime64[m]")
+    measures = {measure: df[measure].to_numpy(dtype=np.float64, na_value=np.nan)
+                for measure in MEASURES}
+    return time, measures
+
+def _dict_to_columns(data: dict):
+    """
+    frame_to_columns() for a dict of arrays, with numpy only.
+    """
+    time = np.asarray(data["time"])
+    if not np.issubdtype(time.dtype, np.datetime64):
+        time = time.astype(object)
+    time = time.astype("datetime64[m]")
+    measures = {measure: np.asarray(data[measure], dtype=np.float64) for measure in MEASURES}
+    # increasing times (e.g. of a forecast) have no duplicates
+    if len(time) > 1 and not np.all(time[1:] > time[:-1]):
+        # keep the last of the duplicated times, in the order of the data
+        _, reversed_index = np.unique(time[::-1], return_index=True)
+        keep = np.sort(len(time) - 1 - reversed_index)
+        time = time[keep]
+        measures = {measure: values[keep] for measure, values in measures.items()}
+    return time, measures
@@ -6,6 +6,14 @@ MODE_ERROR_EXIT_CODE = 2
 CONFIG_FILE_ERROR_EXIT_CODE = 2
 DATABASE_ERROR_EXIT_CODE = 2
 DATA_SERVICE_ERROR_EXIT_CODE = 2
+LOCATIONS_FILE_ERROR_EXIT_CODE = 2
+EXPORT_ERROR_EXIT_CODE = 2
+
+# The exceptions of this program log the error and exit in their constructor,
+# so a failed call raises SystemExit, which "except Exception" does not catch.
+# The threads and the servers that have to go on after one failed task catch
+# RECOVERABLE_ERRORS instead; KeyboardInterrupt still stops the program.
+RECOVERABLE_ERRORS = (Exception, SystemExit)
 
 class ModeError(Exception):
     def __init__(self, message, mode):
@@ -51,3 +59,27 @@ class DataServiceError(Exception):
         logger.error(message)
         logger.error("Exception: " + str(exception_error))
         exit(self.exit_code)
+
+class LocationsFileError(Exception):
+    def __init__(self, message, filepath, exception_error=Exception):
+        """
+        This exception is for problems related to the locations file.
+        """
+        super().__init__(message)
+        self.exit_code = LOCATIONS_FILE_ERROR_EXIT_CODE
+        logger.error(message)
+        logger.error("Exception: " + str(exception_error))
+        logger.error("LocationsFile: " + str(filepath))
+        exit(self.exit_code)
+
+class ExportError(Exception):
+    def __init__(self, message, filepath, exception_error=Exception):
+        """
+        This exception is for problems in exporting the database to a file.
+        """
+        super().__init__(message)
+        self.exit_code = EXPORT_ERROR_EXIT_CODE
+        logger.error(message)
+        logger.error("Exception: " + str(exception_error))
+        logger.error("ExportFile: " + str(filepath))
+        exit(self.exit_code)
@@ -0,0 +1,97 @@
+"""
+Export the weather database (or columnar store) to a csv, Parquet or Arrow IPC file,
+streaming the records in chunks so memory use does not grow with the database.
+Parquet and Arrow IPC need the optional pyarrow package.
+"""
+from database import IWeatherStorage
+from util import get_file_path
+from exception import ExportError
+
+import logging
+logger = logging.getLogger(__name__)
+
+# export formats for the file extensions
+EXPORT_FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+}
+
+def get_export_format(filename: str) -> str:
+    """
+    Get the export format from the extension of filename.
+    """
+    for extension, export_format in EXPORT_FORMATS.items():
+        if str(filename).lower().endswith(extension):
+            return export_format
+    raise ExportError("Unknown export format for the file extension.", filename)
+
+def export(database: IWeatherStorage, filename: str, export_format: str = None,
+           chunk_rows: int = 100000) -> int:
+    """
+    Export all records of the database to filename in export_format
+    ("csv", "parquet" or "arrow"; by default from the file extension).
+    Returns the number of exported records.
+    """
+    filepath = get_file_path(filename, calling_file=__file__)
+    if export_format is None:
+        export_format = get_export_format(filepath)
+    logger.info("Exporting database to " + export_format + " file: " + str(filepath))
+    chunks = database.iter_chunks(chunk_rows=chunk_rows)
+    if export_format == "csv":
+        n_rows = _export_csv(chunks, filepath)
+    elif export_format in ("parquet", "arrow"):
+        n_rows = _export_arrow(chunks, filepath, export_format)
+    else:
+        raise ExportError("Unknown export format.", filepath, export_format)
+    logger.info("Exported " + str(n_rows) + " records.")
+    return n_rows
+
+def _export_csv(chunks, filepath) -> int:
+    """
+    Write the chunks to a csv file, with a header line.
+    """
+    n_rows = 0
+    try:
+        with open(filepath, "w", newline="") as f:
+            for i, df in enumerate(chunks):
+                df.to_csv(f, header=(i == 0))
+                n_rows += len(df)
+            if n_rows == 0:
+                f.write("time,longitude,latitude,precipitation_probability,precipitation,wind_speed_10m\n")
+    except OSError as err:
+        raise ExportError("Cannot write the export file.", filepath, err)
+    return n_rows
+
+def _export_arrow(chunks, filepath, export_format: str) -> int:
+    """
+    Write the chunks to a Parquet file (a row group per chunk)
+    or an Arrow IPC file (a record batch per chunk).
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as err:
+        raise ExportError("The pyarrow package is needed to export to " + export_format + ".",
+                          filepath, err)
+    n_rows = 0
+    writer = None
+    try:
+        for df in chunks:
+            table = pa.Table.from_pandas(df, preserve_index=True)
+            if writer is None:
+                if export_format == "parquet":
+                    writer = pq.ParquetWriter(str(filepath), table.schema)
+                else:
+                    writer = pa.ipc.new_file(str(filepath), table.schema)
+            writer.write_table(table)
+            n_rows += len(df)
+    except OSError as err:
+        raise ExportError("Cannot write the export file.", filepath, err)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        logger.warning("Database is empty. No export file written.")
+    return n_rows
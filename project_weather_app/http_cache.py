@@ -0,0 +1,297 @@
+"""
+The HttpCache object keeps the responses of the weather data API in an sqlite file,
+keyed on the url and the request parameters, so repeated requests are answered
+without the network, also after a restart. The start of the time window of a request
+is not in the key: a stored response of the same model run with an earlier start
+has the forecast of the requested hours too, so the incremental refreshes, whose
+start moves with each download, are answered from the cache.
+The bodies are stored compressed, with zstd if the zstandard package is installed,
+else with gzip.
+A response is fresh until its Cache-Control max-age expires, but not past the time
+the next forecast model run is available, since the forecast changes then.
+A stale response with an ETag or a Last-Modified header is revalidated with a
+conditional request, and a 304 answer reuses the stored body.
+"""
+import gzip
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from util import get_file_path
+import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# stores between removals of the oldest responses above max_entries
+PRUNE_INTERVAL = 100
+
+# request parameters left out of the cache key (see above)
+UNKEYED_PARAMS = ("start_hour",)
+
+# headers of a response that are stored with it
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Cache-Control", "Date")
+
+class CachedResponse():
+    def __init__(self, key: str, headers: dict, body: bytes, stored_at: float, expires_at: float):
+        """
+        A stored response: its headers, its uncompressed body,
+        and the times it was stored and expires (time.time()).
+        """
+        self.key = key
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+
+    def is_fresh(self, now: float = None) -> bool:
+        return (time.time() if now is None else now) < self.expires_at
+
+    def get_validators(self) -> dict:
+        """
+        Get the headers of a conditional request for this response.
+        """
+        validators = {}
+        if self.headers.get("ETag"):
+            validators["If-None-Match"] = self.headers["ETag"]
+        if self.headers.get("Last-Modified"):
+            validators["If-Modified-Since"] = self.headers["Last-Modified"]
+        return validators
+
+    def to_response(self, url: str) -> requests.Response:
+        """
+        Make a requests.Response of the stored response, for the callers of HttpClient.get().
+        """
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r.headers = CaseInsensitiveDict(self.headers)
+        r._content = self.body
+        r.encoding = "utf-8"
+        r.from_cache = True
+        return r
+
+class HttpCache():
+    def __init__(self, filename: str, compression: str = "zstd", max_entries: int = 10000,
+                 model_run_interval: float = 10800, model_run_delay: float = 7200):
+        """
+        Create the cache in the sqlite file filename, for up to max_entries responses.
+        compression is "zstd" or "gzip"; zstd needs the zstandard package, else gzip is used.
+        The forecast models run every model_run_interval seconds (from 00:00 UTC),
+        and a run is available model_run_delay seconds after its start.
+        """
+        self._filepath = get_file_path(filename, calling_file=__file__)
+        if compression == "zstd" and zstandard is None:
+            logger.info("The zstandard package is not installed, using gzip for the http cache.")
+            compression = "gzip"
+        if compression not in ("zstd", "gzip"):
+            raise ValueError("Unknown compression of the http cache: " + str(compression))
+        self._compression = compression
+        self._max_entries = max_entries
+        self._model_run_interval = model_run_interval
+        self._model_run_delay = model_run_delay
+        self._lock = threading.Lock()
+        self._n_stores = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.bytes_saved = 0
+        self._conn = sqlite3.connect(self._filepath, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL;")
+        self._conn.execute("PRAGMA synchronous = NORMAL;")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                url TEXT NOT NULL,
+                                headers TEXT NOT NULL,
+                                compression TEXT NOT NULL,
+                                body BLOB NOT NULL,
+                                stored_at REAL NOT NULL,
+                                expires_at REAL NOT NULL);''')
+        self._conn.commit()
+        logger.info("Http cache: " + str(self._filepath) + " (" + self._compression + ")")
+
+    @staticmethod
+    def get_key(url: str, params: dict) -> str:
+        """
+        Get the cache key of a request: a hash of the url and the sorted parameters,
+        but the ones in UNKEYED_PARAMS.
+        """
+        query = urlencode(sorted((str(name), str(value)) for name, value in (params or {}).items()
+                                 if name not in UNKEYED_PARAMS))
+        return hashlib.sha256((url + "?" + query).encode()).hexdigest()
+
+    def lookup(self, url: str, params: dict) -> Optional[CachedResponse]:
+        """
+        Get the stored response of a request, fresh or stale, or None.
+        A response stored with zstd cannot be read without the zstandard package,
+        and is requested again.
+        """
+        key = self.get_key(url, params)
+        with self._lock:
+            row = self._conn.execute('''SELECT headers, compression, body, stored_at, expires_at
+                                        FROM responses WHERE key = ?;''', (key,)).fetchone()
+        if row is None:
+            return None
+        headers, compression, body, stored_at, expires_at = row
+        if compression == "zstd" and zstandard is None:
+            return None
+        return CachedResponse(key, json.loads(headers), self._decompress(body, compression),
+                              stored_at, expires_at)
+
+    def store(self, url: str, params: dict, response: requests.Response):
+        """
+        Store a 200 response, unless its Cache-Control forbids it.
+        """
+        cache_control = _parse_cache_control(response.headers.get("Cache-Control", ""))
+        if "no-store" in cache_control:
+            return
+        now = time.time()
+        headers = {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+        body = self._compress(response.content)
+        with self._lock:
+            self._conn.execute('''INSERT OR REPLACE INTO responses
+                                  (key, url, headers, compression, body, stored_at, expires_at)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?);''',
+                               (self.get_key(url, params), url, json.dumps(headers), self._compression,
+                                body, now, self._get_expiry(now, cache_control)))
+            self._n_stores += 1
+            if self._n_stores % PRUNE_INTERVAL == 0:
+                self._prune()
+            self._conn.commit()
+
+    def refresh(self, cached: CachedResponse, response: requests.Response):
+        """
+        Renew a stored response after a 304 (not modified) answer, with its new headers.
+        """
+        cache_control = _parse_cache_control(response.headers.get("Cache-Control",
+                                                                  cached.headers.get("Cache-Control", "")))
+        headers = dict(cached.headers)
+        headers.update({name: response.headers[name] for name in STORED_HEADERS if name in response.headers})
+        now = time.time()
+        with self._lock:
+            self._conn.execute('''UPDATE responses SET headers = ?, stored_at = ?, expires_at = ?
+                                  WHERE key = ?;''',
+                               (json.dumps(headers), now, self._get_expiry(now, cache_control), cached.key))
+            self._conn.commit()
+            self.revalidated += 1
+            self.bytes_saved += len(cached.body)
+        metrics.count("http_cache_revalidated")
+        metrics.count("http_cache_bytes_saved", len(cached.body))
+
+    def count_hit(self, cached: CachedResponse):
+        """
+        Count a request answered from the cache without the network.
+        """
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += len(cached.body)
+        metrics.count("http_cache_hits")
+        metrics.count("http_cache_bytes_saved", len(cached.body))
+
+    def count_miss(self):
+        """
+        Count a request sent to the server (also a revalidation).
+        """
+        with self._lock:
+            self.misses += 1
+        metrics.count("http_cache_misses")
+
+    def get_hit_rate(self) -> float:
+        """
+        Get the fraction of requests answered from the cache without the network.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_status(self) -> str:
+        return ("http cache hits: " + str(self.hits) + ", misses: " + str(self.misses)
+                + ", revalidated: " + str(self.revalidated)
+                + ", hit rate: " + format(self.get_hit_rate(), ".1%")
+                + ", bytes saved: " + str(self.bytes_saved))
+
+    def clear(self):
+        """
+        Remove all stored responses.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM responses;")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _get_expiry(self, now: float, cache_control: dict) -> float:
+        """
+        Get the time a response stored at now expires: at the next model run
+        or after the max-age of its Cache-Control, whichever is first.
+        With no-cache, it has to be revalidated at once.
+        """
+        if "no-cache" in cache_control:
+            return now
+        expires_at = self.get_next_model_run(now)
+        max_age = cache_control.get("max-age")
+        if max_age is not None:
+            expires_at = min(expires_at, now + max_age)
+        return expires_at
+
+    def get_next_model_run(self, now: float) -> float:
+        """
+        Get the time (time.time()) the next forecast model run after now is available.
+        """
+        if self._model_run_interval <= 0:
+            return float("inf")
+        # runs start at multiples of the interval since 00:00 UTC, and are available after the delay
+        run_start = (now - self._model_run_delay) // self._model_run_interval * self._model_run_interval
+        return run_start + self._model_run_interval + self._model_run_delay
+
+    def _compress(self, body: bytes) -> bytes:
+        if self._compression == "zstd":
+            return zstandard.ZstdCompressor(level=3).compress(body)
+        return gzip.compress(body, compresslevel=6)
+
+    @staticmethod
+    def _decompress(body: bytes, compression: str) -> bytes:
+        if compression == "zstd":
+            return zstandard.ZstdDecompressor().decompress(body)
+        return gzip.decompress(body)
+
+    def _prune(self):
+        """
+        Remove the oldest responses above max_entries. Called with the lock.
+        """
+        self._conn.execute('''DELETE FROM responses WHERE key IN
+                              (SELECT key FROM responses ORDER BY stored_at DESC LIMIT -1 OFFSET ?);''',
+                           (self._max_entries,))
+
+def _parse_cache_control(value: str) -> dict:
+    """
+    Parse a Cache-Control header into a dict of its directives,
+    with max-age in seconds.
+    """
+    directives = {}
+    for directive in value.split(","):
+        name, _, argument = directive.strip().partition("=")
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name in ("max-age", "s-maxage"):
+            try:
+                directives["max-age"] = max(0, int(argument.strip().strip('"')))
+            except ValueError:
+                pass
+        else:
+            directives[name] = argument.strip() or True
+    return directives
@@ -0,0 +1,111 @@
+"""
+The HttpClient object sends the requests to the weather data API
+through a pooled session, with rate limiting and retries,
+and optionally through a persistent response cache (see http_cache.py).
+"""
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from http_cache import HttpCache
+import metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+# status codes of responses that are worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class RateLimiter():
+    """
+    Limit the rate of requests to each host, shared by all threads.
+    """
+    def __init__(self, requests_per_second: float):
+        self._interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self._next_time = {} # host -> earliest time of the next request
+        self._lock = threading.Lock()
+
+    def acquire(self, host: str):
+        """
+        Wait until a request to host is allowed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time.get(host, now))
+            self._next_time[host] = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+class HttpClient():
+    def __init__(self, max_workers: int = 8, requests_per_second: float = 10,
+                 retries: int = 3, backoff_factor: float = 0.5, timeout: float = 30,
+                 cache: HttpCache = None):
+        """
+        Create the http client with a connection pool for max_workers threads.
+        With a cache, fresh stored responses are returned without a request.
+        """
+        self._cache = cache
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._timeout = timeout
+        self._rate_limiter = RateLimiter(requests_per_second)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def get(self, url: str, params: dict) -> requests.Response:
+        """
+        Get the response of a GET request, from the cache if it is fresh there.
+        A stale cached response is revalidated with a conditional request.
+        """
+        if self._cache is None:
+            return self._send(url, params)
+        cached = self._cache.lookup(url, params)
+        if cached is not None and cached.is_fresh():
+            self._cache.count_hit(cached)
+            return cached.to_response(url)
+        self._cache.count_miss()
+        r = self._send(url, params, headers=None if cached is None else cached.get_validators())
+        if r.status_code == 304 and cached is not None:
+            self._cache.refresh(cached, r)
+            return cached.to_response(url)
+        if r.status_code == 200:
+            self._cache.store(url, params, r)
+        return r
+
+    def _send(self, url: str, params: dict, headers: dict = None) -> requests.Response:
+        """
+        Send a GET request, retrying with exponential backoff (and jitter)
+        on connection errors and on the status codes in RETRY_STATUS_CODES.
+        Returns the last response, or raises the last exception.
+        """
+        host = urlsplit(url).netloc
+        for attempt in range(self._retries + 1):
+            self._rate_limiter.acquire(host)
+            metrics.count("http_requests")
+            try:
+                r = self._session.get(url, params=params, headers=headers, timeout=self._timeout)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt == self._retries:
+                    raise
+                logger.warning("Request failed: " + str(err))
+            else:
+                if r.status_code not in RETRY_STATUS_CODES or attempt == self._retries:
+                    return r
+                logger.warning("Request failed with status code: " + str(r.status_code))
+            metrics.count("http_retries")
+            delay = self._backoff_factor * 2 ** attempt
+            time.sleep(delay + random.uniform(0, delay))
+
+    def close(self):
+        """
+        Close the connections of the session, and the cache.
+        """
+        self._session.close()
+        if self._cache is not None:
+            self._cache.close()
@@ -0,0 +1,180 @@
+"""
+Load test of the read server (see read_server.py), with keep-alive connections.
+Each connection sends requests one after another for random locations of a
+locations file (or one location), and the latency percentiles are reported.
+Start the server, then run from the project_weather_app directory:
+    python main.py --mode MOCK --mock-locations 1000
+    python main.py --mode MOCK --read-server
+    python load_test.py --mock-locations 1000 --connections 16 --duration 10
+--hot N only requests N of the locations, to measure the responses from the cache.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+from location import Location, read_locations_file
+from mock_data import make_locations
+
+# percentiles of the latencies in the report
+PERCENTILES = (50, 90, 99, 99.9)
+
+async def read_response(reader: asyncio.StreamReader):
+    """
+    Read a response, and get its status code and the length of its body.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by the server.")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding") == "chunked":
+        size = 0
+        while True:
+            chunk_size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(chunk_size + 2)
+            size += chunk_size
+            if chunk_size == 0:
+                break
+    else:
+        size = int(headers.get("content-length", 0))
+        await reader.readexactly(size)
+    return status, size, headers.get("connection", "").lower() == "close"
+
+async def run_connection(host: str, port: int, paths, end_time: float, results: dict, headers: str,
+                         record_time: float):
+    """
+    Send requests on one keep-alive connection until end_time,
+    reconnecting if the server closes the connection.
+    Only the requests from record_time are counted.
+    """
+    reader = writer = None
+    while time.perf_counter() < end_time:
+        path = random.choice(paths)
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(("GET " + path + " HTTP/1.1\r\nHost: " + host + "\r\n" + headers + "\r\n").encode())
+            status, size, close = await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            if start >= record_time:
+                results["errors"] += 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        if start >= record_time:
+            results["latencies"].append(time.perf_counter() - start)
+            results["bytes"] += size
+            if status != 200:
+                results["errors"] += 1
+        if close:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+def get_paths(locations, endpoint: str, response_format: str, variables: str, start: str, end: str):
+    """
+    Get the request paths of the locations.
+    """
+    paths = []
+    for location in locations:
+        params = {"lat": location.get_latitude(), "lon": location.get_longitude()}
+        if variables:
+            params["vars" if endpoint == "forecast" else "agg"] = variables
+        if start:
+            params["start"] = start
+        if end:
+            params["end"] = end
+        if response_format != "json":
+            params["format"] = response_format
+        paths.append("/" + endpoint + "?" + urlencode(params))
+    return paths
+
+async def load_test(url: str, paths, connections: int, duration: float, use_gzip: bool,
+                    warmup: float = 0) -> dict:
+    """
+    Run the load test, and get the latencies and counters.
+    The requests of the first warmup seconds (e.g. filling the cache of the server) are not counted.
+    """
+    split = urlsplit(url)
+    headers = "Accept-Encoding: gzip\r\n" if use_gzip else ""
+    results = {"latencies": [], "errors": 0, "bytes": 0}
+    record_time = time.perf_counter() + warmup
+    end_time = record_time + duration
+    await asyncio.gather(*[run_connection(split.hostname, split.port or 80, paths, end_time, results, headers,
+                                          record_time)
+                           for _ in range(connections)])
+    results["elapsed"] = time.perf_counter() - record_time
+    return results
+
+def report(results: dict) -> dict:
+    """
+    Get the summary of the results: requests per second and latency percentiles in ms.
+    """
+    latencies = np.array(results["latencies"]) * 1000
+    summary = {"requests": len(latencies),
+               "errors": results["errors"],
+               "requests_per_second": len(latencies) / results["elapsed"],
+               "mb_per_second": results["bytes"] / results["elapsed"] / 1e6}
+    if len(latencies):
+        for percentile in PERCENTILES:
+            summary["p" + str(percentile) + "_ms"] = float(np.percentile(latencies, percentile))
+        summary["max_ms"] = float(latencies.max())
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the read server.")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="url of the server (default: http://127.0.0.1:8080)")
+    parser.add_argument("--endpoint", choices=["forecast", "rollup"], default="forecast")
+    parser.add_argument("--locations-file", help="csv file of the locations to request")
+    parser.add_argument("--mock-locations", type=int,
+                        help="request the locations generated by main.py --mode MOCK --mock-locations N")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the mocked locations (default: 0)")
+    parser.add_argument("--lon", type=float, default=13.41, help="location without a locations file")
+    parser.add_argument("--lat", type=float, default=52.52, help="location without a locations file")
+    parser.add_argument("--hot", type=int,
+                        help="only request this many of the locations, so the responses are cached")
+    parser.add_argument("--vars", help="vars of /forecast or agg of /rollup (comma separated)")
+    parser.add_argument("--start", help="start time of the requested data (isoformat)")
+    parser.add_argument("--end", help="end time of the requested data (isoformat)")
+    parser.add_argument("--format", choices=["json", "arrow"], default="json")
+    parser.add_argument("--gzip", action="store_true", help="accept gzip compressed responses")
+    parser.add_argument("--connections", type=int, default=16, help="concurrent connections (default: 16)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run (default: 10)")
+    parser.add_argument("--warmup", type=float, default=1,
+                        help="seconds of requests before the measured duration (default: 1)")
+    parser.add_argument("--output", help="json file for the summary")
+    args = parser.parse_args()
+
+    if args.locations_file:
+        locations = read_locations_file(args.locations_file)
+    elif args.mock_locations:
+        locations = make_locations(args.mock_locations, seed=args.seed)
+    else:
+        locations = [Location(args.lon, args.lat)]
+    if args.hot:
+        locations = locations[:args.hot]
+    paths = get_paths(locations, args.endpoint, args.format, args.vars, args.start, args.end)
+    results = asyncio.run(load_test(args.url, paths, args.connections, args.duration, args.gzip, args.warmup))
+    summary = report(results)
+    for name, value in summary.items():
+        print(f"{name:<22} {value:>12.3f}" if isinstance(value, float) else f"{name:<22} {value:>12}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,11 @@
 A Location object is used to store the location data,
 such as the longitude and the latitude of a location.
 """
+import csv
+from typing import List, Tuple
+from util import get_file_path
+from exception import LocationsFileError
+
 class Location():
     def __init__(self, longitude, latitude) -> None:
         self._longitude = longitude
@@ -9,4 +14,39 @@ class Location():
     def get_longitude(self):
         return self._longitude
     def get_latitude(self):
-        return self._latitude
\ No newline at end of file
+        return self._latitude
+
+def read_locations_file(locations_filename: str) -> List[Location]:
+    """
+    read_locations_file() gets the locations from locations_filename,
+    which is a csv file with a longitude and a latitude on each line.
+    A header line "longitude,latitude", empty lines and lines starting with "#" are skipped.
+    """
+    return [location for location, _ in read_location_intervals(locations_filename)]
+
+def read_location_intervals(locations_filename: str,
+                            default_interval: float = None) -> List[Tuple[Location, float]]:
+    """
+    read_location_intervals() gets the locations and their refresh intervals from
+    locations_filename, like read_locations_file(), with an optional third column
+    of the refresh interval in seconds. Without it, the interval is default_interval.
+    """
+    filepath = get_file_path(locations_filename, calling_file = __file__)
+
+    locations = []
+    try:
+        with open(filepath, newline="") as f:
+            for row in csv.reader(f):
+                if not row or row[0].strip().startswith("#"):
+                    continue
+                if row[0].strip().lower() == "longitude":
+                    continue
+                interval = float(row[2]) if len(row) > 2 and row[2].strip() else default_interval
+                locations.append((Location(longitude=float(row[0]), latitude=float(row[1])), interval))
+    except FileNotFoundError as err:
+        raise LocationsFileError("Locations file not found.",
+                                 filepath, err)
+    except (ValueError, IndexError) as err:
+        raise LocationsFileError("Locations file has an invalid line.",
+                                 filepath, err)
+    return locations
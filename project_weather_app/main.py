@@ -4,17 +4,21 @@ and processes the data.
 """
 import argparse
 import logging
+import os
+import signal
 
 # From this project:
-from database import WeatherDatabase
-from data_handler import DataHandler
-from data_service import DataServiceFactory
-from location import Location
-import visualization_handler as vh
-from util import logger_setup
+# Only the light modules are imported here. The modules of the storages, the data
+# services, the plots and the servers load numpy, pandas, requests or matplotlib,
+# so they are imported by the commands that use them, for a fast start.
+from location import Location, read_locations_file, read_location_intervals
+import read_config as rc
+from util import get_file_path, logger_setup
 import exception as e
+import metrics
 
 MODE = "API" # data retrieval mode: ["API"|"MOCK"]
+STORAGE = "SQLITE" # storage of the weather data: ["SQLITE"|"COLUMNAR"]
 
 # This is the default location for weather data retrieval and visualization.
 # Location: from API documtation page: https://open-meteo.com/en/docs
@@ -25,6 +29,27 @@ LATITUDE = 52.52
 # LONGITUDE = -122.431297 # "longitude": -122.431297,
 # LATITUDE = 37.773972    # "latitude": 37.773972,
 
+# Policy for downloaded records that are already in the database: ["update"|"ignore"]
+# "update" overwrites the stored record with the newer forecast.
+ON_CONFLICT = "update"
+
+# Keep the daily summary table for WeatherDatabase.rollup() up to date on insert
+SUMMARY_TABLES = False
+
+# Mocked data: hours of data per location, and the seed of the random data
+MOCK_HOURS = 168 # 24 hours * 7 days
+SEED = 0
+
+# Downsampling of long series for the plot: ["lttb"|"minmax"|"query"|"none"]
+# "query" decimates in the database query instead of after it.
+DECIMATION = "lttb"
+
+# Resolution of the saved plots, in dots per inch
+PLOT_DPI = 100
+
+# Number of functions in the cProfile stats of --cprofile
+CPROFILE_TOP = 25
+
 # Logging level
 LOG_LEVEL = logging.INFO
 
@@ -32,6 +57,10 @@ LOG_LEVEL = logging.INFO
 DATA_SOURCE = "config/config.json" # config file for data service
 API_DB_FILE = "data/weather_api.db" # database file location
 MOCKED_DB_FILE = "data/weather_mocked.db"
+API_STORE_DIR = "data/weather_api_columnar" # columnar store locations
+MOCKED_STORE_DIR = "data/weather_mocked_columnar"
+API_STATE_FILE = "data/scheduler_state_api.json" # scheduler state of --serve
+MOCKED_STATE_FILE = "data/scheduler_state_mocked.json"
 LOG_FILE = "log/weather_app.log"
 
 def main():
@@ -42,9 +71,91 @@ def main():
     # setup the parser
     parser = argparse.ArgumentParser()
     parser.add_argument("--mode", help="program mode: API or MOCK")
+    parser.add_argument("--storage", default=STORAGE,
+                        help="storage of the weather data: SQLITE or COLUMNAR (default: " + STORAGE + ")")
     parser.add_argument("--reset", action="store_true", 
                         help="Reset the database by deleting all records before downloading data.")
+    parser.add_argument("--locations-file",
+                        help="Download data for all locations in this csv file (longitude,latitude per line) without plotting.")
+    parser.add_argument("--config", default=DATA_SOURCE,
+                        help="config file for the data service (default: " + DATA_SOURCE + ")")
+    parser.add_argument("--export",
+                        help="Export the database to this .csv, .parquet or .arrow file, and exit.")
+    parser.add_argument("--chunk-rows", type=int, default=100000,
+                        help="records per chunk for --export (default: 100000)")
+    parser.add_argument("--mock-locations", type=int,
+                        help="MOCK mode: generate data for this many random locations and bulk load it, without plotting.")
+    parser.add_argument("--mock-hours", type=int, default=MOCK_HOURS,
+                        help="MOCK mode: hours of data per location (default: " + str(MOCK_HOURS) + ")")
+    parser.add_argument("--seed", type=int, default=SEED,
+                        help="MOCK mode: seed of the random data and locations (default: " + str(SEED) + ")")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time the stages of the program, and log the time spent in each stage at the end.")
+    parser.add_argument("--cprofile",
+                        help="Profile the program with cProfile, save the stats to this file and log the top functions.")
+    parser.add_argument("--metrics-file",
+                        help="Write the metrics of the stages to this file at the end, as json (.json) or Prometheus text.")
+    parser.add_argument("--serve", "--daemon", action="store_true",
+                        help="Keep running and refresh the data of the locations (--locations-file, "
+                             "with an optional third column of the interval in seconds, or the default location) "
+                             "on a schedule, until SIGINT or SIGTERM.")
+    parser.add_argument("--no-plot", action="store_true",
+                        help="Print the data of the location without plotting it (matplotlib is not loaded).")
+    parser.add_argument("--plot-file",
+                        help="Save the plot to this .png or .svg file without a window, instead of showing it.")
+    parser.add_argument("--plot-dir",
+                        help="With --locations-file or --mock-locations: save a plot of each location to this directory, "
+                             "rendered in a pool of processes.")
+    parser.add_argument("--plot-processes", type=int,
+                        help="processes of --plot-dir (default: one per cpu)")
+    parser.add_argument("--decimate", default=DECIMATION, choices=["lttb", "minmax", "query", "none"],
+                        help="downsampling of long series to about one point per pixel of the plot: "
+                             "lttb or minmax before plotting, query to decimate (min/max) in the database "
+                             "query, or none (default: " + DECIMATION + ")")
+    parser.add_argument("--plot-width", type=int,
+                        help="points per series of the decimated plot (default: the width of the plot in pixels)")
+    parser.add_argument("--read-server", action="store_true",
+                        help="Serve the stored data over HTTP (/forecast and /rollup, see the \"read_server\" "
+                             "section of the config file) until SIGINT or SIGTERM, without downloading.")
+    parser.add_argument("--nearest", type=int,
+                        help="With --locations-file: print the N stored locations nearest to each location "
+                             "in the file (and their distances in km), without downloading.")
     args = parser.parse_args()
+
+    # the metrics are only collected when they are reported
+    if args.profile or args.metrics_file:
+        metrics.enable()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            cprofile_file = get_file_path(args.cprofile, calling_file=__file__)
+            profiler.dump_stats(cprofile_file)
+            import io
+            import pstats
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(CPROFILE_TOP)
+            logger.info("cProfile stats saved to " + str(cprofile_file) + "\n" + stream.getvalue())
+        if args.profile:
+            logger.info("Time spent in each stage:\n" + metrics.get_registry().format_breakdown())
+        if args.metrics_file:
+            metrics_file = metrics.write_metrics(args.metrics_file)
+            logger.info("Metrics written to " + str(metrics_file))
+
+    # print("Program finished.")
+    logger.info("Program finished.")
+
+def run(args):
+    """
+    Run the program with the parsed command line arguments.
+    """
+    logger = logging.getLogger()
     if args.mode:
         mode = args.mode
         logger.info("Using command line mode: " + str(mode))
@@ -54,30 +165,202 @@ def main():
 
     # select database file based on the mode
     if mode.upper() == "API":
-        logger.info("Database: " + str(API_DB_FILE))
-        db_file = API_DB_FILE
+        db_file, store_dir, state_file = API_DB_FILE, API_STORE_DIR, API_STATE_FILE
     elif mode.upper() == "MOCK":
-        logger.info("Database: " + str(MOCKED_DB_FILE))
-        db_file = MOCKED_DB_FILE
+        db_file, store_dir, state_file = MOCKED_DB_FILE, MOCKED_STORE_DIR, MOCKED_STATE_FILE
     else:
         raise e.ModeError("Mode error.", mode)
 
     # create database object for accessing the stored weather data
-    db = WeatherDatabase(db_file)
+    if args.storage.upper() == "SQLITE":
+        from database import WeatherDatabase
+        logger.info("Database: " + str(db_file))
+        db_config = rc.get_database_config(args.config)
+        db = WeatherDatabase(db_file, on_conflict=ON_CONFLICT, summaries=SUMMARY_TABLES,
+                             pragmas=db_config["pragmas"],
+                             grid_resolution=db_config["grid_resolution"])
+    elif args.storage.upper() == "COLUMNAR":
+        from columnar_store import ColumnarWeatherStore
+        logger.info("Columnar store: " + str(store_dir))
+        db = ColumnarWeatherStore(store_dir, on_conflict=ON_CONFLICT)
+    else:
+        raise e.ModeError("Storage error.", args.storage)
     if args.reset:
         logger.info("reset the database....")
         db.reset()
 
+    if args.export:
+        from export import export
+        export(db, args.export, chunk_rows=args.chunk_rows)
+        return
+
+    if args.read_server:
+        serve_reads(args, db)
+        return
+
+    # setup the in-memory cache in front of the database
+    cache_config = rc.get_cache_config(args.config)
+    cache = None
+    if cache_config.pop("enabled"):
+        from cache import ForecastCache
+        cache = ForecastCache(**cache_config)
+
     # setup the data_service and data_handler
-    data_service = DataServiceFactory(DATA_SOURCE, database=db, mode=mode).create()    
-    data_handler = DataHandler(data_service, vh.VisualizationHandler())
+    from data_service import DataServiceFactory
+    data_service = DataServiceFactory(args.config, database=db, mode=mode, cache=cache,
+                                      seed=args.seed, mock_hours=args.mock_hours).create()
+    try:
+        handle_data(args, data_service, db, mode, state_file)
+    finally:
+        # write the queued data to the database
+        data_service.close()
+
+def handle_data(args, data_service, db, mode: str, state_file: str):
+    """
+    Download, print and plot the data as selected by the command line arguments.
+    """
+    logger = logging.getLogger()
+    if args.serve:
+        serve(args, data_service, db, state_file)
+    elif args.mock_locations and mode.upper() == "MOCK":
+        # generate data for many locations, e.g. to load test the database
+        from mock_data import make_locations
+        locations = make_locations(args.mock_locations, seed=args.seed)
+        logger.info("Generating data for " + str(len(locations)) + " locations.")
+        data_service.download_many(locations)
+        data_service.print_status()
+        if args.plot_dir:
+            plot_locations(data_service, locations, args.plot_dir, args)
+    elif args.locations_file and args.nearest:
+        # look up the stored locations nearest to the locations in the file
+        locations = read_locations_file(args.locations_file)
+        nearest = db.nearest_locations(locations, args.nearest)
+        nearest.insert(0, "query_latitude", [locations[i].get_latitude() for i in nearest["query"]])
+        nearest.insert(0, "query_longitude", [locations[i].get_longitude() for i in nearest["query"]])
+        print(nearest.drop(columns="query").to_string(index=False))
+    elif args.locations_file:
+        # refresh the data for all locations in the file, once for nearby locations
+        locations = snap_locations(data_service, read_locations_file(args.locations_file))
+        logger.info("Downloading data for " + str(len(locations)) + " locations.")
+        data_service.download_many(locations)
+        data_service.print_status()
+        if args.plot_dir:
+            plot_locations(data_service, locations, args.plot_dir, args)
+    else:
+        # handle the data for the given location
+        from data_handler import DataHandler
+        decimation, query_buckets = get_decimation(args)
+        if args.no_plot:
+            visualization_handler = None
+        elif args.plot_file:
+            import visualization_handler as vh
+            visualization_handler = vh.HeadlessVisualizationHandler(args.plot_file, decimation=decimation,
+                                                                    width=args.plot_width)
+        else:
+            import visualization_handler as vh
+            visualization_handler = vh.VisualizationHandler(decimation=decimation, width=args.plot_width)
+        data_handler = DataHandler(data_service, visualization_handler, query_buckets=query_buckets)
+        location = Location(longitude=LONGITUDE, latitude=LATITUDE)
+        data_handler.execute(location)
 
-    # handle the data for the given location
-    location = Location(longitude=LONGITUDE, latitude=LATITUDE)
-    data_handler.execute(location)
+def snap_locations(data_service, locations):
+    """
+    Get the locations to download for a list of locations: the stored location within
+    the snap distance of each location, and one location for new locations near each other
+    (see IDataService.resolve_locations()).
+    """
+    resolved = list(dict.fromkeys(data_service.resolve_locations(locations)))
+    if len(resolved) < len(locations):
+        logging.getLogger().info("Merged " + str(len(locations)) + " locations within the snap distance into "
+                                 + str(len(resolved)) + " locations.")
+    return resolved
 
-    # print("Program finished.")
-    logger.info("Program finished.")
+def get_decimation(args):
+    """
+    Get the decimation of the plot handler, and the buckets of the decimating
+    database query (or None), from the command line arguments.
+    """
+    if args.decimate == "none":
+        return None, None
+    if args.decimate == "query":
+        from visualization_handler import FIGURE_WIDTH
+        return None, args.plot_width or FIGURE_WIDTH * PLOT_DPI
+    return args.decimate, None
+
+def plot_locations(data_service, locations, plot_dir: str, args):
+    """
+    Save a plot of the data of each location to plot_dir, named by its longitude and latitude.
+    """
+    import visualization_handler as vh
+    logger = logging.getLogger()
+    os.makedirs(plot_dir, exist_ok=True)
+    decimation, query_buckets = get_decimation(args)
+    plots = [(os.path.join(plot_dir, "weather_" + str(location.get_longitude()) + "_"
+                           + str(location.get_latitude()) + ".png"),
+              data_service.get_data_from_db(location, query_buckets))
+             for location in locations]
+    with metrics.timer("plot"):
+        filenames = vh.render_many(plots, processes=args.plot_processes, dpi=PLOT_DPI,
+                                   decimation=decimation, width=args.plot_width)
+    logger.info("Saved " + str(len(filenames)) + " plots to " + str(plot_dir))
+
+def serve(args, data_service, db, state_file: str):
+    """
+    Refresh the data of the locations on a schedule until SIGINT or SIGTERM,
+    then finish the running downloads and save the schedule.
+    """
+    from data_handler import DataHandler
+    from scheduler import Scheduler
+    logger = logging.getLogger()
+    scheduler_config = rc.get_scheduler_config(args.config)
+    if args.locations_file:
+        schedule = read_location_intervals(args.locations_file, scheduler_config["interval"])
+        # nearby locations are refreshed as one, on the shortest of their intervals
+        intervals = {}
+        for location, interval in zip(data_service.resolve_locations([location for location, _ in schedule]),
+                                      (interval for _, interval in schedule)):
+            intervals[location] = min(interval, intervals.get(location, interval))
+        if len(intervals) < len(schedule):
+            logger.info("Merged " + str(len(schedule)) + " locations within the snap distance into "
+                        + str(len(intervals)) + " locations.")
+        schedule = list(intervals.items())
+    else:
+        schedule = [(Location(longitude=LONGITUDE, latitude=LATITUDE), scheduler_config["interval"])]
+    scheduler = Scheduler(DataHandler(data_service, None), db,
+                          max_workers=scheduler_config["max_workers"],
+                          jitter=scheduler_config["jitter"],
+                          retry_interval=scheduler_config["retry_interval"],
+                          state_file=state_file,
+                          save_interval=scheduler_config["save_interval"])
+    for location, interval in schedule:
+        scheduler.add(location, interval)
+
+    def handle_signal(signum, frame):
+        logger.info("Received signal " + signal.Signals(signum).name + ", shutting down.")
+        scheduler.stop()
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    scheduler.run()
+
+def serve_reads(args, db):
+    """
+    Serve the stored data over HTTP until SIGINT or SIGTERM.
+    """
+    import asyncio
+    from read_server import ReadServer
+    server = ReadServer(db, snap_distance=rc.get_database_config(args.config)["snap_distance"],
+                        **rc.get_read_server_config(args.config))
+
+    async def run_server():
+        await server.start()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        logging.getLogger().info("Received a signal, shutting down.")
+        await server.stop()
+    asyncio.run(run_server())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,246 @@
+"""
+Timers, counters and gauges for the stages of the program (download, decode, insert, query,
+dataframe build and plot), with a Prometheus text or json dump and a per-stage breakdown.
+Metrics are disabled by default; then timer() returns a shared no-op context manager
+and count() returns at once, so the instrumented code runs at almost full speed.
+Usage:
+    with metrics.timer("fetch"):
+        r = client.get(url, params)
+    metrics.count("bytes_downloaded", len(r.content))
+    metrics.gauge("write_queue_depth", queue.qsize())
+"""
+import json
+import threading
+import time
+
+from util import get_file_path
+
+# upper bounds of the histogram buckets of the stage durations, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# prefix of the names of the Prometheus metrics
+PREFIX = "weather_"
+
+class Histogram():
+    def __init__(self):
+        """
+        The distribution of the durations of a stage.
+        """
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1) # the last bucket is +Inf
+
+    def observe(self, seconds: float):
+        """
+        Add a duration. Called with the lock of the registry.
+        """
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+class MetricsRegistry():
+    def __init__(self):
+        """
+        The histograms of the stage durations, the counters, and the gauges.
+        """
+        self.enabled = False
+        self._histograms = {} # stage -> Histogram
+        self._counters = {}   # name -> value
+        self._gauges = {}     # name -> (last value, max value)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Add a duration of a stage.
+        """
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, value: float = 1):
+        """
+        Add value to a counter.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        """
+        Set the value of a gauge, and keep its maximum.
+        """
+        with self._lock:
+            maximum = self._gauges.get(name, (value, value))[1]
+            self._gauges[name] = (value, max(maximum, value))
+
+    def reset(self):
+        """
+        Remove all histograms and counters.
+        """
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+            self._start = time.perf_counter()
+
+    def to_dict(self) -> dict:
+        """
+        Get the metrics as a dict, for the json dump.
+        """
+        with self._lock:
+            return {
+                "elapsed_seconds": time.perf_counter() - self._start,
+                "stages": {stage: {"count": histogram.count,
+                                   "sum_seconds": histogram.sum,
+                                   "max_seconds": histogram.max,
+                                   "buckets": dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"],
+                                                       histogram.buckets))}
+                           for stage, histogram in sorted(self._histograms.items())},
+                "counters": dict(sorted(self._counters.items())),
+                "gauges": {name: {"value": value, "max": maximum}
+                           for name, (value, maximum) in sorted(self._gauges.items())},
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Get the metrics in the Prometheus text exposition format.
+        """
+        name = PREFIX + "stage_duration_seconds"
+        lines = ["# HELP " + name + " Duration of the stages of the program.",
+                 "# TYPE " + name + " histogram"]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, n in zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram.buckets):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+            for counter, value in sorted(self._counters.items()):
+                lines.append("# TYPE " + PREFIX + counter + "_total counter")
+                lines.append(PREFIX + counter + "_total " + str(value))
+            for gauge, (value, maximum) in sorted(self._gauges.items()):
+                lines.append("# TYPE " + PREFIX + gauge + " gauge")
+                lines.append(PREFIX + gauge + " " + str(value))
+                lines.append("# TYPE " + PREFIX + gauge + "_max gauge")
+                lines.append(PREFIX + gauge + "_max " + str(maximum))
+        return "\n".join(lines) + "\n"
+
+    def format_breakdown(self) -> str:
+        """
+        Get a table of the time spent in each stage, and the counters.
+        Stages may be nested (e.g. "dataframe" in "query") or run in several threads at once
+        (e.g. "fetch"), so the shares of the elapsed time can add up to more than 100%.
+        """
+        metrics = self.to_dict()
+        elapsed = metrics["elapsed_seconds"]
+        lines = [f"{'stage':<12} {'count':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'share':>7}"]
+        for stage, histogram in metrics["stages"].items():
+            mean = histogram["sum_seconds"] / histogram["count"]
+            lines.append(f"{stage:<12} {histogram['count']:>7} {histogram['sum_seconds']:>9.3f} "
+                         f"{mean * 1000:>9.2f} {histogram['max_seconds'] * 1000:>9.2f} "
+                         f"{histogram['sum_seconds'] / elapsed:>7.1%}")
+        lines.append(f"{'elapsed':<12} {'':>7} {elapsed:>9.3f}")
+        for counter, value in metrics["counters"].items():
+            lines.append(f"{counter:<20} {value:>12}")
+        for gauge, values in metrics["gauges"].items():
+            lines.append(f"{gauge:<20} {values['value']:>12} (max {values['max']})")
+        return "\n".join(lines)
+
+class _Timer():
+    def __init__(self, stage: str):
+        """
+        Context manager that adds its duration to the histogram of the stage.
+        """
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _registry.observe(self._stage, time.perf_counter() - self._start)
+        return False
+
+class _NullTimer():
+    """
+    Context manager that does nothing, for disabled metrics.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_registry = MetricsRegistry()
+_NULL_TIMER = _NullTimer()
+
+def enable():
+    """
+    Enable the metrics, and start the elapsed time.
+    """
+    _registry.reset()
+    _registry.enabled = True
+
+def disable():
+    """
+    Disable the metrics. The collected metrics are kept.
+    """
+    _registry.enabled = False
+
+def is_enabled() -> bool:
+    return _registry.enabled
+
+def timer(stage: str):
+    """
+    Get a context manager that times a stage.
+    """
+    if not _registry.enabled:
+        return _NULL_TIMER
+    return _Timer(stage)
+
+def observe(stage: str, seconds: float):
+    """
+    Add a duration measured by the caller to the histogram of a stage.
+    """
+    if _registry.enabled:
+        _registry.observe(stage, seconds)
+
+def count(name: str, value: float = 1):
+    """
+    Add value to a counter.
+    """
+    if _registry.enabled:
+        _registry.count(name, value)
+
+def gauge(name: str, value: float):
+    """
+    Set the value of a gauge.
+    """
+    if _registry.enabled:
+        _registry.gauge(name, value)
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+def write_metrics(filename: str):
+    """
+    Write the metrics to a file, as json if filename ends with .json,
+    else in the Prometheus text format.
+    Returns the complete path of the file.
+    """
+    filepath = get_file_path(filename, calling_file=__file__)
+    with open(filepath, "w") as f:
+        if str(filename).lower().endswith(".json"):
+            json.dump(_registry.to_dict(), f, indent=2)
+        else:
+            f.write(_registry.to_prometheus())
+    return filepath
@@ -0,0 +1,124 @@
+"""
+The MockWeatherGenerator object generates synthetic hourly weather data
+for the mocked data service, and for load testing the rest of the program.
+The data of each location is seeded by the seed and the location, so it is
+reproducible, and it is drawn for all hours at once with numpy.
+The measures have a daily cycle in the local solar time of the location,
+and follow the weather of the previous hours (autoregressive noise).
+"""
+import datetime
+from typing import List
+
+import numpy as np
+
+from location import Location
+from decode import MEASURES
+
+# autocorrelation of the hourly noise
+WETNESS_AUTOCORRELATION = 0.95  # slowly changing weather systems
+WIND_AUTOCORRELATION = 0.8      # gusts
+
+class MockWeatherGenerator():
+    def __init__(self, seed: int = 0, hours: int = 168, start: datetime.datetime = None):
+        """
+        Create the generator of hours of data (by default 7 days) for each location,
+        from the start time (UTC), by default the hours up to the current hour.
+        The same seed gives the same data for a location.
+        """
+        self._seed = seed
+        self._hours = hours
+        if start is None:
+            start = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) \
+                - datetime.timedelta(hours=hours - 1)
+        self._start = np.datetime64(start, "h")
+
+    def get_time(self) -> np.ndarray:
+        """
+        Get the hourly times of the generated data.
+        """
+        return (self._start + np.arange(self._hours)).astype("datetime64[m]")
+
+    def _get_rng(self, location: Location) -> np.random.Generator:
+        """
+        Get the random generator of a location, seeded by the seed and the location
+        (rounded to 4 decimal places).
+        """
+        return np.random.default_rng([self._seed,
+                                      int(round((location.get_longitude() + 180) * 1e4)),
+                                      int(round((location.get_latitude() + 90) * 1e4))])
+
+    def generate(self, locations: List[Location]) -> dict:
+        """
+        Generate the data of the locations.
+        Returns a dict with the time array of the hours, and an array
+        of shape (number of locations, hours) for each measure.
+        """
+        n, hours = len(locations), self._hours
+        longitude = np.array([location.get_longitude() for location in locations], dtype=np.float64)
+        latitude = np.array([location.get_latitude() for location in locations], dtype=np.float64)
+        # the random draws of each location, from its own generator
+        noise = np.empty((n, 3, hours))
+        wind_mean = np.empty(n)
+        for i, location in enumerate(locations):
+            rng = self._get_rng(location)
+            noise[i, :2] = rng.standard_normal((2, hours))
+            noise[i, 2] = rng.gamma(0.8, 0.05, hours)
+            wind_mean[i] = rng.lognormal(np.log(8.0), 0.3)
+        wetness = _autoregressive(noise[:, 0], WETNESS_AUTOCORRELATION)
+        gusts = _autoregressive(noise[:, 1], WIND_AUTOCORRELATION)
+
+        # local solar time of each hour, in hours
+        utc_hour = (self.get_time().astype("datetime64[h]").astype(np.int64) % 24).astype(np.float64)
+        local_hour = (utc_hour[np.newaxis, :] + longitude[:, np.newaxis] / 15) % 24
+        # the tropics are wetter, and showers peak in the afternoon
+        climate = np.cos(np.radians(latitude))[:, np.newaxis] - 0.7
+        afternoon = np.sin(2 * np.pi * (local_hour - 9) / 24)
+        latent = 1.5 * wetness + climate + 0.5 * afternoon
+        probability = 100 / (1 + np.exp(-latent))
+        # it rains in the wettest hours, more when it is wetter
+        precipitation = np.where(latent > 0.5, noise[:, 2] * latent, 0.0)
+        # the wind is strongest in the early afternoon
+        wind = wind_mean[:, np.newaxis] * (1 + 0.3 * np.sin(2 * np.pi * (local_hour - 8) / 24)
+                                           + 0.25 * gusts)
+        return {
+            "time": self.get_time(),
+            "precipitation_probability": np.round(probability),
+            "precipitation": np.round(precipitation, 3),
+            "wind_speed_10m": np.round(np.maximum(wind, 0), 1),
+        }
+
+    def iter_forecasts(self, locations: List[Location], chunk_locations: int = 1000):
+        """
+        Iterate over (location, data) for the locations, generating chunk_locations
+        locations at a time. data is a dict of the time and measure arrays,
+        which can be inserted with IWeatherStorage.insert_records().
+        """
+        for first in range(0, len(locations), chunk_locations):
+            chunk = locations[first:first + chunk_locations]
+            data = self.generate(chunk)
+            for i, location in enumerate(chunk):
+                yield location, {"time": data["time"],
+                                 **{measure: data[measure][i] for measure in MEASURES}}
+
+def _autoregressive(noise: np.ndarray, phi: float) -> np.ndarray:
+    """
+    Filter standard normal noise of shape (locations, hours) into an AR(1) series
+    along the hours, with autocorrelation phi and a standard deviation of 1.
+    """
+    values = np.empty_like(noise)
+    values[:, 0] = noise[:, 0]
+    scale = np.sqrt(1 - phi ** 2)
+    # one step per hour, for all locations at once
+    for t in range(1, noise.shape[1]):
+        values[:, t] = phi * values[:, t - 1] + scale * noise[:, t]
+    return values
+
+def make_locations(n: int, seed: int = 0) -> List[Location]:
+    """
+    Make n random locations, between latitudes -60 and 70 degrees,
+    rounded to 4 decimal places.
+    """
+    rng = np.random.default_rng(seed)
+    longitude = np.round(rng.uniform(-180, 180, n), 4)
+    latitude = np.round(rng.uniform(-60, 70, n), 4)
+    return [Location(longitude=lon, latitude=lat) for lon, lat in zip(longitude.tolist(), latitude.tolist())]
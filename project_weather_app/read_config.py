@@ -35,3 +35,149 @@ def get_config(config_filename: str) -> Tuple[str, dict]:
         raise ConfigFileError("Config file exception error.", 
                               filepath, err)
     return url, payload
+
+# defaults for the "fetch" section of the config file
+DEFAULT_FETCH_CONFIG = {
+    "max_workers": 8,           # maximum number of concurrent requests
+    "batch_size": 1,            # number of locations in a request
+    "requests_per_second": 10,  # rate limit per host
+    "retries": 3,               # retries of a failed request
+    "backoff_factor": 0.5,      # a retry waits backoff_factor * 2**attempt seconds
+    "timeout": 30,              # timeout of a request in seconds
+    "refresh_interval": 3600,   # seconds until downloaded data is stale
+    "forecast_days": 7,         # days of forecast to download
+    "coalesce_timeout": 120,    # seconds a caller waits for the download of the same location by another caller
+}
+
+def get_fetch_config(config_filename: str) -> dict:
+    """
+    get_fetch_config() gets the settings for downloading data
+    from the "fetch" section of config_filename.
+    Settings missing from the config file have the values of DEFAULT_FETCH_CONFIG.
+    """
+    return _get_section(config_filename, "fetch", DEFAULT_FETCH_CONFIG)
+
+# defaults for the "cache" section of the config file
+DEFAULT_CACHE_CONFIG = {
+    "enabled": False,   # use the in-memory cache in front of the database
+    "max_entries": 128, # maximum number of cached dataframes
+    "ttl": 3600,        # seconds until a cached dataframe expires
+    "precision": 4,     # decimal places of the rounded location in the cache key
+}
+
+def get_cache_config(config_filename: str) -> dict:
+    """
+    get_cache_config() gets the settings of the in-memory cache
+    from the "cache" section of config_filename.
+    Settings missing from the config file have the values of DEFAULT_CACHE_CONFIG.
+    """
+    return _get_section(config_filename, "cache", DEFAULT_CACHE_CONFIG)
+
+# defaults for the "database" section of the config file
+DEFAULT_DATABASE_CONFIG = {
+    "grid_resolution": 0.0001,  # degrees of the grid cells of the stored locations
+    "pragmas": {},              # sqlite pragmas, in addition to connection.DEFAULT_PRAGMAS
+    "snap_distance": 0.0,       # km within which a location uses the nearest stored location (0: off)
+}
+
+def get_database_config(config_filename: str) -> dict:
+    """
+    get_database_config() gets the grid resolution of the locations, the snap distance
+    of the nearest stored location, and the sqlite pragmas of the database connections
+    from the "database" section of config_filename.
+    Settings missing from the config file have the values of DEFAULT_DATABASE_CONFIG.
+    """
+    return _get_section(config_filename, "database", DEFAULT_DATABASE_CONFIG)
+
+# defaults for the "http_cache" section of the config file
+DEFAULT_HTTP_CACHE_CONFIG = {
+    "enabled": False,                  # keep the API responses in a persistent cache
+    "file": "data/http_cache.db",      # sqlite file of the cache
+    "compression": "zstd",             # "zstd" (needs the zstandard package, else gzip) or "gzip"
+    "max_entries": 10000,              # maximum number of stored responses
+    "model_run_interval": 10800,       # seconds between the runs of the forecast model
+    "model_run_delay": 7200,           # seconds from the start of a model run until it is available
+}
+
+def get_http_cache_config(config_filename: str) -> dict:
+    """
+    get_http_cache_config() gets the settings of the persistent cache of the API responses
+    from the "http_cache" section of config_filename.
+    Settings missing from the config file have the values of DEFAULT_HTTP_CACHE_CONFIG.
+    """
+    return _get_section(config_filename, "http_cache", DEFAULT_HTTP_CACHE_CONFIG)
+
+# defaults for the "write_behind" section of the config file
+DEFAULT_WRITE_BEHIND_CONFIG = {
+    "enabled": True,            # write the downloaded data in a writer thread, in group commits
+    "max_queue": 64,            # forecasts queued before the downloads wait for the writer
+    "commit_rows": 50000,       # records of a group commit
+    "commit_interval": 0.5,     # seconds of queued forecasts in a group commit
+}
+
+def get_write_behind_config(config_filename: str) -> dict:
+    """
+    get_write_behind_config() gets the settings of the queue between the downloads
+    and the database writes from the "write_behind" section of config_filename.
+    Settings missing from the config file have the values of DEFAULT_WRITE_BEHIND_CONFIG.
+    """
+    return _get_section(config_filename, "write_behind", DEFAULT_WRITE_BEHIND_CONFIG)
+
+# defaults for the "scheduler" section of the config file, for --serve
+DEFAULT_SCHEDULER_CONFIG = {
+    "interval": 3600,       # seconds between refreshes of a location, unless set in the locations file
+    "max_workers": 4,       # locations refreshed at the same time
+    "jitter": 0.1,          # random fraction added to or taken from each interval
+    "retry_interval": 60,   # seconds until a failed refresh is retried, doubled on each failure
+    "save_interval": 30,    # seconds between saves of the scheduler state
+}
+
+def get_scheduler_config(config_filename: str) -> dict:
+    """
+    get_scheduler_config() gets the settings of the scheduler of --serve
+    from the "scheduler" section of config_filename.
+    Settings missing from the config file have the values of DEFAULT_SCHEDULER_CONFIG.
+    """
+    return _get_section(config_filename, "scheduler", DEFAULT_SCHEDULER_CONFIG)
+
+# defaults for the "read_server" section of the config file, for --read-server
+DEFAULT_READ_SERVER_CONFIG = {
+    "host": "127.0.0.1",        # address to listen on
+    "port": 8080,               # port to listen on
+    "readers": 8,               # queries run at the same time, each with its own connection
+    "cache_entries": 1024,      # encoded responses kept in memory
+    "cache_ttl": 60,            # seconds a response is kept in memory
+    "gzip_level": 5,            # gzip level of the responses (0: no compression)
+    "keep_alive_timeout": 15,   # seconds an idle connection is kept open
+}
+
+def get_read_server_config(config_filename: str) -> dict:
+    """
+    get_read_server_config() gets the settings of the HTTP read server of --read-server
+    from the "read_server" section of config_filename.
+    Settings missing from the config file have the values of DEFAULT_READ_SERVER_CONFIG.
+    """
+    return _get_section(config_filename, "read_server", DEFAULT_READ_SERVER_CONFIG)
+
+def _get_section(config_filename: str, section: str, defaults: dict) -> dict:
+    """
+    Get an optional section of the configuration in config_filename,
+    completed with the given defaults.
+    """
+    filepath = get_file_path(config_filename, calling_file = __file__)
+
+    try: 
+        with open(filepath) as f:
+            data = json.load(f)
+            settings = dict(defaults)
+            settings.update(data["configuration"].get(section, {}))
+    except FileNotFoundError as err:
+        raise ConfigFileError("Config file not found.", 
+                              filepath, err)
+    except KeyError as err:
+        raise ConfigFileError("Config file's dictionary key is not found.", 
+                              filepath, err)
+    except Exception as err:
+        raise ConfigFileError("Config file exception error.", 
+                              filepath, err)
+    return settings
@@ -0,0 +1,491 @@
+"""
+The ReadServer object serves the stored weather data over HTTP, for dashboards:
+    GET /forecast?lat=52.52&lon=13.41&start=2024-01-01&end=2024-01-08&vars=precipitation,wind_speed_10m
+    GET /rollup?lat=52.52&lon=13.41&freq=D&agg=precipitation_sum&start=2024-01-01&end=2024-02-01
+start, end, vars and agg are optional (see IWeatherStorage.query() and WeatherDatabase.rollup()).
+start and end are in UTC, unless they have a UTC offset (e.g. 2024-01-01T00:00+02:00).
+The response is json, or an Arrow IPC stream with format=arrow (or an Accept header
+of application/vnd.apache.arrow.stream), which needs the pyarrow package.
+It is an asyncio server with the standard library: connections are kept alive,
+the queries run in a pool of reader threads (each with its own database connection),
+and the responses are encoded and sent in chunks, gzip compressed if the client accepts it.
+Only the encoding is streamed: the records of a request are queried into one dataframe
+before the first chunk is sent, so the memory of a request grows with its time range
+(about 40 bytes per hourly record), and the encoded response is not held in memory.
+The encoded responses of recent requests are kept in memory for cache_ttl seconds,
+so repeated requests are answered without the database.
+"""
+import asyncio
+import datetime
+import io
+import json
+import re
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+from database import IWeatherStorage, ROLLUP_PERIODS, ROLLUPS
+from decode import MEASURES
+from exception import RECOVERABLE_ERRORS
+from location import Location
+import metrics
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# records encoded in one chunk of a streamed response
+CHUNK_ROWS = 5000
+
+# largest response body kept in the response cache, in bytes
+MAX_CACHED_BYTES = 1 << 20
+
+# longest request line or header line, and most header lines of a request
+MAX_LINE = 8192
+MAX_HEADERS = 100
+
+JSON_TYPE = "application/json"
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+
+# returned by the reader threads at the end of a response
+_END = object()
+
+class _HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        """
+        An error answered to the client with the status code and a json message.
+        """
+        super().__init__(message)
+        self.status = status
+
+class ResponseCache():
+    def __init__(self, max_entries: int = 1024, ttl: float = 60):
+        """
+        Create the cache for up to max_entries encoded responses, which expire
+        after ttl seconds, since the data is downloaded by other processes.
+        It is only used from the event loop, so it has no lock.
+        """
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = OrderedDict() # key -> (time cached, content type, body), in LRU order
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Get the (content type, body) of a cached response, or None.
+        """
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self._ttl:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key, content_type: str, body: bytes):
+        if self._max_entries <= 0 or self._ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic(), content_type, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+class ReadServer():
+    def __init__(self, database: IWeatherStorage, host: str = "127.0.0.1", port: int = 8080,
+                 readers: int = 8, cache_entries: int = 1024, cache_ttl: float = 60,
+                 gzip_level: int = 5, keep_alive_timeout: float = 15, snap_distance: float = 0.0):
+        """
+        Create the server of the data in database on host:port (port 0 picks a free port).
+        readers is the number of queries run at the same time.
+        A request for a location within snap_distance km of a stored location
+        gets the data of the stored location.
+        """
+        self._database = database
+        self._host = host
+        self.port = port
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="reader")
+        self._cache = ResponseCache(cache_entries, cache_ttl)
+        self._gzip_level = gzip_level
+        self._keep_alive_timeout = keep_alive_timeout
+        self._snap_distance = snap_distance
+        self._server = None
+        self._routes = {"/forecast": self._forecast, "/rollup": self._rollup}
+        self.requests = 0
+        self.errors = 0
+
+    async def start(self):
+        """
+        Start listening. The connections are served by the running event loop.
+        """
+        self._server = await asyncio.start_server(self._handle_connection, self._host, self.port,
+                                                  limit=MAX_LINE)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Read server listening on http://" + self._host + ":" + str(self.port))
+
+    async def stop(self):
+        """
+        Stop listening, close the connections, and stop the reader threads.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self._readers.shutdown(wait=True)
+        logger.info("Read server stopped. " + self.get_status())
+
+    def get_status(self) -> str:
+        return ("requests: " + str(self.requests) + ", errors: " + str(self.errors)
+                + ", response cache hits: " + str(self._cache.hits)
+                + ", misses: " + str(self._cache.misses))
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Answer the requests of a connection until the client closes it, asks to close it,
+        or is idle for keep_alive_timeout seconds.
+        """
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self._keep_alive_timeout)
+                except _HttpError as err:
+                    await self._send_error(writer, err.status, str(err), "HTTP/1.1", keep_alive=False)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                if request is None:
+                    break
+                method, target, version, headers = request
+                keep_alive = _is_keep_alive(version, headers)
+                await self._respond(writer, method, target, version, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """
+        Read the request line and the headers of a request, or None at the end of the connection.
+        A body is read and ignored.
+        """
+        try:
+            line = await reader.readline()
+            if not line:
+                return None
+            parts = line.decode("latin-1").split()
+            if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+                raise _HttpError(400, "Bad request line.")
+            headers = {}
+            for _ in range(MAX_HEADERS):
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            else:
+                raise _HttpError(431, "Too many headers.")
+        except ValueError:
+            # a line longer than the limit of the reader
+            raise _HttpError(431, "Request line or header too long.")
+        if "transfer-encoding" in headers:
+            raise _HttpError(501, "Request bodies are not supported.")
+        length = headers.get("content-length", "0")
+        if not length.isdigit():
+            raise _HttpError(400, "Bad Content-Length.")
+        if int(length) > 0:
+            await reader.readexactly(int(length))
+        return parts[0], parts[1], parts[2], headers
+
+    async def _respond(self, writer: asyncio.StreamWriter, method: str, target: str,
+                       version: str, headers: dict, keep_alive: bool):
+        """
+        Answer a request, from the response cache or by streaming the response
+        made by the reader threads.
+        """
+        start = time.perf_counter()
+        self.requests += 1
+        metrics.count("server_requests")
+        try:
+            url = urlsplit(target)
+            if method != "GET":
+                raise _HttpError(405, "Only GET is supported.")
+            handler = self._routes.get(url.path)
+            if handler is None:
+                raise _HttpError(404, "Unknown path: " + url.path)
+            params = dict(parse_qsl(url.query))
+            response_format = _get_format(params, headers)
+            use_gzip = "gzip" in headers.get("accept-encoding", "") and self._gzip_level > 0
+            key = (url.path, tuple(sorted(params.items())), response_format, use_gzip)
+            cached = self._cache.get(key)
+            if cached is not None:
+                metrics.count("server_cache_hits")
+                content_type, body = cached
+                await self._send(writer, 200, content_type, [body], version, keep_alive, use_gzip)
+                return
+            chunks = handler(params, response_format)
+            if use_gzip:
+                chunks = _gzip_chunks(chunks, self._gzip_level)
+            # the whole query runs on the first chunk, so its errors are answered before the headers
+            first = await self._next_chunk(chunks)
+            content_type = ARROW_TYPE if response_format == "arrow" else JSON_TYPE
+            body = await self._send(writer, 200, content_type, self._iter_chunks(first, chunks),
+                                    version, keep_alive, use_gzip)
+            if body is not None:
+                self._cache.put(key, content_type, body)
+        except _HttpError as err:
+            self.errors += 1
+            await self._send_error(writer, err.status, str(err), version, keep_alive)
+        except ConnectionError:
+            # the client is gone, or the response was aborted after its headers were sent:
+            # _handle_connection() closes the connection, since no other response can follow.
+            self.errors += 1
+            raise
+        except RECOVERABLE_ERRORS as err:
+            # the client gets a 500, and the connection stays open for the next request
+            self.errors += 1
+            logger.error("Error in request " + target + ": " + repr(err))
+            await self._send_error(writer, 500, "Internal error.", version, keep_alive)
+        finally:
+            metrics.observe("serve", time.perf_counter() - start)
+
+    async def _next_chunk(self, chunks):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, next, chunks, _END)
+
+    async def _iter_chunks(self, first, chunks):
+        """
+        Iterate the chunks of a response, made in the reader threads.
+        """
+        chunk = first
+        while chunk is not _END:
+            if chunk:
+                yield chunk
+            chunk = await self._next_chunk(chunks)
+
+    async def _send(self, writer: asyncio.StreamWriter, status: int, content_type: str, chunks,
+                    version: str, keep_alive: bool, use_gzip: bool = False):
+        """
+        Send a response with the body in chunks (a list, or an async iterator, which
+        is streamed with the chunked transfer encoding to HTTP/1.1 clients).
+        Returns the body if it is small enough for the response cache, else None.
+        """
+        headers = ["HTTP/1.1 " + str(status) + " " + HTTPStatus(status).phrase,
+                   "Content-Type: " + content_type,
+                   "Vary: Accept-Encoding",
+                   "Connection: " + ("keep-alive" if keep_alive else "close")]
+        if use_gzip:
+            headers.append("Content-Encoding: gzip")
+        if isinstance(chunks, list) or version == "HTTP/1.0":
+            if not isinstance(chunks, list):
+                chunks = [chunk async for chunk in chunks]
+            body = b"".join(chunks)
+            headers.append("Content-Length: " + str(len(body)))
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+            return body if len(body) <= MAX_CACHED_BYTES else None
+        headers.append("Transfer-Encoding: chunked")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+        kept, size = [], 0
+        try:
+            async for chunk in chunks:
+                writer.write(format(len(chunk), "x").encode() + b"\r\n" + chunk + b"\r\n")
+                # wait for a slow client before making the next chunk
+                await writer.drain()
+                size += len(chunk)
+                if kept is not None and size <= MAX_CACHED_BYTES:
+                    kept.append(chunk)
+                else:
+                    kept = None
+        except RECOVERABLE_ERRORS as err:
+            if isinstance(err, ConnectionError):
+                raise
+            # the headers are sent, so the client only sees the connection closed
+            logger.error("Error while streaming a response: " + repr(err))
+            raise ConnectionAbortedError("Response aborted.")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return None if kept is None else b"".join(kept)
+
+    async def _send_error(self, writer: asyncio.StreamWriter, status: int, message: str,
+                          version: str, keep_alive: bool):
+        metrics.count("server_errors")
+        body = json.dumps({"error": True, "status": status, "reason": message}).encode()
+        await self._send(writer, status, JSON_TYPE, [body], version, keep_alive)
+
+    # The handlers run in the reader threads, as generators of the chunks of the response body.
+
+    def _forecast(self, params: dict, response_format: str):
+        """
+        The hourly records of a location, for /forecast.
+        """
+        location = self._get_location(params)
+        columns = _get_names(params, "vars", MEASURES)
+        start, end = _get_time(params, "start"), _get_time(params, "end")
+        df = self._database.query(location, start, end, columns)
+        yield from _encode(df, response_format, {"longitude": location.get_longitude(),
+                                                 "latitude": location.get_latitude()})
+
+    def _rollup(self, params: dict, response_format: str):
+        """
+        The daily or weekly rollups of a location, for /rollup.
+        """
+        if not hasattr(self._database, "rollup"):
+            raise _HttpError(501, "The storage has no rollups.")
+        freq = params.get("freq", "D")
+        if freq not in ROLLUP_PERIODS:
+            raise _HttpError(400, "Unknown freq: " + freq)
+        location = self._get_location(params)
+        agg = _get_names(params, "agg", list(ROLLUPS))
+        start, end = _get_time(params, "start"), _get_time(params, "end")
+        df = self._database.rollup(location, freq=freq, agg=agg, start=start, end=end)
+        yield from _encode(df, response_format, {"longitude": location.get_longitude(),
+                                                 "latitude": location.get_latitude(),
+                                                 "freq": freq})
+
+    def _get_location(self, params: dict) -> Location:
+        """
+        Get the stored location of the lat and lon parameters, or the stored location
+        within the snap distance.
+        """
+        try:
+            latitude, longitude = float(params["lat"]), float(params["lon"])
+        except KeyError:
+            raise _HttpError(400, "The lat and lon parameters are required.")
+        except ValueError:
+            raise _HttpError(400, "lat and lon must be numbers.")
+        if not (abs(latitude) <= 90 and abs(longitude) <= 180):
+            raise _HttpError(400, "lat or lon out of range.")
+        location = Location(longitude, latitude)
+        if self._snap_distance > 0:
+            nearest = self._database.find_nearest(location, self._snap_distance)
+            if nearest is not None:
+                return nearest
+        if self._database.get_last_fetched(location) is None:
+            raise _HttpError(404, "No data for the location.")
+        return location
+
+def _is_keep_alive(version: str, headers: dict) -> bool:
+    """
+    HTTP/1.1 connections are kept alive unless the client closes them,
+    and HTTP/1.0 connections only if the client asks for it.
+    """
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+def _get_format(params: dict, headers: dict) -> str:
+    """
+    Get the format of the response, "json" or "arrow", from the format parameter
+    or else the Accept header.
+    """
+    response_format = params.pop("format", None)
+    if response_format is None:
+        response_format = "arrow" if ARROW_TYPE in headers.get("accept", "") else "json"
+    if response_format not in ("json", "arrow"):
+        raise _HttpError(400, "Unknown format: " + response_format)
+    if response_format == "arrow" and pa is None:
+        raise _HttpError(406, "The arrow format needs the pyarrow package on the server.")
+    return response_format
+
+def _get_names(params: dict, name: str, allowed) -> list:
+    """
+    Get a comma separated list parameter, checking its values, or all allowed values.
+    """
+    if not params.get(name):
+        return list(allowed)
+    names = params[name].split(",")
+    for value in names:
+        if value not in allowed:
+            raise _HttpError(400, "Unknown " + name + ": " + value)
+    return names
+
+def _get_time(params: dict, name: str):
+    """
+    Get a time parameter as an isoformat string in UTC (the time zone of the
+    stored data), or None. A time without a UTC offset is in UTC.
+    """
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        try:
+            time = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            # the "+" of an offset that was not escaped in the query string is a space
+            time = datetime.datetime.fromisoformat(re.sub(r" (\d\d(:?\d\d)?)$", r"+\1", value))
+    except ValueError:
+        raise _HttpError(400, "Bad " + name + " time: " + value)
+    if time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time.isoformat()
+
+def _encode(df, response_format: str, meta: dict):
+    """
+    Encode a dataframe with a time index in chunks of CHUNK_ROWS records.
+    """
+    df = df.reset_index()
+    df["time"] = df["time"].dt.strftime("%Y-%m-%dT%H:%M")
+    if response_format == "arrow":
+        yield from _encode_arrow(df, meta)
+    else:
+        yield from _encode_json(df, meta)
+
+def _encode_json(df, meta: dict):
+    """
+    Encode the records as {..meta.., "columns": [...], "records": [{...}, ...]}.
+    """
+    meta = dict(meta, columns=list(df.columns))
+    yield (json.dumps(meta)[:-1] + ', "records": [').encode()
+    separator = ""
+    for first in range(0, len(df), CHUNK_ROWS):
+        records = df.iloc[first:first + CHUNK_ROWS].to_json(orient="records", double_precision=10)
+        yield (separator + records[1:-1]).encode()
+        separator = ","
+    yield b"]}"
+
+def _encode_arrow(df, meta: dict):
+    """
+    Encode the records as an Arrow IPC stream, with a record batch per chunk
+    and meta in the metadata of the schema.
+    """
+    schema = pa.Schema.from_pandas(df, preserve_index=False).with_metadata(
+        {name: json.dumps(value) for name, value in meta.items()})
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for first in range(0, max(len(df), 1), CHUNK_ROWS):
+            writer.write_batch(pa.RecordBatch.from_pandas(df.iloc[first:first + CHUNK_ROWS],
+                                                          schema=schema, preserve_index=False))
+            yield _take(sink)
+    yield _take(sink)
+
+def _take(sink: io.BytesIO) -> bytes:
+    """
+    Get the bytes written to sink, and empty it.
+    """
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+def _gzip_chunks(chunks, level: int):
+    """
+    Compress the chunks of a response body as one gzip stream.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
@@ -0,0 +1,260 @@
+"""
+The Scheduler object refreshes the data of many locations in a long-running process,
+each location on its own interval, with a bounded pool of worker threads.
+The next refresh of each location is jittered, so locations added together do not
+stay in lockstep, and when more locations are due than there are free workers,
+the locations that were never downloaded, then the most overdue ones, go first. The schedule is saved to a state file,
+so a restart continues it instead of downloading everything again.
+"""
+import datetime
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from data_handler import DataHandler
+from database import IWeatherStorage
+from exception import RECOVERABLE_ERRORS
+from location import Location
+from util import get_file_path
+import metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+# longest wait of the scheduler loop, in seconds, so a changed schedule is picked up
+MAX_WAIT = 5.0
+
+# due locations compared by priority for each free worker
+CANDIDATES_PER_WORKER = 8
+
+class ScheduledLocation():
+    def __init__(self, location: Location, interval: float):
+        """
+        A location with its refresh interval in seconds, and the state of its schedule.
+        """
+        self.location = location
+        self.interval = interval
+        self.next_run = 0.0    # time.time() of the next refresh
+        self.failures = 0      # failed refreshes in a row
+        self.never_fetched = False
+        self.running = False
+
+    def get_key(self) -> str:
+        """
+        Get the key of the location in the state file.
+        """
+        return repr(float(self.location.get_longitude())) + "," + repr(float(self.location.get_latitude()))
+
+class Scheduler():
+    def __init__(self, data_handler: DataHandler, database: IWeatherStorage,
+                 max_workers: int = 4, jitter: float = 0.1, retry_interval: float = 60,
+                 state_file: str = None, save_interval: float = 30):
+        """
+        Create the scheduler, which refreshes the locations with data_handler.refresh().
+        max_workers is the number of locations refreshed at the same time.
+        Each interval is changed by a random fraction of up to +-jitter.
+        A failed refresh is retried after retry_interval seconds, doubled for each
+        failure in a row, up to the interval of the location.
+        The schedule is saved to state_file (if given) every save_interval seconds
+        and on shutdown.
+        """
+        self._data_handler = data_handler
+        self._database = database
+        self._max_workers = max_workers
+        self._jitter = jitter
+        self._retry_interval = retry_interval
+        self._state_file = None if state_file is None else get_file_path(state_file, calling_file=__file__)
+        self._save_interval = save_interval
+        self._entries = {}   # key -> ScheduledLocation
+        self._heap = []      # (next_run, sequence number, key) of the entries that are not running
+        self._sequence = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self.refreshes = 0
+        self.failures = 0
+        self._state = self._load_state()
+
+    def _load_state(self) -> dict:
+        """
+        Read the saved schedule, keyed by location.
+        """
+        if self._state_file is None or not os.path.exists(self._state_file):
+            return {}
+        try:
+            with open(self._state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as err:
+            logger.warning("Cannot read scheduler state file, starting a new schedule: " + str(err))
+            return {}
+        logger.info("Scheduler state found: " + str(self._state_file))
+        return state.get("locations", {})
+
+    def save_state(self):
+        """
+        Save the schedule to the state file.
+        """
+        if self._state_file is None:
+            return
+        with self._lock:
+            state = {"saved_at": time.time(),
+                     "locations": {key: {"next_run": entry.next_run,
+                                         "failures": entry.failures}
+                                   for key, entry in self._entries.items()}}
+        tmp_file = str(self._state_file) + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self._state_file)
+        except OSError as err:
+            logger.error("Cannot save scheduler state file: " + str(err))
+
+    def add(self, location: Location, interval: float):
+        """
+        Add a location to refresh every interval seconds.
+        Its first refresh is taken from the saved schedule, or else from the time
+        of its last download in the database; a location that was never downloaded is due now.
+        """
+        entry = ScheduledLocation(location, interval)
+        key = entry.get_key()
+        saved = self._state.get(key)
+        last_fetched = self._database.get_last_fetched(location)
+        entry.never_fetched = last_fetched is None
+        if saved is not None and not entry.never_fetched:
+            entry.next_run = min(saved["next_run"], time.time() + interval)
+            entry.failures = saved.get("failures", 0)
+        elif not entry.never_fetched:
+            # last_fetched is a naive datetime in UTC
+            fetched_time = last_fetched.replace(tzinfo=datetime.timezone.utc).timestamp()
+            entry.next_run = fetched_time + self._get_jittered(interval)
+        else:
+            entry.next_run = time.time()
+        with self._lock:
+            self._entries[key] = entry
+            self._push(entry)
+        self._wakeup.set()
+
+    def _push(self, entry: ScheduledLocation):
+        """
+        Put an entry in the heap. Called with the lock.
+        """
+        self._sequence += 1
+        heapq.heappush(self._heap, (entry.next_run, self._sequence, entry.get_key()))
+
+    def _get_jittered(self, seconds: float) -> float:
+        """
+        Change seconds by a random fraction of up to +-jitter.
+        """
+        return seconds * (1 + random.uniform(-self._jitter, self._jitter))
+
+    def _get_priority(self, entry: ScheduledLocation, now: float) -> float:
+        """
+        Get the priority of a due entry: locations that were never downloaded first,
+        then by how many intervals they are overdue.
+        """
+        overdue = (now - entry.next_run) / entry.interval if entry.interval > 0 else 0.0
+        return (1e9 if entry.never_fetched else 0.0) + overdue
+
+    def _take_due(self, now: float) -> List[ScheduledLocation]:
+        """
+        Take the due entries with the highest priority, up to the number of free workers,
+        from the heap. Only the CANDIDATES_PER_WORKER earliest due entries per free worker
+        are compared, so a large backlog is not sorted on every wakeup.
+        Called with the lock.
+        """
+        free = self._max_workers - self._in_flight
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < free * CANDIDATES_PER_WORKER:
+            next_run, _, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            # skip heap items of entries that were rescheduled since
+            if entry is not None and not entry.running and entry.next_run == next_run:
+                due.append(entry)
+        due.sort(key=lambda entry: self._get_priority(entry, now), reverse=True)
+        for entry in due[free:]:
+            self._push(entry)
+        due = due[:free]
+        for entry in due:
+            entry.running = True
+        self._in_flight += len(due)
+        return due
+
+    def _refresh(self, entry: ScheduledLocation):
+        """
+        Refresh a location in a worker thread, and schedule its next refresh.
+        """
+        try:
+            with metrics.timer("refresh"):
+                ok = self._data_handler.refresh(entry.location, force=True)
+        except RECOVERABLE_ERRORS as err:
+            # the location is retried with backoff, like a failed download
+            logger.error("Cannot refresh location " + entry.get_key() + ": " + str(err))
+            ok = False
+        with self._lock:
+            if ok:
+                entry.failures = 0
+                entry.never_fetched = False
+                delay = entry.interval
+                self.refreshes += 1
+            else:
+                entry.failures += 1
+                delay = min(entry.interval, self._retry_interval * 2 ** (entry.failures - 1))
+                self.failures += 1
+            entry.next_run = time.time() + self._get_jittered(delay)
+            entry.running = False
+            self._in_flight -= 1
+            self._push(entry)
+        metrics.count("scheduler_refreshes" if ok else "scheduler_failures")
+        self._wakeup.set()
+
+    def run(self, duration: float = None):
+        """
+        Run the scheduler until stop() is called (or for duration seconds).
+        On stop, the running refreshes are finished and the state is saved.
+        """
+        logger.info("Scheduler started with " + str(len(self._entries)) + " locations and "
+                    + str(self._max_workers) + " workers.")
+        end_time = None if duration is None else time.time() + duration
+        last_save = time.time()
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while not self._stop.is_set():
+                # cleared before the heap is read, so a refresh that finishes
+                # from here on wakes up the wait below
+                self._wakeup.clear()
+                now = time.time()
+                if end_time is not None and now >= end_time:
+                    break
+                with self._lock:
+                    due = self._take_due(now)
+                    if self._in_flight >= self._max_workers:
+                        # all workers are busy: the due locations wait for a free worker
+                        next_run = now + MAX_WAIT
+                    else:
+                        next_run = self._heap[0][0] if self._heap else now + MAX_WAIT
+                for entry in due:
+                    executor.submit(self._refresh, entry)
+                if self._save_interval is not None and now - last_save >= self._save_interval:
+                    self.save_state()
+                    last_save = now
+                # sleep until the next location is due, a refresh finishes, or stop()
+                wait = min(max(next_run - now, 0.0), MAX_WAIT)
+                if end_time is not None:
+                    wait = min(wait, max(end_time - now, 0.0))
+                self._wakeup.wait(timeout=wait)
+            logger.info("Scheduler stopping, waiting for " + str(self._in_flight) + " running refreshes.")
+        self.save_state()
+        logger.info("Scheduler stopped. Refreshes: " + str(self.refreshes)
+                    + ", failures: " + str(self.failures) + ".")
+
+    def stop(self):
+        """
+        Stop the scheduler. Can be called from a signal handler or another thread.
+        """
+        self._stop.set()
+        self._wakeup.set()
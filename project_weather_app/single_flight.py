@@ -0,0 +1,127 @@
+"""
+The SingleFlight object coalesces concurrent calls with the same key:
+the first caller (the leader) runs the call, and the callers that come while it
+is running wait for its result, or its exception, instead of running it again.
+Threads call do(), and coroutines call do_async(); both wait for the same call.
+Usage:
+    result = single_flight.do(("download", longitude, latitude), download_data, location)
+"""
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+class SingleFlight():
+    def __init__(self, timeout: float = None):
+        """
+        Create the coordinator of the calls in flight.
+        A caller waits at most timeout seconds (by default without a limit)
+        for the call of another caller, and then gets a TimeoutError.
+        """
+        self._timeout = timeout
+        self._calls = {} # key -> Future of the call in flight
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def _join(self, key):
+        """
+        Get the future of the call in flight for key, and whether the caller
+        is its leader and has to run the call.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self._calls[key] = Future()
+                self.leaders += 1
+                leader = True
+        metrics.count("singleflight_leaders" if leader else "singleflight_coalesced")
+        return future, leader
+
+    def _finish(self, key, future: Future, result=None, error: BaseException = None):
+        """
+        Remove the call from the calls in flight, and pass its result or error to the waiters.
+        """
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _timed_out(self, key):
+        with self._lock:
+            self.timeouts += 1
+        metrics.count("singleflight_timeouts")
+        logger.warning("Timeout waiting for the call in flight for " + str(key))
+
+    def do(self, key, func, *args, timeout: float = None, **kwargs):
+        """
+        Run func(*args, **kwargs) if no call for key is in flight, else wait for the
+        result of the call in flight. An exception of the call is raised in all callers.
+        The leader runs func in its own thread and is not limited by the timeout.
+        """
+        future, leader = self._join(key)
+        if not leader:
+            try:
+                return future.result(timeout=self._timeout if timeout is None else timeout)
+            except FutureTimeoutError:
+                self._timed_out(key)
+                raise TimeoutError("Timeout waiting for the call in flight for " + str(key))
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as err:
+            # any error, also a SystemExit (see exception.py), is passed to the waiters
+            self._finish(key, future, error=err)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key, func, *args, timeout: float = None, **kwargs):
+        """
+        Like do(), for coroutines. func is a coroutine function, which the leader runs
+        in the event loop, or a function, which the leader runs in the default executor
+        of the loop so the loop is not blocked. The timeout also limits the leader;
+        the call goes on for the other callers when a caller times out or is cancelled.
+        """
+        # asyncio is only loaded by the programs that use it
+        import asyncio
+        timeout = self._timeout if timeout is None else timeout
+        future, leader = self._join(key)
+        if leader:
+            loop = asyncio.get_running_loop()
+            if asyncio.iscoroutinefunction(func):
+                task = loop.create_task(func(*args, **kwargs))
+            else:
+                task = loop.run_in_executor(None, lambda: func(*args, **kwargs))
+            task.add_done_callback(lambda task: self._finish_task(key, future, task))
+        try:
+            # shielded, so a timeout or a cancellation of one caller does not cancel the call
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            self._timed_out(key)
+            raise TimeoutError("Timeout waiting for the call in flight for " + str(key))
+
+    def _finish_task(self, key, future: Future, task):
+        """
+        Pass the result of the task of an async leader to the waiters.
+        """
+        import asyncio
+        if task.cancelled():
+            self._finish(key, future, error=asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._finish(key, future, error=task.exception())
+        else:
+            self._finish(key, future, task.result())
+
+    def get_status(self) -> str:
+        return ("single flight calls: " + str(self.leaders) + ", duplicate calls avoided: "
+                + str(self.coalesced) + ", timeouts: " + str(self.timeouts))
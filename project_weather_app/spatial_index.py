@@ -0,0 +1,176 @@
+"""
+The SpatialIndex object finds the stored locations nearest to a coordinate,
+so a request for a point near a stored location can reuse its forecast
+instead of downloading the same model cell again.
+The locations are sorted by the cell of a grid of cell_degrees degrees
+(like a geohash), so a lookup only compares the locations in the cells
+around the coordinate. Distances are great-circle distances in km.
+LocationIndex wraps it for the Location objects of the storages.
+"""
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# mean radius of the earth in km
+EARTH_RADIUS = 6371.0088
+
+# query locations compared with all indexed locations at once in nearest_n()
+CHUNK_LOCATIONS = 1024
+
+def haversine(longitude1, latitude1, longitude2, latitude2):
+    """
+    Get the great-circle distances in km between coordinates in degrees (numpy arrays or numbers).
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(value) for value in (longitude1, latitude1, longitude2, latitude2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _to_unit_vectors(longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+    """
+    Get the unit vectors of coordinates in degrees, of shape (n, 3).
+    """
+    lon, lat = np.radians(longitudes), np.radians(latitudes)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+class SpatialIndex():
+    def __init__(self, ids, longitudes, latitudes, cell_degrees: float = 0.1):
+        """
+        Create the index of the locations with the given ids and coordinates in degrees.
+        """
+        self._cell_degrees = cell_degrees
+        self._n_longitude_cells = max(1, int(round(360 / cell_degrees)))
+        keys = self._get_cell_keys(np.asarray(longitudes, dtype=np.float64),
+                                   np.asarray(latitudes, dtype=np.float64))
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._ids = np.asarray(ids, dtype=np.int64)[order]
+        self._longitudes = np.asarray(longitudes, dtype=np.float64)[order]
+        self._latitudes = np.asarray(latitudes, dtype=np.float64)[order]
+        self._vectors = None # unit vectors of the locations, made by nearest_n()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _get_cell_keys(self, longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+        """
+        Get the keys of the grid cells of coordinates in degrees.
+        """
+        longitude_cells = np.floor((longitudes + 180) / self._cell_degrees).astype(np.int64) % self._n_longitude_cells
+        latitude_cells = np.floor((latitudes + 90) / self._cell_degrees).astype(np.int64)
+        return latitude_cells * self._n_longitude_cells + longitude_cells
+
+    def nearest(self, longitude: float, latitude: float,
+                max_distance: float) -> Optional[Tuple[int, float]]:
+        """
+        Get the id of the indexed location nearest to a coordinate and its distance in km,
+        or None if no location is within max_distance km.
+        """
+        if len(self._ids) == 0:
+            return None
+        # the cells that can have locations within max_distance
+        degrees = math.degrees(max_distance / EARTH_RADIUS)
+        latitude_cell = math.floor((latitude + 90) / self._cell_degrees)
+        n_latitude = math.ceil(degrees / self._cell_degrees)
+        cos_latitude = math.cos(math.radians(min(abs(latitude) + degrees, 90.0)))
+        if cos_latitude < 1e-9:
+            n_longitude = self._n_longitude_cells
+        else:
+            n_longitude = min(self._n_longitude_cells, math.ceil(degrees / cos_latitude / self._cell_degrees))
+        longitude_cell = math.floor((longitude + 180) / self._cell_degrees)
+        longitude_cells = np.unique((longitude_cell + np.arange(-n_longitude, n_longitude + 1))
+                                    % self._n_longitude_cells)
+        candidates = []
+        for row in range(latitude_cell - n_latitude, latitude_cell + n_latitude + 1):
+            keys = row * self._n_longitude_cells + longitude_cells
+            starts = np.searchsorted(self._keys, keys, "left")
+            ends = np.searchsorted(self._keys, keys, "right")
+            candidates.extend(np.arange(start, end) for start, end in zip(starts, ends) if end > start)
+        if not candidates:
+            return None
+        candidates = np.concatenate(candidates)
+        distances = haversine(longitude, latitude, self._longitudes[candidates], self._latitudes[candidates])
+        best = int(np.argmin(distances))
+        if distances[best] > max_distance:
+            return None
+        return int(self._ids[candidates[best]]), float(distances[best])
+
+    def nearest_n(self, longitudes, latitudes, n: int,
+                  max_distance: float = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the ids of the n indexed locations nearest to each of many coordinates,
+        nearest first, and their distances in km, as arrays of shape (coordinates, n).
+        Missing neighbors (fewer than n locations, or farther than max_distance km)
+        have the id -1 and the distance inf.
+        """
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+        ids = np.full((len(longitudes), n), -1, dtype=np.int64)
+        distances = np.full((len(longitudes), n), np.inf)
+        k = min(n, len(self._ids))
+        if k == 0:
+            return ids, distances
+        if self._vectors is None:
+            self._vectors = _to_unit_vectors(self._longitudes, self._latitudes)
+        # the nearest locations have the largest dot products of the unit vectors
+        for first in range(0, len(longitudes), CHUNK_LOCATIONS):
+            queries = _to_unit_vectors(longitudes[first:first + CHUNK_LOCATIONS],
+                                       latitudes[first:first + CHUNK_LOCATIONS])
+            dots = queries @ self._vectors.T
+            if k < len(self._ids):
+                nearest = np.argpartition(-dots, k - 1, axis=1)[:, :k]
+            else:
+                nearest = np.broadcast_to(np.arange(k), (len(queries), k))
+            order = np.argsort(-np.take_along_axis(dots, nearest, axis=1), axis=1)
+            nearest = np.take_along_axis(nearest, order, axis=1)
+            # the dot products lose precision for near points, so the distances are recomputed
+            chunk_distances = haversine(longitudes[first:first + len(queries), np.newaxis],
+                                        latitudes[first:first + len(queries), np.newaxis],
+                                        self._longitudes[nearest], self._latitudes[nearest])
+            chunk_ids = self._ids[nearest]
+            if max_distance is not None:
+                too_far = chunk_distances > max_distance
+                chunk_ids = np.where(too_far, -1, chunk_ids)
+                chunk_distances = np.where(too_far, np.inf, chunk_distances)
+            ids[first:first + len(queries), :k] = chunk_ids
+            distances[first:first + len(queries), :k] = chunk_distances
+        return ids, distances
+
+class LocationIndex():
+    def __init__(self, locations, cell_degrees: float = 0.1):
+        """
+        Create the index of a list of stored locations, for the storages.
+        """
+        self._locations = list(locations)
+        self._index = SpatialIndex(np.arange(len(self._locations)),
+                                   [location.get_longitude() for location in self._locations],
+                                   [location.get_latitude() for location in self._locations],
+                                   cell_degrees)
+
+    def find_nearest(self, location, max_distance: float):
+        """
+        Get the stored location nearest to location, if it is within max_distance km, else None.
+        """
+        nearest = self._index.nearest(location.get_longitude(), location.get_latitude(), max_distance)
+        return None if nearest is None else self._locations[nearest[0]]
+
+    def nearest_locations(self, locations, n: int, max_distance: float = None) -> pd.DataFrame:
+        """
+        Get the n stored locations nearest to each of the locations (within max_distance km).
+        The dataframe has a row for each neighbor, with the position of the location
+        in the list ("query"), the rank of the neighbor from 0 for the nearest,
+        its longitude and latitude, and its distance in km.
+        """
+        ids, distances = self._index.nearest_n([location.get_longitude() for location in locations],
+                                               [location.get_latitude() for location in locations],
+                                               n, max_distance)
+        query, rank = np.nonzero(ids >= 0)
+        found = ids[query, rank]
+        return pd.DataFrame({
+            "query": query,
+            "rank": rank,
+            "longitude": np.array([float(self._locations[i].get_longitude()) for i in found], dtype=np.float64),
+            "latitude": np.array([float(self._locations[i].get_latitude()) for i in found], dtype=np.float64),
+            "distance": distances[query, rank],
+        })
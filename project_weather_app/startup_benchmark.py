@@ -0,0 +1,124 @@
+"""
+Benchmark of the cold start of main.py: each command is run several times in a new
+interpreter with python -X importtime, and the wall time, the total import time,
+the slowest imports and the heavy modules that were loaded are reported.
+A saved report is the baseline to find regressions, e.g. an eager import of matplotlib:
+    python startup_benchmark.py --output startup_baseline.json
+    python startup_benchmark.py --output startup.json --baseline startup_baseline.json
+The second run exits with 1 if a command got slower by more than --threshold (relative)
+and --min-ms, or loads a heavy module that it did not load in the baseline.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# the commands to time, by name: the arguments of main.py
+COMMANDS = {"help": ["--help"],
+            "mock_no_plot": ["--mode", "MOCK", "--no-plot"],
+            "mock_plot_file": ["--mode", "MOCK", "--plot-file", "startup_benchmark.png"]}
+
+# the slow modules that each command should only load when it needs them
+HEAVY_MODULES = ("numpy", "pandas", "matplotlib", "requests", "pyarrow", "asyncio")
+
+# slowest imports in the report of each command
+TOP_IMPORTS = 10
+
+def parse_importtime(stderr: str) -> dict:
+    """
+    Get the imported modules with their cumulative import time in microseconds
+    from the output of python -X importtime.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue # the header line
+        name = fields[2].strip()
+        # the top level imports are the ones without indentation
+        top_level = len(fields[2]) - len(fields[2].lstrip()) <= 1
+        modules[name] = {"cumulative_us": int(fields[1]), "top_level": top_level}
+    return modules
+
+def run_command(args, runs: int) -> dict:
+    """
+    Run main.py with args runs times, and get the median wall time and import time,
+    the slowest imports and the heavy modules that were loaded (of the last run).
+    """
+    env = dict(os.environ, MPLBACKEND="Agg")
+    wall_times, import_times = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "main.py"] + args,
+                                capture_output=True, text=True, env=env)
+        wall_times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError("main.py " + " ".join(args) + " failed:\n" + result.stderr[-2000:])
+        modules = parse_importtime(result.stderr)
+        import_times.append(sum(module["cumulative_us"] for module in modules.values() if module["top_level"]))
+    top = sorted(modules.items(), key=lambda item: item[1]["cumulative_us"], reverse=True)
+    return {"wall_ms": statistics.median(wall_times) * 1000,
+            "import_ms": statistics.median(import_times) / 1000,
+            "heavy_modules": [name for name in HEAVY_MODULES if name in modules],
+            "top_imports": dict([(name, module["cumulative_us"] / 1000)
+                                 for name, module in top if module["top_level"]][:TOP_IMPORTS])}
+
+def compare(baseline: dict, current: dict, threshold: float, min_ms: float) -> list:
+    """
+    Get the regressions of the current report against the baseline: a slowdown by more
+    than threshold (relative) and min_ms (so the noise of the fast commands is ignored),
+    or a heavy module that was not loaded in the baseline.
+    """
+    regressions = []
+    for name, result in current.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        for measure in ("wall_ms", "import_ms"):
+            if result[measure] > max(before[measure] * (1 + threshold), before[measure] + min_ms):
+                regressions.append(name + ": " + measure + " " + format(before[measure], ".1f")
+                                   + " -> " + format(result[measure], ".1f"))
+        for module in sorted(set(result["heavy_modules"]) - set(before["heavy_modules"])):
+            regressions.append(name + ": now loads " + module)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the cold start of main.py.")
+    parser.add_argument("--commands", nargs="+", choices=list(COMMANDS), default=list(COMMANDS),
+                        help="commands to time (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="runs of each command (default: 5)")
+    parser.add_argument("--output", help="json file for the report")
+    parser.add_argument("--baseline", help="json report to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown that is a regression (default: 0.2)")
+    parser.add_argument("--min-ms", type=float, default=25,
+                        help="smallest slowdown in ms that is a regression (default: 25)")
+    args = parser.parse_args()
+
+    report = {}
+    try:
+        for name in args.commands:
+            report[name] = run_command(COMMANDS[name], args.runs)
+            print(f"{name:<16} wall {report[name]['wall_ms']:>8.1f} ms  imports {report[name]['import_ms']:>8.1f} ms  "
+                  + "loads: " + (", ".join(report[name]["heavy_modules"]) or "-"))
+    finally:
+        if os.path.exists("startup_benchmark.png"):
+            os.remove("startup_benchmark.png")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report, args.threshold, args.min_ms)
+        for regression in regressions:
+            print("Regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+A local stand-in for the open-meteo.com forecast API, for testing and benchmarking
+the data service without the network.
+Run from the project_weather_app directory:
+    python stub_server.py --port 8080
+and point the "url" of a config file to http://127.0.0.1:8080/v1/forecast
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+def make_hourly(longitude: float, latitude: float, start: datetime.datetime, n: int) -> dict:
+    """
+    Make n hours from start of the "hourly" data of a forecast for a location.
+    The data is reproducible for the location and hour.
+    """
+    seed = abs(hash((round(longitude, 4), round(latitude, 4)))) % (2 ** 32)
+    rng = np.random.default_rng(seed)
+    # offset of the start from a fixed day, so the same hour always gets the same values
+    offset = int((start - datetime.datetime(2000, 1, 1)).total_seconds() // 3600)
+    phase = rng.random(3) * 24
+    hours = np.arange(offset, offset + n)
+    return {
+        "time": [(start + datetime.timedelta(hours=i)).isoformat(timespec="minutes")
+                 for i in range(n)],
+        "precipitation_probability": np.round(50 + 50 * np.sin((hours + phase[0]) / 24 * np.pi)).tolist(),
+        "precipitation": np.round(np.clip(np.sin((hours + phase[1]) / 12 * np.pi), 0, None), 2).tolist(),
+        "wind_speed_10m": np.round(10 + 5 * np.sin((hours + phase[2]) / 24 * np.pi), 1).tolist(),
+    }
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive connections
+    # the headers and the body are sent separately, so without TCP_NODELAY
+    # each response on a keep-alive connection waits for a delayed ACK (about 40 ms).
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if random.random() < server.fail_rate:
+            self._send(503, {"error": True, "reason": "stub failure"})
+            return
+        if server.fixture is not None:
+            # replay the recorded response
+            self._send(200, server.fixture)
+            return
+        query = parse_qs(urlsplit(self.path).query)
+        try:
+            longitudes = [float(x) for x in query["longitude"][0].split(",")]
+            latitudes = [float(x) for x in query["latitude"][0].split(",")]
+            if "start_hour" in query:
+                start = datetime.datetime.fromisoformat(query["start_hour"][0])
+                end = datetime.datetime.fromisoformat(query["end_hour"][0])
+            else:
+                forecast_days = int(query.get("forecast_days", ["7"])[0])
+                start = datetime.datetime.combine(datetime.date.today(), datetime.time())
+                end = start + datetime.timedelta(days=forecast_days, hours=-1)
+        except (KeyError, ValueError):
+            self._send(400, {"error": True, "reason": "invalid parameters"})
+            return
+        n = int((end - start).total_seconds() // 3600) + 1
+        if len(longitudes) != len(latitudes):
+            self._send(400, {"error": True, "reason": "longitude and latitude must have the same number of elements"})
+            return
+        content = [{
+            "longitude": longitude,
+            "latitude": latitude,
+            "location_id": i,
+            "hourly": make_hourly(longitude, latitude, start, n),
+        } for i, (longitude, latitude) in enumerate(zip(longitudes, latitudes))]
+        # like the API, answer with an object for one location, and a list for several.
+        self._send(200, content[0] if len(content) == 1 else content)
+
+    def _send(self, status_code: int, content: dict):
+        body = json.dumps(content).encode()
+        if status_code == 200:
+            # like a cache in front of the API, with a validator of the body
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.server.not_modified += 1
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self._send_cache_control()
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status_code == 200:
+            self.send_header("ETag", etag)
+            # the data changes every hour
+            hour = time.time() // 3600 * 3600
+            self.send_header("Last-Modified", formatdate(hour, usegmt=True))
+            self._send_cache_control()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_cache_control(self):
+        if self.server.max_age is not None:
+            self.send_header("Cache-Control", "max-age=" + str(self.server.max_age))
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(port: int = 0, latency: float = 0.0, fail_rate: float = 0.0,
+                 fixture: str = None, max_age: int = None) -> ThreadingHTTPServer:
+    """
+    Start the stand-in server in a background thread.
+    With port 0 a free port is used. With a fixture file, every request is
+    answered with the recorded response in the file. With max_age, the responses have
+    a "Cache-Control: max-age" header. Requests with the ETag of the response in
+    If-None-Match are answered with 304 (counted in server.not_modified). The url of the forecast API is
+    "http://127.0.0.1:<server.server_port>/v1/forecast". Stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_rate = fail_rate
+    server.fixture = None
+    server.max_age = max_age
+    server.not_modified = 0
+    if fixture is not None:
+        with open(fixture) as f:
+            server.fixture = json.load(f)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the open-meteo.com forecast API.")
+    parser.add_argument("--port", type=int, default=8080, help="port of the server")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of each response in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--fixture", help="json file with a recorded response to replay")
+    parser.add_argument("--max-age", type=int, help="max-age of the Cache-Control header of the responses")
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency, args.fail_rate, args.fixture, args.max_age)
+    print("Serving http://127.0.0.1:" + str(server.server_port) + "/v1/forecast")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+"""
+The tests import the modules of the project like main.py does, from the project directory.
+Run from the project_weather_app directory:
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
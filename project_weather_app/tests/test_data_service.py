@@ -0,0 +1,134 @@
+"""
+Tests of the batched downloads of DataServiceFromAPI against the local stand-in
+of the API (stub_server.py).
+"""
+import datetime
+import json
+import os
+
+import numpy as np
+import pytest
+
+from data_service import DataServiceFromAPI, DataServiceMocked, split_response
+from database import WeatherDatabase
+from location import Location
+import stub_server
+
+FIXTURE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "fixtures", "forecast_multi.json")
+
+def read_fixture() -> list:
+    with open(FIXTURE_FILE) as f:
+        return json.load(f)
+
+def write_config(tmp_path, server, batch_size: int) -> str:
+    config = {"configuration": {
+        "url": "http://127.0.0.1:" + str(server.server_port) + "/v1/forecast",
+        "payload": {"hourly": ["precipitation_probability", "precipitation", "wind_speed_10m"]},
+        "hourly_units": {"precipitation_unit": "inch", "wind_speed_unit": "mph"},
+        "fetch": {"batch_size": batch_size, "retries": 0, "requests_per_second": 1000},
+    }}
+    filename = str(tmp_path / "config.json")
+    with open(filename, "w") as f:
+        json.dump(config, f)
+    return filename
+
+@pytest.fixture
+def serve(tmp_path):
+    """
+    Get a function that starts the stand-in server, optionally replaying a response.
+    """
+    servers = []
+    def start(response=None):
+        fixture = None
+        if response is not None:
+            fixture = str(tmp_path / "response.json")
+            with open(fixture, "w") as f:
+                json.dump(response, f)
+        servers.append(stub_server.start_server(fixture=fixture))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def make_service(tmp_path, server, batch_size: int):
+    database = WeatherDatabase(str(tmp_path / "weather.db"))
+    return DataServiceFromAPI(write_config(tmp_path, server, batch_size), database), database
+
+def test_download_many_splits_the_fixture_by_location_id(tmp_path, serve):
+    fixture = read_fixture()
+    locations = [Location(item["longitude"], item["latitude"]) for item in fixture]
+    # the items of the response are not in the order of the request
+    server = serve(list(reversed(fixture)))
+    service, database = make_service(tmp_path, server, batch_size=len(fixture))
+    try:
+        assert service.download_many(locations) == len(fixture)
+    finally:
+        service.close()
+    for location, item in zip(locations, sorted(fixture, key=lambda item: item["location_id"])):
+        df = database.get_location_record(location)
+        assert len(df) == len(item["hourly"]["time"])
+        assert df.index[0] == np.datetime64(item["hourly"]["time"][0])
+        for measure in ("precipitation_probability", "precipitation", "wind_speed_10m"):
+            np.testing.assert_allclose(df[measure], item["hourly"][measure])
+        assert database.get_last_fetched(location) is not None
+
+def test_split_response_orders_by_location_id():
+    fixture = read_fixture()
+    hourly = split_response(list(reversed(fixture)), len(fixture))
+    assert hourly == [item["hourly"] for item in sorted(fixture, key=lambda item: item["location_id"])]
+    # one location is an object, not a list
+    assert split_response(fixture[0], 1) == [fixture[0]["hourly"]]
+
+def test_split_response_checks_the_number_of_locations():
+    with pytest.raises(ValueError, match="has 3 locations, expected 2"):
+        split_response(read_fixture(), 2)
+
+def test_download_many_skips_a_response_with_other_locations(tmp_path, serve):
+    fixture = read_fixture()
+    locations = [Location(item["longitude"], item["latitude"]) for item in fixture[:2]]
+    server = serve(fixture)
+    service, database = make_service(tmp_path, server, batch_size=2)
+    try:
+        assert service.download_many(locations) == 0
+    finally:
+        service.close()
+    for location in locations:
+        assert database.get_location_record(location).empty
+        assert database.get_last_fetched(location) is None
+
+def test_download_many_from_the_stub_server(tmp_path, serve):
+    server = serve()
+    service, database = make_service(tmp_path, server, batch_size=3)
+    locations = [Location(longitude=10.0 + i, latitude=50.0 - i) for i in range(7)]
+    try:
+        assert service.download_many(locations) == len(locations)
+        # the locations are up to date, so nothing is downloaded again
+        assert service.download_many(locations) == 0
+    finally:
+        service.close()
+    start = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    for location in locations:
+        df = database.get_location_record(location)
+        expected = stub_server.make_hourly(location.get_longitude(), location.get_latitude(), start, 7 * 24)
+        assert len(df) == 7 * 24
+        np.testing.assert_allclose(df["wind_speed_10m"], expected["wind_speed_10m"])
+
+def test_resolve_locations_merges_nearby_locations(tmp_path):
+    config = str(tmp_path / "config.json")
+    with open(config, "w") as f:
+        json.dump({"configuration": {"database": {"snap_distance": 1.0}}}, f)
+    database = WeatherDatabase(str(tmp_path / "weather.db"))
+    service = DataServiceMocked(config, database)
+    service.download_data(Location(longitude=-122.43, latitude=37.77))
+    locations = [Location(longitude=13.41, latitude=52.52),
+                 Location(longitude=13.4105, latitude=52.5201),
+                 Location(longitude=-122.4302, latitude=37.7701),
+                 Location(longitude=2.35, latitude=48.85)]
+    resolved = service.resolve_locations(locations)
+    # about 40 m apart: both new locations are downloaded as the first one
+    assert resolved[0] is locations[0] and resolved[1] is locations[0]
+    # near a stored location
+    assert (resolved[2].get_longitude(), resolved[2].get_latitude()) == (-122.43, 37.77)
+    assert resolved[3] is locations[3]
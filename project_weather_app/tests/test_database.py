@@ -0,0 +1,49 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from database import WeatherDatabase
+from location import Location
+
+BERLIN = Location(longitude=13.41, latitude=52.52)
+SAN_FRANCISCO = Location(longitude=-122.43, latitude=37.77)
+
+def make_forecast(value: float, hours: int = 24) -> pd.DataFrame:
+    return pd.DataFrame({"time": pd.date_range("2024-01-01", periods=hours, freq="h"),
+                         "precipitation_probability": np.full(hours, value),
+                         "precipitation": np.full(hours, value),
+                         "wind_speed_10m": np.full(hours, value)})
+
+def test_reset_by_another_connection_keeps_the_location_ids(tmp_path):
+    reader = WeatherDatabase(str(tmp_path / "weather.db"))
+    writer = WeatherDatabase(str(tmp_path / "weather.db"))
+    writer.insert_records(BERLIN, make_forecast(1.0))
+    assert (reader.query(BERLIN)["wind_speed_10m"] == 1.0).all()
+    writer.reset()
+    writer.insert_records(SAN_FRANCISCO, make_forecast(2.0))
+    writer.insert_records(BERLIN, make_forecast(3.0))
+    assert (reader.query(BERLIN)["wind_speed_10m"] == 3.0).all()
+    assert (reader.query(SAN_FRANCISCO)["wind_speed_10m"] == 2.0).all()
+
+def test_rolled_back_location_is_not_cached(tmp_path):
+    database = WeatherDatabase(str(tmp_path / "weather.db"))
+    # the second forecast of Berlin reads its id in the transaction, then the third one fails
+    with pytest.raises(SystemExit):
+        database.insert_many([(BERLIN, make_forecast(1.0)), (BERLIN, make_forecast(1.0)),
+                              (SAN_FRANCISCO, {"time": ["not a time"]})])
+    database.insert_records(SAN_FRANCISCO, make_forecast(2.0),
+                            fetched_at=datetime.datetime(2024, 1, 1))
+    assert database.query(BERLIN).empty
+    assert database.get_last_fetched(BERLIN) is None
+    assert (database.query(SAN_FRANCISCO)["wind_speed_10m"] == 2.0).all()
+
+def test_locations_added_by_another_connection_are_found(tmp_path):
+    reader = WeatherDatabase(str(tmp_path / "weather.db"))
+    writer = WeatherDatabase(str(tmp_path / "weather.db"))
+    writer.insert_records(SAN_FRANCISCO, make_forecast(1.0))
+    assert reader.find_nearest(BERLIN, 10) is None
+    writer.insert_records(BERLIN, make_forecast(1.0))
+    nearest = reader.find_nearest(Location(longitude=13.42, latitude=52.52), 10)
+    assert (nearest.get_longitude(), nearest.get_latitude()) == (13.41, 52.52)
@@ -0,0 +1,92 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from database import WeatherDatabase
+from decimate import (bucket_envelope, decimate_frame, decimate_series, get_bucket_minutes,
+                      interleave_envelope, lttb, minmax)
+from decode import MEASURES, minutes_to_time, time_to_minutes
+from location import Location
+
+BERLIN = Location(longitude=13.41, latitude=52.52)
+
+def make_series(n: int) -> pd.Series:
+    x = np.arange(n)
+    return pd.Series(np.sin(x / 20.0) * 10 + (x % 7 == 0) * 5.0,
+                     index=pd.date_range("2024-01-01", periods=n, freq="h"))
+
+@pytest.mark.parametrize("n, n_out", [(10, 10), (10, 50), (10, 2), (10, 0)])
+def test_lttb_keeps_all_points_of_a_short_series_or_a_small_target(n, n_out):
+    series = make_series(n)
+    np.testing.assert_array_equal(lttb(series.index.asi8, series.to_numpy(), n_out), np.arange(n))
+
+@pytest.mark.parametrize("n, n_buckets", [(10, 5), (10, 50), (10, 0)])
+def test_minmax_keeps_all_points_of_a_short_series_or_no_buckets(n, n_buckets):
+    np.testing.assert_array_equal(minmax(make_series(n).to_numpy(), n_buckets), np.arange(n))
+
+def test_lttb_keeps_the_first_and_last_point():
+    series = make_series(1000)
+    indices = lttb(series.index.asi8, series.to_numpy(), 50)
+    assert len(indices) == 50
+    assert indices[0] == 0 and indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+
+def test_minmax_keeps_the_first_and_last_point_and_the_extremes():
+    y = make_series(1000).to_numpy().copy()
+    y[500] = 100.0
+    y[501] = -100.0
+    indices = minmax(y, 30)
+    assert len(indices) <= 2 * 30 + 2
+    assert indices[0] == 0 and indices[-1] == 999
+    assert {500, 501} <= set(indices)
+    assert np.all(np.diff(indices) > 0)
+
+@pytest.mark.parametrize("method", ["lttb", "minmax"])
+def test_decimate_series_drops_missing_values(method):
+    series = make_series(1000)
+    series.iloc[::3] = np.nan
+    series.iloc[-1] = np.nan
+    decimated = decimate_series(series, 20, method)
+    assert not decimated.isna().any()
+    assert decimated.index[0] == series.index[1]
+    assert decimated.index[-1] == series.index[-2]
+    if method == "lttb":
+        assert len(decimated) == 20
+    else:
+        assert len(decimated) <= 2 * 20 + 2
+        assert decimated.min() == series.min() and decimated.max() == series.max()
+
+def test_decimate_frame_decimates_each_column():
+    series = make_series(1000)
+    df = pd.DataFrame({"precipitation": series, "wind_speed_10m": series.where(series.index.hour < 12)})
+    decimated = decimate_frame(df, 20, "minmax")
+    assert list(decimated) == ["precipitation", "wind_speed_10m"]
+    # the columns keep different times
+    assert not decimated["precipitation"].index.equals(decimated["wind_speed_10m"].index)
+    assert all(decimated["wind_speed_10m"].index.hour < 12)
+    # a short frame is not decimated
+    assert decimate_frame(df.iloc[:10], 20)["precipitation"].equals(df["precipitation"].iloc[:10])
+    with pytest.raises(ValueError):
+        decimate_frame(df, 20, "mean")
+
+def test_query_decimated_matches_the_envelope_in_python(tmp_path):
+    database = WeatherDatabase(str(tmp_path / "weather.db"))
+    # irregular times, so some buckets have one record or none, and missing values
+    times = pd.date_range("2024-01-01", periods=2000, freq="h").delete(np.s_[300:340])
+    values = make_series(len(times)).to_numpy()
+    df = pd.DataFrame({"time": times,
+                       "precipitation_probability": values,
+                       "precipitation": np.where(np.arange(len(times)) % 5 == 0, np.nan, values / 10),
+                       "wind_speed_10m": values * 2})
+    database.insert_records(BERLIN, df, fetched_at=datetime.datetime(2024, 3, 1))
+    full = database.get_location_record(BERLIN)
+    for buckets in (1, 37, 200, 5000):
+        minutes = time_to_minutes(full.index.to_numpy())
+        first_minute = int(minutes[0])
+        envelope = bucket_envelope(minutes, {column: full[column].to_numpy() for column in MEASURES},
+                                   first_minute, get_bucket_minutes(first_minute, int(minutes[-1]), buckets))
+        expected_minutes, expected = interleave_envelope(*envelope)
+        expected = pd.DataFrame(expected, index=minutes_to_time(expected_minutes))
+        pd.testing.assert_frame_equal(database.query_decimated(BERLIN, buckets), expected, check_freq=False)
@@ -0,0 +1,138 @@
+"""
+Tests of the persistent cache of the API responses (http_cache.py), alone and
+through HttpClient and DataServiceFromAPI against the local stand-in of the API.
+"""
+import json
+
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from data_service import DataServiceFromAPI
+from database import WeatherDatabase
+from http_client import HttpClient
+from location import Location
+import http_cache
+import metrics
+import stub_server
+
+URL = "http://127.0.0.1/v1/forecast"
+PARAMS = {"longitude": "13.41", "latitude": "52.52", "hourly": "precipitation"}
+
+def make_response(body: bytes = b'{"hourly": {}}', **headers) -> requests.Response:
+    r = requests.Response()
+    r.status_code = 200
+    r.headers = CaseInsensitiveDict(headers)
+    r._content = body
+    return r
+
+@pytest.fixture
+def server():
+    server = stub_server.start_server(max_age=0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = http_cache.HttpCache(str(tmp_path / "http_cache.db"), compression="gzip")
+    yield cache
+    cache.close()
+
+def test_expiry_at_max_age_or_next_model_run(cache):
+    cache.store(URL, PARAMS, make_response(**{"Cache-Control": "max-age=60"}))
+    cached = cache.lookup(URL, PARAMS)
+    assert cached.body == b'{"hourly": {}}'
+    assert cached.expires_at <= cached.stored_at + 60
+    assert cached.is_fresh(cached.stored_at) and not cached.is_fresh(cached.stored_at + 60)
+    # without max-age, the response expires when the next model run is available
+    cache.store(URL, PARAMS, make_response())
+    cached = cache.lookup(URL, PARAMS)
+    assert cached.expires_at == cache.get_next_model_run(cached.stored_at)
+    cache.store(URL, PARAMS, make_response(**{"Cache-Control": "no-cache"}))
+    assert not cache.lookup(URL, PARAMS).is_fresh()
+    cache.store(URL, {"other": 1}, make_response(**{"Cache-Control": "no-store"}))
+    assert cache.lookup(URL, {"other": 1}) is None
+
+def test_next_model_run(cache):
+    # runs every 3 hours from 00:00 UTC, available 2 hours after their start
+    assert cache.get_next_model_run(0) == 7200
+    assert cache.get_next_model_run(7199) == 7200
+    assert cache.get_next_model_run(7200) == 18000
+    assert cache.get_next_model_run(86400 + 3600) == 86400 + 7200
+
+def test_start_hour_is_not_in_the_key():
+    incremental = dict(PARAMS, start_hour="2026-09-01T06:00", end_hour="2026-09-07T23:00")
+    later = dict(incremental, start_hour="2026-09-01T09:00")
+    assert http_cache.HttpCache.get_key(URL, incremental) == http_cache.HttpCache.get_key(URL, later)
+    assert http_cache.HttpCache.get_key(URL, incremental) != http_cache.HttpCache.get_key(
+        URL, dict(incremental, end_hour="2026-09-08T23:00"))
+
+def test_stale_response_is_revalidated(cache, server):
+    client = HttpClient(requests_per_second=1000, retries=0, cache=cache)
+    url = "http://127.0.0.1:" + str(server.server_port) + "/v1/forecast"
+    first = client.get(url, PARAMS)
+    assert first.status_code == 200 and not getattr(first, "from_cache", False)
+    # max-age=0: the stored response is stale at once, and the server answers 304
+    second = client.get(url, PARAMS)
+    assert second.from_cache and second.content == first.content
+    assert server.not_modified == 1
+    assert cache.misses == 2 and cache.hits == 0 and cache.revalidated == 1
+    assert cache.bytes_saved == len(first.content)
+
+def test_zstd_falls_back_to_gzip(tmp_path, monkeypatch):
+    monkeypatch.setattr(http_cache, "zstandard", None)
+    cache = http_cache.HttpCache(str(tmp_path / "http_cache.db"), compression="zstd")
+    try:
+        cache.store(URL, PARAMS, make_response())
+        assert cache.lookup(URL, PARAMS).body == b'{"hourly": {}}'
+        # a response stored with zstd before is requested again
+        cache._conn.execute("UPDATE responses SET compression = 'zstd';")
+        assert cache.lookup(URL, PARAMS) is None
+    finally:
+        cache.close()
+    with pytest.raises(ValueError):
+        http_cache.HttpCache(str(tmp_path / "other.db"), compression="lz4")
+
+def test_zstd_reads_gzip_responses(tmp_path):
+    pytest.importorskip("zstandard")
+    filename = str(tmp_path / "http_cache.db")
+    cache = http_cache.HttpCache(filename, compression="gzip")
+    cache.store(URL, PARAMS, make_response())
+    cache.close()
+    cache = http_cache.HttpCache(filename, compression="zstd")
+    try:
+        assert cache.lookup(URL, PARAMS).body == b'{"hourly": {}}'
+        cache.store(URL, PARAMS, make_response(b'{"hourly": {"time": []}}'))
+        assert cache.lookup(URL, PARAMS).body == b'{"hourly": {"time": []}}'
+    finally:
+        cache.close()
+
+def test_incremental_refresh_is_answered_from_the_cache(tmp_path):
+    server = stub_server.start_server(max_age=3600)
+    config = str(tmp_path / "config.json")
+    with open(config, "w") as f:
+        json.dump({"configuration": {
+            "url": "http://127.0.0.1:" + str(server.server_port) + "/v1/forecast",
+            "payload": {"hourly": ["precipitation_probability", "precipitation", "wind_speed_10m"]},
+            "fetch": {"retries": 0, "requests_per_second": 1000},
+            "http_cache": {"enabled": True, "file": str(tmp_path / "http_cache.db"), "compression": "gzip"},
+        }}, f)
+    service = DataServiceFromAPI(config, WeatherDatabase(str(tmp_path / "weather.db")))
+    metrics.enable()
+    try:
+        location = Location(longitude=13.41, latitude=52.52)
+        # the first download asks for the forecast days, the refreshes for the hours since the last download
+        assert service.download_data(location)
+        assert service.download_data(location)
+        downloaded = metrics.get_registry().to_dict()["counters"]["bytes_downloaded"]
+        # the next refresh starts later, and is in the stored response of the first refresh
+        assert service.download_data(location)
+        counters = metrics.get_registry().to_dict()["counters"]
+        assert counters["http_cache_hits"] == 1
+        assert counters["bytes_downloaded"] == downloaded
+    finally:
+        metrics.disable()
+        service.close()
+        server.shutdown()
+        server.server_close()
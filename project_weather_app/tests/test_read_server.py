@@ -0,0 +1,89 @@
+import asyncio
+import datetime
+import json
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from database import WeatherDatabase
+from location import Location
+from read_server import ReadServer
+
+BERLIN = Location(longitude=13.41, latitude=52.52)
+
+@pytest.fixture
+def database(tmp_path):
+    database = WeatherDatabase(str(tmp_path / "weather.db"))
+    hours = 48
+    database.insert_records(BERLIN, pd.DataFrame({
+        "time": pd.date_range("2026-08-31", periods=hours, freq="h"),
+        "precipitation_probability": np.arange(hours, dtype=np.float64),
+        "precipitation": np.zeros(hours),
+        "wind_speed_10m": np.zeros(hours)}), fetched_at=datetime.datetime(2026, 8, 31))
+    return database
+
+def get(database, paths):
+    """
+    Start the server, and get the status and json body of each path.
+    """
+    async def run():
+        server = ReadServer(database, port=0, readers=2)
+        await server.start()
+        loop = asyncio.get_running_loop()
+        try:
+            return [await loop.run_in_executor(None, fetch, "http://127.0.0.1:" + str(server.port) + path)
+                    for path in paths]
+        finally:
+            await server.stop()
+
+    def fetch(url):
+        try:
+            with urllib.request.urlopen(url, timeout=10) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as err:
+            return err.code, None
+    return asyncio.run(run())
+
+def test_forecast_time_range_with_utc_offset(database):
+    # 00:00 and 02:00 at +02:00 are 22:00 and 24:00 UTC of the day before
+    escaped, unescaped, utc, bad = get(database, [
+        "/forecast?lat=52.52&lon=13.41&start=2026-09-01T00:00%2B02:00&end=2026-09-01T02:00%2B02:00",
+        "/forecast?lat=52.52&lon=13.41&start=2026-09-01T00:00+02:00&end=2026-09-01T02:00+02:00",
+        "/forecast?lat=52.52&lon=13.41&start=2026-08-31T22:00&end=2026-09-01T00:00Z",
+        "/forecast?lat=52.52&lon=13.41&start=yesterday"])
+    for status, body in (escaped, unescaped, utc):
+        assert status == 200
+        assert [record["time"] for record in body["records"]] == ["2026-08-31T22:00", "2026-08-31T23:00"]
+        assert [record["precipitation_probability"] for record in body["records"]] == [22.0, 23.0]
+    assert bad[0] == 400
+
+def test_failed_stream_closes_the_connection(database):
+    def failing_handler(params, response_format):
+        yield b'{"records": ['
+        raise ValueError("lost the database")
+
+    async def run():
+        server = ReadServer(database, port=0, readers=2)
+        server._routes["/forecast"] = failing_handler
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"GET /forecast HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            await writer.drain()
+            # the server closes the connection, so the read ends
+            response = await asyncio.wait_for(reader.read(), timeout=10)
+            writer.close()
+            return response, server.errors
+        finally:
+            await server.stop()
+
+    response, errors = asyncio.run(run())
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert response.count(b"HTTP/1.1") == 1
+    assert b'{"records": [' in response
+    # the body ends without the last chunk
+    assert not response.endswith(b"0\r\n\r\n")
+    assert errors == 1
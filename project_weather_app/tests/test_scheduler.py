@@ -0,0 +1,47 @@
+import threading
+import time
+
+from location import Location
+from scheduler import Scheduler
+
+class SlowDataHandler():
+    """
+    Stands in for DataHandler: each refresh takes delay seconds.
+    """
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.refreshed = []
+        self._lock = threading.Lock()
+
+    def refresh(self, location: Location, force: bool = False) -> bool:
+        time.sleep(self.delay)
+        with self._lock:
+            self.refreshed.append(location)
+        return True
+
+class NeverFetchedDatabase():
+    def get_last_fetched(self, location: Location):
+        return None
+
+def test_busy_workers_do_not_spin():
+    # more due locations than workers: the loop waits for a free worker
+    data_handler = SlowDataHandler(delay=0.5)
+    scheduler = Scheduler(data_handler, NeverFetchedDatabase(), max_workers=1, jitter=0, state_file=None)
+    for i in range(3):
+        scheduler.add(Location(longitude=float(i), latitude=0.0), interval=3600)
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    scheduler.run(duration=1.6)
+    cpu = time.process_time() - start_cpu
+    assert len(data_handler.refreshed) == 3
+    assert time.perf_counter() - start < 3
+    assert cpu < 0.5
+
+def test_due_locations_are_refreshed_once_per_interval():
+    data_handler = SlowDataHandler(delay=0)
+    scheduler = Scheduler(data_handler, NeverFetchedDatabase(), max_workers=2, jitter=0, state_file=None)
+    for i in range(4):
+        scheduler.add(Location(longitude=float(i), latitude=0.0), interval=3600)
+    scheduler.run(duration=0.5)
+    assert sorted(location.get_longitude() for location in data_handler.refreshed) == [0.0, 1.0, 2.0, 3.0]
+    assert scheduler.refreshes == 4 and scheduler.failures == 0
@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from single_flight import SingleFlight
+
+N_THREADS = 8
+
+def wait_until(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def run_threads(flight: SingleFlight, func, n: int = N_THREADS, **kwargs):
+    """
+    Call flight.do() with one key in n threads, and get the result or exception of each.
+    """
+    outcomes = [None] * n
+
+    def call(i: int):
+        try:
+            outcomes[i] = flight.do("key", func, **kwargs)
+        except BaseException as err:
+            outcomes[i] = err
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+def test_concurrent_calls_run_once():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(1)
+        release.wait(timeout=10)
+        return "forecast"
+
+    threads, outcomes = run_threads(flight, func)
+    # the leader runs until all other callers wait for it
+    wait_until(lambda: flight.coalesced == N_THREADS - 1)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert calls == [1]
+    assert outcomes == ["forecast"] * N_THREADS
+    assert flight.leaders == 1
+    # the call is no longer in flight
+    assert flight.do("key", lambda: "next") == "next"
+
+def test_exception_of_the_leader_is_raised_in_every_caller():
+    flight = SingleFlight()
+    release = threading.Event()
+    error = ValueError("API down")
+
+    def func():
+        release.wait(timeout=10)
+        raise error
+
+    threads, outcomes = run_threads(flight, func)
+    wait_until(lambda: flight.coalesced == N_THREADS - 1)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert all(outcome is error for outcome in outcomes)
+
+def test_waiter_times_out_while_the_leader_finishes():
+    flight = SingleFlight(timeout=0.05)
+    release = threading.Event()
+
+    def func():
+        release.wait(timeout=10)
+        return "forecast"
+
+    threads, outcomes = run_threads(flight, func, n=2)
+    wait_until(lambda: flight.timeouts == 1)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=10)
+    # the leader is not limited by the timeout
+    assert outcomes.count("forecast") == 1
+    assert sum(isinstance(outcome, TimeoutError) for outcome in outcomes) == 1
+
+def test_cancelled_async_caller_does_not_cancel_the_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "forecast"
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do_async("key", func))
+        waiter = asyncio.ensure_future(flight.do_async("key", func))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(run()) == "forecast"
+    assert calls == [1]
+    assert flight.leaders == 1 and flight.coalesced == 1
+
+def test_async_and_thread_callers_share_the_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(1)
+        release.wait(timeout=10)
+        return "forecast"
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do_async("key", func))
+        await asyncio.sleep(0.01)
+        threads, outcomes = run_threads(flight, func, n=2)
+        await asyncio.get_running_loop().run_in_executor(
+            None, wait_until, lambda: flight.coalesced == 2)
+        release.set()
+        result = await leader
+        for thread in threads:
+            thread.join(timeout=10)
+        return [result] + outcomes
+
+    assert asyncio.run(run()) == ["forecast"] * 3
+    assert calls == [1]
@@ -0,0 +1,172 @@
+"""
+Conformance tests of the storages of the weather data (IWeatherStorage):
+each test runs against WeatherDatabase and ColumnarWeatherStore.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from columnar_store import ColumnarWeatherStore
+from database import WeatherDatabase
+from decode import MEASURES
+from location import Location
+
+BERLIN = Location(longitude=13.41, latitude=52.52)
+SAN_FRANCISCO = Location(longitude=-122.43, latitude=37.77)
+
+# two months of hourly records, so the columnar store has two partitions
+HOURS = 24 * 40
+START = pd.Timestamp("2024-01-01")
+
+def make_forecast(offset: float = 0.0, hours: int = HOURS, start=START) -> pd.DataFrame:
+    values = np.arange(hours, dtype=np.float64) + offset
+    return pd.DataFrame({"time": pd.date_range(start, periods=hours, freq="h"),
+                         "precipitation_probability": values,
+                         "precipitation": values / 100,
+                         "wind_speed_10m": values / 10})
+
+@pytest.fixture(params=["sqlite", "columnar"])
+def make_storage(request, tmp_path):
+    """
+    Get a function that creates the storage with an on_conflict policy.
+    """
+    def make(on_conflict: str = "update"):
+        if request.param == "sqlite":
+            return WeatherDatabase(str(tmp_path / "weather.db"), on_conflict=on_conflict)
+        return ColumnarWeatherStore(str(tmp_path / "weather_columnar"), on_conflict=on_conflict)
+    return make
+
+@pytest.fixture
+def storage(make_storage):
+    return make_storage()
+
+def test_insert_and_get_location_record(storage):
+    assert storage.insert_records(BERLIN, make_forecast()) == HOURS
+    df = storage.get_location_record(BERLIN)
+    assert list(df.columns) == MEASURES
+    assert len(df) == HOURS
+    assert df.index[0] == START
+    np.testing.assert_allclose(df["wind_speed_10m"], make_forecast()["wind_speed_10m"])
+    assert storage.get_location_record(SAN_FRANCISCO).empty
+
+def test_insert_single_record(storage):
+    storage.insert_single_record(BERLIN, "2024-01-01T05:00", 50.0, 0.5, 5.0)
+    df = storage.get_location_record(BERLIN)
+    assert len(df) == 1
+    assert df.index[0] == pd.Timestamp("2024-01-01T05:00")
+    assert df.iloc[0].tolist() == [50.0, 0.5, 5.0]
+
+@pytest.mark.parametrize("on_conflict, expected_offset", [("update", 1000.0), ("ignore", 0.0)])
+def test_on_conflict_policy(make_storage, on_conflict, expected_offset):
+    storage = make_storage(on_conflict)
+    storage.insert_records(BERLIN, make_forecast(0.0))
+    # the second forecast overlaps the last day of the first one
+    storage.insert_records(BERLIN, make_forecast(1000.0, hours=48, start=START + pd.Timedelta(hours=HOURS - 24)))
+    df = storage.get_location_record(BERLIN)
+    assert len(df) == HOURS + 24
+    overlap = START + pd.Timedelta(hours=HOURS - 1)
+    assert df.loc[overlap, "precipitation_probability"] == expected_offset + (23 if expected_offset else HOURS - 1)
+    assert df.index.is_monotonic_increasing
+
+def test_duplicated_times_keep_the_last(storage):
+    data = pd.concat([make_forecast(0.0, hours=2), make_forecast(7.0, hours=2)])
+    assert storage.insert_records(BERLIN, data) == 2
+    assert storage.get_location_record(BERLIN)["precipitation_probability"].tolist() == [7.0, 8.0]
+
+def test_insert_many_and_query_locations(storage):
+    storage.insert_many([(BERLIN, make_forecast(0.0)), (SAN_FRANCISCO, make_forecast(5.0))])
+    df = storage.query([BERLIN, SAN_FRANCISCO], columns=["wind_speed_10m"])
+    assert list(df.columns) == ["longitude", "latitude", "wind_speed_10m"]
+    assert len(df) == 2 * HOURS
+    san_francisco = df[df["longitude"] == SAN_FRANCISCO.get_longitude()]
+    np.testing.assert_allclose(san_francisco["wind_speed_10m"], make_forecast(5.0)["wind_speed_10m"])
+
+def test_query_range_and_columns(storage):
+    storage.insert_records(BERLIN, make_forecast())
+    df = storage.query(BERLIN, start="2024-01-31T12:00", end=datetime.datetime(2024, 2, 1, 12),
+                       columns=["precipitation", "wind_speed_10m"])
+    assert list(df.columns) == ["precipitation", "wind_speed_10m"]
+    assert len(df) == 24
+    assert df.index[0] == pd.Timestamp("2024-01-31T12:00")
+    assert df.index[-1] == pd.Timestamp("2024-02-01T11:00")
+    assert storage.query(BERLIN, start="2025-01-01").empty
+    assert storage.query(BERLIN, columns="precipitation").columns.tolist() == ["precipitation"]
+
+def test_query_unknown_column(storage):
+    storage.insert_records(BERLIN, make_forecast())
+    with pytest.raises(SystemExit):
+        storage.query(BERLIN, columns=["temperature"])
+
+def test_query_decimated(storage):
+    storage.insert_records(BERLIN, make_forecast())
+    df = storage.query_decimated(BERLIN, 20)
+    full = storage.get_location_record(BERLIN)
+    assert list(df.columns) == MEASURES
+    assert 0 < len(df) <= 2 * 20
+    assert df.index.is_monotonic_increasing
+    # the envelope keeps the first and last records, and the extremes
+    assert df.index[0] == full.index[0] and df.index[-1] == full.index[-1]
+    for column in MEASURES:
+        assert df[column].min() == full[column].min()
+        assert df[column].max() == full[column].max()
+    assert storage.query_decimated(SAN_FRANCISCO, 20).empty
+
+def test_query_decimated_range(storage):
+    storage.insert_records(BERLIN, make_forecast())
+    df = storage.query_decimated(BERLIN, 10, start="2024-01-10", end="2024-01-20", columns=["precipitation"])
+    assert list(df.columns) == ["precipitation"]
+    assert df.index[0] >= pd.Timestamp("2024-01-10") and df.index[-1] < pd.Timestamp("2024-01-20")
+    assert len(df) <= 2 * 10
+
+def test_get_all_data(storage):
+    storage.insert_many([(BERLIN, make_forecast(0.0)), (SAN_FRANCISCO, make_forecast(5.0))])
+    df = storage.get_all_data()
+    assert list(df.columns) == ["longitude", "latitude"] + MEASURES
+    assert len(df) == 2 * HOURS
+    # ordered by longitude, latitude and time
+    assert df["longitude"].iloc[0] == SAN_FRANCISCO.get_longitude()
+    assert df["longitude"].iloc[-1] == BERLIN.get_longitude()
+    assert df[df["longitude"] == BERLIN.get_longitude()].index.is_monotonic_increasing
+
+def test_iter_chunks(storage):
+    storage.insert_many([(BERLIN, make_forecast(0.0)), (SAN_FRANCISCO, make_forecast(5.0))])
+    chunks = list(storage.iter_chunks(chunk_rows=100, columns=["precipitation"]))
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    df = pd.concat(chunks)
+    assert list(df.columns) == ["longitude", "latitude", "precipitation"]
+    pd.testing.assert_frame_equal(df, storage.get_all_data()[["longitude", "latitude", "precipitation"]],
+                                  check_freq=False)
+
+def test_last_fetched(storage):
+    fetched_at = datetime.datetime(2024, 3, 1, 12, 30)
+    assert storage.get_last_fetched(BERLIN) is None
+    storage.insert_records(BERLIN, make_forecast())
+    assert storage.get_last_fetched(BERLIN) is None
+    storage.insert_records(BERLIN, make_forecast(), fetched_at=fetched_at)
+    assert storage.get_last_fetched(BERLIN) == fetched_at
+    storage.insert_many([(BERLIN, make_forecast()), (SAN_FRANCISCO, make_forecast())],
+                        fetched_at=fetched_at + datetime.timedelta(hours=1))
+    assert storage.get_last_fetched(BERLIN) == fetched_at + datetime.timedelta(hours=1)
+    assert storage.get_last_fetched(SAN_FRANCISCO) == fetched_at + datetime.timedelta(hours=1)
+
+def test_reset(storage):
+    storage.insert_records(BERLIN, make_forecast(), fetched_at=datetime.datetime(2024, 3, 1))
+    storage.reset()
+    assert storage.get_location_record(BERLIN).empty
+    assert storage.get_all_data().empty
+    assert storage.get_last_fetched(BERLIN) is None
+    storage.insert_records(BERLIN, make_forecast(3.0))
+    assert storage.get_location_record(BERLIN)["precipitation_probability"].iloc[0] == 3.0
+
+def test_find_nearest(make_storage):
+    reader, writer = make_storage(), make_storage()
+    writer.insert_records(SAN_FRANCISCO, make_forecast())
+    assert reader.find_nearest(BERLIN, 10) is None
+    # a location added by another instance is found
+    writer.insert_records(BERLIN, make_forecast())
+    nearest = reader.find_nearest(Location(longitude=13.42, latitude=52.52), 10)
+    assert (nearest.get_longitude(), nearest.get_latitude()) == (13.41, 52.52)
+    df = reader.nearest_locations([BERLIN], 2)
+    assert len(df) == 2
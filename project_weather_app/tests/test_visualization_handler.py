@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from visualization_handler import HeadlessVisualizationHandler
+
+def make_frame(maxima) -> pd.DataFrame:
+    """
+    A day of hourly data rising to maxima of precipitation probability, precipitation and wind speed.
+    """
+    ramp = np.linspace(0, 1, 24)
+    return pd.DataFrame({"precipitation_probability": ramp * maxima[0],
+                         "precipitation": ramp * maxima[1],
+                         "wind_speed_10m": ramp * maxima[2]},
+                        index=pd.date_range("2024-01-01", periods=24, freq="h"))
+
+def get_ylims(handler: HeadlessVisualizationHandler):
+    return [axis.get_ylim() for axis in handler._axes]
+
+def test_reused_figure_is_rescaled_to_each_frame():
+    handler = HeadlessVisualizationHandler(decimation=None)
+    handler.render(make_frame((10, 0.1, 5)))
+    handler.render(make_frame((90, 3, 50)))
+    fresh = HeadlessVisualizationHandler(decimation=None)
+    fresh.render(make_frame((90, 3, 50)))
+    assert get_ylims(handler) == get_ylims(fresh)
+    for (bottom, top), maximum in zip(get_ylims(handler), (90, 3, 50)):
+        assert bottom == 0 and top >= maximum
+
+def test_render_returns_png():
+    data = HeadlessVisualizationHandler().render(make_frame((10, 0.1, 5)))
+    assert data.startswith(b"\x89PNG")
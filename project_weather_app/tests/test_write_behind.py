@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from location import Location
+from write_behind import WriteBehindQueue
+
+class RecordingDatabase():
+    """
+    Stands in for the storage: records the locations of each commit. The first commit
+    waits for release(), so the forecasts put meanwhile are queued together.
+    """
+    def __init__(self, error: Exception = None):
+        self.commits = []
+        self.error = error
+        self.started = threading.Event()
+        self._release = threading.Event()
+
+    def release(self):
+        self._release.set()
+
+    def insert_many(self, forecasts, fetched_at=None):
+        forecasts = list(forecasts)
+        self.started.set()
+        self._release.wait(timeout=10)
+        if self.error is not None:
+            raise self.error
+        self.commits.append([location.get_longitude() for location, _ in forecasts])
+        return sum(len(data["time"]) for _, data in forecasts)
+
+def make_data(rows: int) -> dict:
+    return {"time": list(range(rows))}
+
+def put_while_blocked(writer: WriteBehindQueue, database: RecordingDatabase, puts):
+    """
+    Put a first forecast, and the (longitude, rows, delay) of puts while its commit runs.
+    """
+    futures = [writer.put(Location(0.0, 0.0), make_data(1))]
+    assert database.started.wait(timeout=10)
+    for longitude, rows, delay in puts:
+        time.sleep(delay)
+        futures.append(writer.put(Location(longitude, 0.0), make_data(rows)))
+    database.release()
+    return futures
+
+def test_group_commit_up_to_commit_rows():
+    database = RecordingDatabase()
+    writer = WriteBehindQueue(database, commit_rows=50, commit_interval=60)
+    futures = put_while_blocked(writer, database, [(float(i), 20, 0) for i in range(1, 6)])
+    writer.close()
+    # a group takes forecasts until it has commit_rows records
+    assert database.commits == [[0.0], [1.0, 2.0, 3.0], [4.0, 5.0]]
+    assert [future.result() for future in futures] == [1, 20, 20, 20, 20, 20]
+    assert writer.commits == 3 and writer.rows == 101
+
+def test_group_commit_up_to_commit_interval():
+    database = RecordingDatabase()
+    writer = WriteBehindQueue(database, commit_rows=1000, commit_interval=0.1)
+    put_while_blocked(writer, database, [(1.0, 1, 0), (2.0, 1, 0.3), (3.0, 1, 0)])
+    writer.close()
+    # the forecast queued after the interval ends the group
+    assert database.commits == [[0.0], [1.0, 2.0], [3.0]]
+
+def test_failed_commit_fails_every_future():
+    error = ValueError("disk full")
+    database = RecordingDatabase(error=error)
+    writer = WriteBehindQueue(database)
+    futures = put_while_blocked(writer, database, [(1.0, 1, 0), (2.0, 1, 0)])
+    writer.close()
+    for future in futures:
+        assert future.exception(timeout=10) is error
+    assert writer.failures == 2 and writer.commits == 0
+
+def test_close_writes_the_queued_forecasts():
+    database = RecordingDatabase()
+    writer = WriteBehindQueue(database, max_queue=4, commit_rows=1)
+    futures = [writer.put(Location(0.0, 0.0), make_data(1))]
+    assert database.started.wait(timeout=10)
+    for i in range(1, 5):
+        futures.append(writer.put(Location(float(i), 0.0), make_data(1)))
+    closer = threading.Thread(target=writer.close)
+    closer.start()
+    database.release()
+    closer.join(timeout=10)
+    assert not closer.is_alive()
+    assert all(future.done() for future in futures)
+    assert sorted(sum(database.commits, [])) == [0.0, 1.0, 2.0, 3.0, 4.0]
+    with pytest.raises(RuntimeError):
+        writer.put(Location(5.0, 0.0), make_data(1))
+
+def test_put_during_close_is_written_or_refused():
+    database = RecordingDatabase()
+    database.release()
+    writer = WriteBehindQueue(database, max_queue=2, commit_rows=1)
+    futures, refused = [], []
+
+    def put_many(thread: int):
+        for i in range(200):
+            try:
+                futures.append(writer.put(Location(float(thread), float(i)), make_data(1)))
+            except RuntimeError:
+                refused.append(i)
+
+    threads = [threading.Thread(target=put_many, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.01)
+    writer.close()
+    for thread in threads:
+        thread.join(timeout=10)
+    # every queued forecast is committed before close() returns
+    assert all(future.done() for future in futures)
+    assert len(futures) + len(refused) == 800
+    writer.flush()
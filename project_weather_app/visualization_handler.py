@@ -1,11 +1,31 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 from abc import ABC, abstractmethod
+# matplotlib is imported by the handlers when they plot, so runs without a plot
+# (e.g. --no-plot, --locations-file) do not spend the time to load it.
+
+from decimate import decimate_frame
 
 import logging
 logger = logging.getLogger(__name__)
 
+# width of the plots in inches
+FIGURE_WIDTH = 8
+
+def get_series(df: pd.DataFrame, width: int, decimation: str = None) -> dict:
+    """
+    Get the series of each column of the dataframe to plot, downsampled to about
+    width points (the width of the plot in pixels) with decimation ("lttb" or "minmax"),
+    or all points without decimation.
+    """
+    if decimation is None:
+        return {column: df[column] for column in df.columns}
+    return decimate_frame(df, width, decimation)
+
 class IVisualizationHandler(ABC):
     @abstractmethod
     def __init__(self):
@@ -16,8 +36,13 @@ class IVisualizationHandler(ABC):
         pass
 
 class VisualizationHandler(IVisualizationHandler):
-    def __init__(self):
-        pass
+    def __init__(self, decimation: str = "lttb", width: int = None):
+        """
+        Long series are downsampled with decimation ("lttb", "minmax" or None)
+        to width points, by default the width of the figure in pixels.
+        """
+        self._decimation = decimation
+        self._width = width
 
     def visualize_data(self, df: pd.DataFrame):
         """
@@ -31,7 +56,9 @@ class VisualizationHandler(IVisualizationHandler):
         # stop if dataframe is empty        
         if df.empty:
             logger.warning("cannot plot empty dataframe.")
-            exit(0)
+            return
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
         
         # Setup plotting colors
         ax1_color = "lightblue" # precipitation probability
@@ -39,7 +66,7 @@ class VisualizationHandler(IVisualizationHandler):
         ax3_color = "orange"    # wind speed
 
         # setup plotting area with two subplots
-        fig, ax = plt.subplots(2, 1, figsize=(8,6))
+        fig, ax = plt.subplots(2, 1, figsize=(FIGURE_WIDTH,6))
         # setup second pair of axis for the top figure.
         ax0_twin = ax[0].twinx()
 
@@ -51,13 +78,15 @@ class VisualizationHandler(IVisualizationHandler):
         ax[1].xaxis.set_major_locator(locator)
         ax[1].xaxis.set_major_formatter(formatter)
 
-        # plot the three data series
-        df["precipitation_probability"].plot(ax=ax[0], color = ax1_color, 
-                                             label="Precipitation Probability", rot=0)
-        df["precipitation"].plot(ax=ax0_twin, color = ax2_color, 
-                                 label="Precipitation", rot=0)
-        df["wind_speed_10m"].plot(ax=ax[1], color=ax3_color, 
-                                  label="Wind Speed", rot=0)
+        # plot the three data series, with about one point per pixel
+        width = self._width or int(FIGURE_WIDTH * fig.dpi)
+        series = get_series(df, width, self._decimation)
+        series["precipitation_probability"].plot(ax=ax[0], color = ax1_color, 
+                                                 label="Precipitation Probability", rot=0)
+        series["precipitation"].plot(ax=ax0_twin, color = ax2_color, 
+                                     label="Precipitation", rot=0)
+        series["wind_speed_10m"].plot(ax=ax[1], color=ax3_color, 
+                                      label="Wind Speed", rot=0)
 
         # setup x-axis limits
         time = df.index.values
@@ -78,3 +107,139 @@ class VisualizationHandler(IVisualizationHandler):
         fig.legend(loc="center right")        
         fig.tight_layout()
         plt.show()
+
+class HeadlessVisualizationHandler(IVisualizationHandler):
+    def __init__(self, filename: str = None, dpi: int = 100, png_compress_level: int = 1,
+                 decimation: str = "lttb", width: int = None):
+        """
+        Create the renderer of the weather plots to PNG or SVG files or bytes,
+        with the Agg canvas and without a window, e.g. for a server or a batch job.
+        visualize_data() writes the plot to filename (the format from its extension),
+        or returns the PNG bytes without a filename.
+        The figure, axes, lines, locators and formatters are made once, and each
+        plot only updates the data of the lines, so many plots are rendered quickly.
+        PNG files are compressed with the fast png_compress_level (0-9) by default,
+        since the encoding takes about a third of the rendering time.
+        Long series are downsampled like in VisualizationHandler.
+        """
+        self._filename = filename
+        self._dpi = dpi
+        self._png_compress_level = png_compress_level
+        self._decimation = decimation
+        self._width = width or FIGURE_WIDTH * dpi
+        self._figure = None
+        self._laid_out = False
+
+    def _make_figure(self):
+        """
+        Make the figure template with the same layout as VisualizationHandler, with empty lines.
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        import matplotlib.dates as mdates
+        figure = Figure(figsize=(FIGURE_WIDTH, 6), dpi=self._dpi)
+        FigureCanvasAgg(figure)
+        ax = figure.subplots(2, 1)
+        ax0_twin = ax[0].twinx()
+        locator = mdates.AutoDateLocator(minticks=3, maxticks=9)
+        formatter = mdates.ConciseDateFormatter(locator)
+        for axis in (ax[0], ax[1]):
+            axis.xaxis.set_major_locator(locator)
+            axis.xaxis.set_major_formatter(formatter)
+        # the axes of each measure, with its color and labels
+        self._lines = {}
+        for axis, measure, color, label in ((ax[0], "precipitation_probability", "lightblue", "Precipitation Probability"),
+                                            (ax0_twin, "precipitation", "darkblue", "Precipitation"),
+                                            (ax[1], "wind_speed_10m", "orange", "Wind Speed")):
+            self._lines[measure] = axis.plot([], [], color=color, label=label)[0]
+        ax[0].set_ylabel("Precipitation Probability(%)")
+        ax0_twin.set_ylabel("Precipitation(in)")
+        ax[1].set_ylabel("Wind Speed(mph)")
+        figure.legend(loc="center right")
+        self._axes = (ax[0], ax0_twin, ax[1])
+        self._figure = figure
+
+    def render(self, df: pd.DataFrame, format: str = "png") -> bytes:
+        """
+        Render the plot of the weather data, and return it in format ("png" or "svg").
+        """
+        output = io.BytesIO()
+        self._draw(df, output, format)
+        return output.getvalue()
+
+    def save(self, df: pd.DataFrame, filename: str):
+        """
+        Render the plot of the weather data to filename, in the format of its extension.
+        """
+        self._draw(df, filename, os.path.splitext(str(filename))[1].lstrip(".").lower() or "png")
+
+    def _draw(self, df: pd.DataFrame, output, format: str):
+        """
+        Update the lines of the figure template with the data, and print the figure to output.
+        """
+        import matplotlib.dates as mdates
+        if self._figure is None:
+            self._make_figure()
+        series = get_series(df, self._width, self._decimation)
+        for measure, line in self._lines.items():
+            line.set_data(mdates.date2num(series[measure].index.values), series[measure].to_numpy())
+        time = mdates.date2num(df.index.values[[0, -1]])
+        for axis in self._axes:
+            # set_ylim() of the previous plot turned the autoscale off
+            axis.set_autoscaley_on(True)
+            axis.relim()
+            axis.autoscale_view()
+            axis.set_xlim((time[0], time[-1]) if time[0] < time[-1] else (time[0] - 1, time[0] + 1))
+            axis.set_ylim(bottom=0)
+        if not self._laid_out:
+            # the layout is computed with the first data, and kept for the next plots
+            self._figure.tight_layout()
+            self._laid_out = True
+        if format == "png":
+            self._figure.savefig(output, format=format, pil_kwargs={"compress_level": self._png_compress_level})
+        else:
+            self._figure.savefig(output, format=format)
+
+    def visualize_data(self, df: pd.DataFrame):
+        """
+        Render the plot of the weather data to the file of the handler,
+        or return the PNG bytes without a file. An empty dataframe is not plotted.
+        """
+        if df.empty:
+            logger.warning("cannot plot empty dataframe.")
+            return None
+        if self._filename is None:
+            return self.render(df)
+        self.save(df, self._filename)
+        logger.info("Plot saved to " + str(self._filename))
+        return self._filename
+
+# the renderer of each process of render_many()
+_worker_handler = None
+
+def _init_worker(dpi: int, decimation: str, width: int):
+    global _worker_handler
+    _worker_handler = HeadlessVisualizationHandler(dpi=dpi, decimation=decimation, width=width)
+
+def _render_in_worker(item):
+    filename, df = item
+    _worker_handler.save(df, filename)
+    return filename
+
+def render_many(plots: List[Tuple[str, pd.DataFrame]], processes: int = None,
+                dpi: int = 100, decimation: str = "lttb", width: int = None,
+                chunksize: int = 4) -> List[str]:
+    """
+    Render the plots of many dataframes to files, given as (filename, dataframe),
+    in a pool of processes (by default one per cpu), each with its own figure template.
+    Empty dataframes are skipped. Returns the filenames of the rendered plots.
+    """
+    plots = [(filename, df) for filename, df in plots if not df.empty]
+    if processes == 1 or len(plots) <= 1:
+        handler = HeadlessVisualizationHandler(dpi=dpi, decimation=decimation, width=width)
+        for filename, df in plots:
+            handler.save(df, filename)
+        return [filename for filename, _ in plots]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(dpi, decimation, width)) as executor:
+        return list(executor.map(_render_in_worker, plots, chunksize=chunksize))
@@ -0,0 +1,184 @@
+"""
+The WriteBehindQueue object decouples downloading from writing to the database:
+the download threads put the decoded forecasts on a bounded queue, and one writer
+thread takes them off and writes them in group commits: the forecasts that were queued
+while the previous commit ran are written in one transaction, up to commit_rows records
+or commit_interval seconds of forecasts. The writer never waits for more forecasts,
+so a single download is written at once. The network latency of the downloads and
+the disk latency of the commits overlap, and many small transactions become a few large ones.
+A full queue blocks the download threads until the writer catches up (backpressure),
+and close() writes everything that is queued before it returns.
+Usage:
+    writer = WriteBehindQueue(database)
+    future = writer.put(location, df, fetched_at)
+    future.result() # wait until the forecast is committed
+    writer.close()
+"""
+import datetime
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from database import IWeatherStorage
+from exception import RECOVERABLE_ERRORS
+from location import Location
+import metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+# put on the queue by close() to stop the writer thread
+_STOP = object()
+
+class WriteRequest():
+    def __init__(self, location: Location, data, fetched_at: datetime.datetime = None):
+        """
+        A forecast to write: the location, its records (as for IWeatherStorage.insert_records()),
+        the time it was downloaded, and the future that is done when it is committed.
+        """
+        self.location = location
+        self.data = data
+        self.fetched_at = fetched_at
+        self.n_rows = len(data["time"]) if isinstance(data, dict) else len(data)
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+class WriteBehindQueue():
+    def __init__(self, database: IWeatherStorage, max_queue: int = 64,
+                 commit_rows: int = 50000, commit_interval: float = 0.5):
+        """
+        Create the queue of up to max_queue forecasts, and start the writer thread.
+        A commit writes the queued forecasts up to commit_rows records, and the forecasts
+        queued within commit_interval seconds after the first one.
+        """
+        self._database = database
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._commit_rows = commit_rows
+        self._commit_interval = commit_interval
+        self._closed = False
+        # the lock of the counters, used by the writer thread
+        self._lock = threading.Lock()
+        # held to check that the queue is open and put a forecast on it,
+        # so no forecast is queued after the _STOP of close()
+        self._put_lock = threading.Lock()
+        self.commits = 0
+        self.rows = 0
+        self.failures = 0
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, location: Location, data, fetched_at: datetime.datetime = None,
+            timeout: float = None) -> Future:
+        """
+        Queue a forecast to write. Blocks while the queue is full, up to timeout seconds
+        (by default without a limit), then raises TimeoutError.
+        Returns a future with the number of records written, or the error of the commit.
+        """
+        request = WriteRequest(location, data, fetched_at)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # the other threads wait for the lock while the queue is full
+        if not self._put_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError("Timeout waiting for the write-behind queue.")
+        try:
+            if self._closed:
+                raise RuntimeError("The write-behind queue is closed.")
+            if self._queue.full():
+                metrics.count("write_queue_full")
+            try:
+                self._queue.put(request, timeout=None if deadline is None
+                                else max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                raise TimeoutError("Timeout waiting for the write-behind queue.")
+        finally:
+            self._put_lock.release()
+        metrics.gauge("write_queue_depth", self._queue.qsize())
+        return request.future
+
+    def flush(self):
+        """
+        Wait until all queued forecasts are committed.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Write the queued forecasts and stop the writer thread.
+        """
+        with self._put_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+        logger.debug("Write-behind queue closed. " + self.get_status())
+
+    def get_status(self) -> str:
+        return ("write-behind commits: " + str(self.commits) + ", records: " + str(self.rows)
+                + ", failed commits: " + str(self.failures))
+
+    def _run(self):
+        """
+        Take the forecasts off the queue and commit them in groups, until close().
+        """
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+            group = [item]
+            n_rows = item.n_rows
+            # a steady stream of forecasts is cut into commits of commit_interval seconds
+            deadline = item.queued_at + self._commit_interval
+            while n_rows < self._commit_rows:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                group.append(item)
+                n_rows += item.n_rows
+                if item.queued_at > deadline:
+                    break
+            metrics.gauge("write_queue_depth", self._queue.qsize())
+            self._commit(group)
+            for _ in group:
+                self._queue.task_done()
+
+    def _commit(self, group):
+        """
+        Write a group of forecasts in one transaction, and complete their futures.
+        The earliest download time of the group is saved for all its locations,
+        so an incremental download never skips hours.
+        """
+        fetched_at = [request.fetched_at for request in group if request.fetched_at is not None]
+        start = time.perf_counter()
+        try:
+            with metrics.timer("commit"):
+                self._database.insert_many(((request.location, request.data) for request in group),
+                                           fetched_at=min(fetched_at) if fetched_at else None)
+        except RECOVERABLE_ERRORS as err:
+            # the writer goes on with the next group, and the callers get the error
+            logger.error("Cannot write " + str(len(group)) + " forecasts to the database: " + str(err))
+            with self._lock:
+                self.failures += 1
+            metrics.count("write_commit_failures")
+            for request in group:
+                request.future.set_exception(err)
+            return
+        end = time.perf_counter()
+        with self._lock:
+            self.commits += 1
+            self.rows += sum(request.n_rows for request in group)
+        metrics.count("write_commits")
+        metrics.count("write_commit_locations", len(group))
+        for request in group:
+            # the time from queueing a forecast until it is committed
+            metrics.observe("write_delay", end - request.queued_at)
+            request.future.set_result(request.n_rows)
+        logger.debug("Committed " + str(len(group)) + " forecasts in "
+                     + format((end - start) * 1000, ".1f") + " ms")